@@ -0,0 +1,595 @@
+import os
+import socket
+import asyncio
+import zlib
+import time
+import hashlib
+import ftplib
+import tarfile
+import threading
+from urllib.parse import urlparse
+
+import requests
+import urllib3
+
+import PdfCheck
+from Metrics import metrics
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# aiohttp is only required for the asynchronous harvesting mode
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+"""
+In-process download engine, replacing the former wget shell-out (one process per URL).
+
+HTTP(S) downloads are realized with a shared requests session, which keeps per-host keep-alive
+connection pools, so that TCP connections and TLS sessions are reused across downloads from the
+same server. FTP downloads (PMC) reuse idle logged-in connections per host. Response bodies are
+streamed to the disk by chunks. PMC archives (.tar.gz) are unpacked while they are downloaded: only
+the PDF and the NLM members are written, and the transfer is stopped as soon as both are found.
+
+The result of a download is a status string, "0" when successful, otherwise a structured error code
+of the form "<error class>:<detail>", for instance "http:404", "dns:...", "timeout:...", "tls:...", "refused:...",
+together with the SHA-256 digest of the PDF, computed while it is written, for deduplication.
+
+When a URL cache is given (see UrlCache), HTTP(S) downloads go directly to the final URL known from a 
+previous download, are conditional requests when the content is already harvested, and the known dead 
+links are not requested again.
+
+AsyncDownloader is the equivalent engine for the asynchronous harvesting mode, based on aiohttp, where 
+an in-flight download is a coroutine and not an OS thread.
+"""
+
+# default request headers, as previously used with wget
+default_headers = {
+    "User-Agent": "Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:60.0) Gecko/20100101 Firefox/60.0",
+    "Accept": "application/pdf, text/html;q=0.9,*/*;q=0.8",
+    "Accept-Encoding": "gzip, deflate"
+}
+
+chunk_size = 64 * 1024
+
+# the connection attempts are spaced by backoff_factor * 2^attempt seconds
+backoff_factor = 0.1
+
+class Downloader(object):
+
+    def __init__(self, config, url_cache=None, has_content=None):
+        self.config = config
+        # optional persistent cache of the responses by URL
+        self.url_cache = url_cache
+        # callback indicating if a content hash is already harvested, for the conditional requests
+        self.has_content = has_content
+        # integrity check of the downloaded PDF
+        self.pdf_checker = PdfCheck.PdfChecker(config)
+        self.connect_timeout = config.get('connect_timeout', 5)
+        self.read_timeout = config.get('read_timeout', 20)
+        tries = config.get('tries', 5)
+
+        self.session = requests.Session()
+        self.session.headers.update(default_headers)
+        self.session.max_redirects = config.get('max_redirects', 10)
+        # retries apply to connection establishment failures (including connection refused),
+        # not to HTTP error status
+        retries = Retry(total=tries-1, status=0, backoff_factor=backoff_factor)
+        # pool_connections is the number of hosts for which a keep-alive pool is cached,
+        # pool_maxsize the max number of reusable connections per host
+        adapter = _TimedHTTPAdapter(pool_connections=config.get('nb_host_pools', 1000),
+                              pool_maxsize=config.get('nb_workers', 12),
+                              max_retries=retries)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        # idle FTP connections by host
+        self.ftp_pool = {}
+        self.ftp_lock = threading.Lock()
+
+    def download(self, url, filename, entry):
+        """
+        Download the resource at the given url into filename, for PMC archives extract then the PDF
+        and NLM files. Return a status string ("0" if successful, an error code otherwise), the entry
+        and the digest of the PDF (None if not available).
+        """
+        # PMC archives are extracted on the fly, the archive itself is never written to disk
+        extract = filename.endswith(".tar.gz") and self.config.get('pmc_streaming', True)
+        info = None
+        if url.startswith("ftp://"):
+            digest = hashlib.sha256()
+            result = self._download_ftp(url, filename, extract, digest)
+        else:
+            result, digest, info = self._download_http_cached(url, filename, extract)
+            if info is None:
+                # known dead link, the negative entry is not renewed and expires after its ttl
+                return result, entry, None
+            if info.get('not_modified'):
+                # unchanged content, already harvested
+                return "0", entry, bytes.fromhex(info['hash'])
+
+        if result == "0" and filename.endswith(".tar.gz") and os.path.isfile(filename):
+            # for PMC we still have to extract the PDF from archive
+            result = _extract_archive(filename, digest)
+        elif result == "0" and filename.endswith(".pdf"):
+            with metrics.timer("validation_seconds"):
+                result = self.pdf_checker.check(filename)
+
+        content_hash = _content_hash(result, filename, digest)
+        if info is not None:
+            _update_cache(self.url_cache, url, result, info, content_hash)
+        return result, entry, content_hash
+
+    def _download_http_cached(self, url, filename, extract=False):
+        """
+        HTTP download through the URL cache, return the status, the digest of the written PDF and the
+        response information (final url, validators, not_modified), None when the url is not requested 
+        because it is a known dead link
+        """
+        cached = self.url_cache.get(url) if self.url_cache is not None else None
+        if cached is not None and cached.get('status') is not None:
+            # known dead link
+            return cached['status'], hashlib.sha256(), None
+        headers = _conditional_headers(cached, self.has_content)
+        final_url = cached.get('final_url') if cached is not None else None
+
+        digest = hashlib.sha256()
+        info = { 'hash': cached.get('hash') if cached is not None else None }
+        result = self._download_http(final_url or url, filename, extract, digest, headers, info)
+        if result != "0" and final_url is not None:
+            # the redirections might have changed, new attempt with the original url
+            digest = hashlib.sha256()
+            result = self._download_http(url, filename, extract, digest, headers, info)
+        return result, digest, info
+
+    def _download_http(self, url, filename, extract=False, digest=None, headers=None, info=None):
+        try:
+            start = time.monotonic()
+            with self.session.get(url, stream=True, timeout=(self.connect_timeout, self.read_timeout), headers=headers) as response:
+                # time to first byte, including the connection (if new) and the redirections
+                headers_time = time.monotonic()
+                metrics.observe("ttfb_seconds", headers_time - start)
+                if response.status_code >= 400:
+                    return "http:" + str(response.status_code)
+                if info is not None:
+                    _response_info(info, response.status_code, str(response.url), response.headers)
+                    if info.get('not_modified'):
+                        return "0"
+                try:
+                    if extract:
+                        response.raw.decode_content = True
+                        # leaving the response context before the end of the body closes the connection
+                        result, _ = _extract_archive_stream(response.raw, filename, digest)
+                        return result
+                    with open(filename, 'wb') as f:
+                        for chunk in response.iter_content(chunk_size=chunk_size):
+                            f.write(chunk)
+                            if digest is not None:
+                                digest.update(chunk)
+                finally:
+                    metrics.observe("transfer_seconds", time.monotonic() - headers_time)
+                    # bytes received on the wire, before content decoding
+                    metrics.inc("downloaded_bytes", response.raw.tell())
+        except requests.exceptions.SSLError as e:
+            return "tls:" + _message(e)
+        except (requests.exceptions.Timeout, urllib3.exceptions.ReadTimeoutError) as e:
+            return "timeout:" + _message(e)
+        except requests.exceptions.TooManyRedirects as e:
+            return "redirect:" + _message(e)
+        except requests.exceptions.ConnectionError as e:
+            if _is_dns_error(e):
+                return "dns:" + _message(e)
+            if _is_refused(e):
+                return "refused:" + _message(e)
+            return "connection:" + _message(e)
+        except urllib3.exceptions.ProtocolError as e:
+            # raw body read interrupted, only when streaming archives
+            return "connection:" + _message(e)
+        except (requests.exceptions.RequestException, urllib3.exceptions.HTTPError) as e:
+            return "request:" + _message(e)
+        except OSError as e:
+            return "io:" + _message(e)
+        return "0"
+
+    def _download_ftp(self, url, filename, extract=False, digest=None):
+        parsed = urlparse(url)
+        host = parsed.hostname
+        try:
+            ftp = self._get_ftp(host, parsed.port)
+        except socket.gaierror as e:
+            return "dns:" + _message(e)
+        except socket.timeout as e:
+            return "timeout:" + _message(e)
+        except ConnectionRefusedError as e:
+            return "refused:" + _message(e)
+        except (ftplib.Error, OSError) as e:
+            return "connection:" + _message(e)
+
+        try:
+            if extract:
+                ftp.voidcmd('TYPE I')
+                with ftp.transfercmd('RETR ' + parsed.path) as conn:
+                    with conn.makefile('rb') as stream:
+                        result, complete = _extract_archive_stream(stream, filename, digest)
+                        if complete:
+                            # padding after the end of the tar archive, for a clean end of transfer
+                            while stream.read(chunk_size):
+                                pass
+                if not complete:
+                    # transfer interrupted on our side, the connection is not reused
+                    _close_ftp(ftp)
+                    return result
+                ftp.voidresp()
+            else:
+                with open(filename, 'wb') as f:
+                    ftp.retrbinary('RETR ' + parsed.path, _hashed_writer(f, digest), blocksize=chunk_size)
+                metrics.inc("downloaded_bytes", os.path.getsize(filename))
+                result = "0"
+        except ftplib.error_perm as e:
+            # permanent error, e.g. 550 file not found, the connection remains usable
+            self._release_ftp(host, ftp)
+            return "ftp:" + str(e)[:3]
+        except socket.timeout as e:
+            _close_ftp(ftp)
+            return "timeout:" + _message(e)
+        except ftplib.Error as e:
+            _close_ftp(ftp)
+            return "ftp:" + str(e)[:3]
+        except OSError as e:
+            _close_ftp(ftp)
+            return "connection:" + _message(e)
+
+        self._release_ftp(host, ftp)
+        return result
+
+    def _get_ftp(self, host, port=None):
+        """
+        Return an idle connection to the host still alive, or a new logged-in connection
+        """
+        while True:
+            with self.ftp_lock:
+                idle = self.ftp_pool.get(host)
+                ftp = idle.pop() if idle else None
+            if ftp is None:
+                break
+            try:
+                # the server might have closed an idle connection
+                ftp.voidcmd('NOOP')
+                return ftp
+            except (ftplib.Error, OSError, EOFError):
+                _close_ftp(ftp)
+        ftp = ftplib.FTP()
+        ftp.connect(host, port or 21, timeout=self.connect_timeout)
+        # connect() applies its timeout to the control connection and to the later data connections
+        ftp.sock.settimeout(self.read_timeout)
+        ftp.timeout = self.read_timeout
+        ftp.login()
+        return ftp
+
+    def _release_ftp(self, host, ftp):
+        with self.ftp_lock:
+            self.ftp_pool.setdefault(host, []).append(ftp)
+
+    def close(self):
+        self.session.close()
+        with self.ftp_lock:
+            for connections in self.ftp_pool.values():
+                for ftp in connections:
+                    _close_ftp(ftp)
+            self.ftp_pool = {}
+
+class AsyncDownloader(object):
+    """
+    Download engine for the asynchronous harvesting mode. The aiohttp session must be opened and 
+    closed within the running event loop. The number of in-flight requests is bounded by the caller, 
+    the connector limit is set to the same global concurrency.
+    """
+
+    def __init__(self, config, url_cache=None, has_content=None):
+        if aiohttp is None:
+            raise ImportError("the asynchronous harvesting mode requires aiohttp, install it with: pip3 install aiohttp")
+        self.config = config
+        self.concurrency = config.get('async_concurrency', 500)
+        self.tries = config.get('tries', 5)
+        self.timeout = aiohttp.ClientTimeout(sock_connect=config.get('connect_timeout', 5), 
+                                             sock_read=config.get('read_timeout', 20))
+        self.max_redirects = config.get('max_redirects', 10)
+        self.session = None
+        # FTP downloads, archive extraction and PDF check are blocking, they are delegated 
+        # to the synchronous engine in the default executor of the loop
+        self.sync_downloader = Downloader(config, url_cache, has_content)
+        self.url_cache = url_cache
+        self.has_content = has_content
+
+    async def open(self):
+        connector = aiohttp.TCPConnector(limit=self.concurrency, ttl_dns_cache=600)
+        self.session = aiohttp.ClientSession(connector=connector, headers=default_headers, timeout=self.timeout,
+                                             trace_configs=[_trace_config()])
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+        self.sync_downloader.close()
+
+    async def download(self, url, filename, entry):
+        """
+        Asynchronous equivalent of Downloader.download()
+        """
+        loop = asyncio.get_running_loop()
+        if url.startswith("ftp://") or filename.endswith(".tar.gz"):
+            # the archives are extracted while streaming with the synchronous tarfile API
+            return await loop.run_in_executor(None, self.sync_downloader.download, url, filename, entry)
+
+        cached = self.url_cache.get(url) if self.url_cache is not None else None
+        if cached is not None and cached.get('status') is not None:
+            # known dead link
+            return cached['status'], entry, None
+        headers = _conditional_headers(cached, self.has_content)
+        final_url = cached.get('final_url') if cached is not None else None
+        info = { 'hash': cached.get('hash') if cached is not None else None }
+
+        for target in ([final_url, url] if final_url is not None else [url]):
+            for attempt in range(self.tries):
+                digest = hashlib.sha256()
+                result = await self._download_http(target, filename, digest, headers, info)
+                # only the failures to establish a connection are retried
+                if not (result.startswith("connection:") or result.startswith("refused:")):
+                    break
+                if attempt + 1 < self.tries:
+                    await asyncio.sleep(backoff_factor * (2 ** attempt))
+            if result == "0":
+                break
+
+        if info.get('not_modified'):
+            # unchanged content, already harvested
+            return "0", entry, bytes.fromhex(info['hash'])
+
+        if result == "0" and filename.endswith(".pdf"):
+            # the quick check reads only a few KB, the possible full check is delegated to the executor
+            with metrics.timer("validation_seconds"):
+                result = PdfCheck.quick_check(filename)
+                if result is PdfCheck.AMBIGUOUS:
+                    result = await loop.run_in_executor(None, self.sync_downloader.pdf_checker.check, filename)
+
+        content_hash = _content_hash(result, filename, digest)
+        _update_cache(self.url_cache, url, result, info, content_hash)
+        return result, entry, content_hash
+
+    async def _download_http(self, url, filename, digest=None, headers=None, info=None):
+        try:
+            start = time.monotonic()
+            async with self.session.get(url, max_redirects=self.max_redirects, headers=headers) as response:
+                headers_time = time.monotonic()
+                metrics.observe("ttfb_seconds", headers_time - start)
+                if response.status >= 400:
+                    return "http:" + str(response.status)
+                if info is not None:
+                    _response_info(info, response.status, str(response.url), response.headers)
+                    if info.get('not_modified'):
+                        return "0"
+                size = 0
+                try:
+                    with open(filename, 'wb') as f:
+                        async for chunk in response.content.iter_chunked(chunk_size):
+                            f.write(chunk)
+                            size += len(chunk)
+                            if digest is not None:
+                                digest.update(chunk)
+                finally:
+                    metrics.observe("transfer_seconds", time.monotonic() - headers_time)
+                    metrics.inc("downloaded_bytes", size)
+        except aiohttp.ClientSSLError as e:
+            return "tls:" + _message(e)
+        except aiohttp.TooManyRedirects as e:
+            return "redirect:" + _message(e)
+        except aiohttp.ClientConnectorError as e:
+            if _is_dns_error(e) or isinstance(e.os_error, socket.gaierror):
+                return "dns:" + _message(e)
+            if _is_refused(e):
+                return "refused:" + _message(e)
+            return "connection:" + _message(e)
+        except (asyncio.TimeoutError, aiohttp.ServerTimeoutError) as e:
+            return "timeout:" + (_message(e) or "read timeout")
+        except aiohttp.ClientError as e:
+            return "request:" + _message(e)
+        except OSError as e:
+            return "io:" + _message(e)
+        return "0"
+
+class _TimedHTTPConnection(urllib3.connection.HTTPConnection):
+
+    def connect(self):
+        # DNS resolution and TCP connection, only for the new connections
+        with metrics.timer("connect_seconds"):
+            super().connect()
+
+class _TimedHTTPSConnection(urllib3.connection.HTTPSConnection):
+
+    def connect(self):
+        # DNS resolution, TCP connection and TLS handshake, only for the new connections
+        with metrics.timer("connect_seconds"):
+            super().connect()
+
+class _TimedHTTPConnectionPool(urllib3.HTTPConnectionPool):
+    ConnectionCls = _TimedHTTPConnection
+
+class _TimedHTTPSConnectionPool(urllib3.HTTPSConnectionPool):
+    ConnectionCls = _TimedHTTPSConnection
+
+class _TimedHTTPAdapter(HTTPAdapter):
+    """
+    HTTPAdapter recording the connection establishment time of its connection pools
+    """
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = { "http": _TimedHTTPConnectionPool, "https": _TimedHTTPSConnectionPool }
+
+def _trace_config():
+    """
+    aiohttp tracing of the DNS resolution and connection establishment times
+    """
+    trace_config = aiohttp.TraceConfig()
+
+    async def dns_start(session, context, params):
+        context.dns_start = time.monotonic()
+
+    async def dns_end(session, context, params):
+        metrics.observe("dns_seconds", time.monotonic() - context.dns_start)
+
+    async def connection_start(session, context, params):
+        context.connection_start = time.monotonic()
+
+    async def connection_end(session, context, params):
+        metrics.observe("connect_seconds", time.monotonic() - context.connection_start)
+
+    trace_config.on_dns_resolvehost_start.append(dns_start)
+    trace_config.on_dns_resolvehost_end.append(dns_end)
+    trace_config.on_connection_create_start.append(connection_start)
+    trace_config.on_connection_create_end.append(connection_end)
+    return trace_config
+
+def _extract_archive_stream(stream, filename, digest=None):
+    """
+    Unpack a PMC tar.gz stream, writing only the PDF and the NLM members next to filename (with the 
+    same base name), and stop reading once both have been found. Return the status and a boolean 
+    indicating if the stream has been read until its end. digest is updated with the PDF content.
+    """
+    pdf_found = False
+    nxml_found = False
+    try:
+        with tarfile.open(fileobj=stream, mode='r|*') as tar:
+            for member in tar:
+                if not member.isfile():
+                    continue
+                if not pdf_found and (member.name.endswith(".pdf") or member.name.endswith(".PDF")):
+                    _write_member(tar, member, filename.replace(".tar.gz", ".pdf"), digest)
+                    pdf_found = True
+                elif not nxml_found and member.name.endswith(".nxml"):
+                    _write_member(tar, member, filename.replace(".tar.gz", ".nxml"))
+                    nxml_found = True
+                if pdf_found and nxml_found:
+                    return "0", False
+    except (tarfile.TarError, EOFError, zlib.error) as e:
+        return "archive:" + _message(e), False
+    if not pdf_found:
+        print("warning: no pdf found in archive:", filename)
+    return "0", True
+
+def _write_member(tar, member, path, digest=None):
+    source = tar.extractfile(member)
+    with open(path, 'wb') as f:
+        write = _hashed_writer(f, digest)
+        while True:
+            chunk = source.read(chunk_size)
+            if not chunk:
+                break
+            write(chunk)
+
+def _hashed_writer(f, digest):
+    if digest is None:
+        return f.write
+    def write(chunk):
+        f.write(chunk)
+        digest.update(chunk)
+    return write
+
+def _conditional_headers(cached, has_content):
+    """
+    Validators of the last good response, only if its content is already harvested
+    """
+    if cached is None or cached.get('hash') is None or has_content is None:
+        return None
+    if not has_content(bytes.fromhex(cached['hash'])):
+        return None
+    headers = {}
+    if cached.get('etag') is not None:
+        headers['If-None-Match'] = cached['etag']
+    if cached.get('last_modified') is not None:
+        headers['If-Modified-Since'] = cached['last_modified']
+    return headers or None
+
+def _response_info(info, status, final_url, headers):
+    info['not_modified'] = status == 304 and info.get('hash') is not None
+    info['final_url'] = final_url
+    info['etag'] = headers.get('ETag')
+    info['last_modified'] = headers.get('Last-Modified')
+
+def _update_cache(url_cache, url, result, info, content_hash):
+    if url_cache is None:
+        return
+    if result == "0" and content_hash is not None:
+        url_cache.put_success(url, info.get('final_url'), info.get('etag'), info.get('last_modified'), content_hash)
+    elif result != "0":
+        url_cache.put_failure(url, result)
+
+def _content_hash(result, filename, digest):
+    """
+    Digest of the downloaded PDF, None if the download failed or if there is no PDF
+    """
+    if result != "0" or not os.path.isfile(filename.replace(".tar.gz", ".pdf")):
+        return None
+    return digest.digest()
+
+def _extract_archive(filename, digest=None):
+    """
+    Extract the PDF and the NLM file from a PMC archive, change file names and remove the tar file
+    """
+    thedir = os.path.dirname(filename)
+    try:
+        tar = tarfile.open(filename)
+        pdf_found = False
+        for member in tar.getmembers():
+            if not pdf_found and member.isfile() and (member.name.endswith(".pdf") or member.name.endswith(".PDF")):
+                member.name = os.path.basename(member.name)
+                tar.extract(member, path=thedir)
+                os.rename(os.path.join(thedir,member.name), filename.replace(".tar.gz", ".pdf"))
+                pdf_found = True
+                if digest is not None:
+                    with open(filename.replace(".tar.gz", ".pdf"), 'rb') as f:
+                        for chunk in iter(lambda: f.read(chunk_size), b''):
+                            digest.update(chunk)
+            if member.isfile() and member.name.endswith(".nxml"):
+                member.name = os.path.basename(member.name)
+                tar.extract(member, path=thedir)
+                os.rename(os.path.join(thedir,member.name), filename.replace(".tar.gz", ".nxml"))
+        tar.close()
+    except (tarfile.TarError, OSError, EOFError) as e:
+        return "archive:" + _message(e)
+    if not pdf_found:
+        print("warning: no pdf found in archive:", filename)
+    if os.path.isfile(filename):
+        os.remove(filename)
+    return "0"
+
+def _is_dns_error(exception):
+    return _in_chain(exception, lambda e: isinstance(e, socket.gaierror) or 
+        type(e).__name__ in ('NameResolutionError', 'ClientConnectorDNSError'))
+
+def _is_refused(exception):
+    return _in_chain(exception, lambda e: isinstance(e, ConnectionRefusedError))
+
+def _in_chain(exception, predicate):
+    # walk the chain of wrapped exceptions (requests -> urllib3 -> socket, aiohttp -> socket)
+    seen = set()
+    pending = [exception]
+    while pending:
+        e = pending.pop()
+        if e is None or id(e) in seen:
+            continue
+        seen.add(id(e))
+        if predicate(e):
+            return True
+        pending.extend([e.__cause__, e.__context__, getattr(e, 'reason', None), getattr(e, 'os_error', None)])
+        pending.extend(arg for arg in getattr(e, 'args', ()) if isinstance(arg, BaseException))
+    return False
+
+def _message(exception):
+    return str(exception).replace('\n', ' ')[:200]
+
+def _close_ftp(ftp):
+    try:
+        ftp.close()
+    except Exception:
+        pass
@@ -0,0 +1,126 @@
+import os
+import gzip
+import json
+import shutil
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import lmdb
+
+import Records
+
+# zstandard is optional, only needed for .zst dumps
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+"""
+Parallel dump of the entries lmdb.
+
+The UUID keyspace is split into ranges of key prefixes, and each range is serialized in JSONL by a
+worker process with its own read-only LMDB transaction, into a shard file compressed according to the
+extension of the output file (.gz or .zst). The shards are either kept, or concatenated in key order
+into the output file, which is valid as gzip members and zstd frames can be concatenated.
+
+In mapping mode, only the identifiers (UUID and DOI or PMC identifier, and canonical UUID for the
+duplicated PDF) are written, which are read in the record header without decoding the entries.
+"""
+
+# number of key ranges per dump worker, so that the workers remain busy until the end
+ranges_per_worker = 4
+
+def dump(config, dump_file, nb_workers=None, shards=False, mapping=False):
+    """
+    Dump the entries lmdb in JSONL into dump_file, or into one shard file per key range if shards
+    is True. Return the number of dumped entries.
+    """
+    if nb_workers is None:
+        nb_workers = config.get('nb_dump_workers', os.cpu_count() or 1)
+    ranges = key_ranges(nb_workers * ranges_per_worker)
+    shard_files = [shard_path(dump_file, i) for i in range(len(ranges))]
+
+    # LMDB environments must not be shared with forked processes, the workers open their own
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=nb_workers, mp_context=context) as pool:
+        futures = [pool.submit(dump_range, config, start, end, path, mapping)
+                   for (start, end), path in zip(ranges, shard_files)]
+        n = sum(future.result() for future in futures)
+
+    if not shards:
+        with open(dump_file, 'wb') as file_out:
+            for path in shard_files:
+                with open(path, 'rb') as shard_in:
+                    shutil.copyfileobj(shard_in, file_out, 1024 * 1024)
+                os.remove(path)
+    return n
+
+def dump_range(config, start, end, path, mapping=False):
+    """
+    Write the entries having a key in [start, end[ (end None for no upper bound) into a JSONL file
+    """
+    codec = Records.RecordCodec(config)
+    env = lmdb.open(os.path.join(config["data_path"], 'entries'), readonly=True, max_readers=1024)
+    n = 0
+    try:
+        with env.begin(buffers=True) as txn, _open(path) as file_out:
+            cursor = txn.cursor()
+            if not cursor.set_range(start):
+                return 0
+            for key, value in cursor:
+                key = bytes(key)
+                if end is not None and key >= end:
+                    break
+                record = codec.decode(value)
+                if mapping:
+                    entry = mapping_entry(record)
+                else:
+                    entry = record.entry()
+                    entry["id"] = key.decode(encoding='UTF-8')
+                    if record.canonical is not None:
+                        entry["canonical_id"] = record.canonical
+                file_out.write(json.dumps(entry).encode(encoding='UTF-8'))
+                file_out.write(b"\n")
+                n += 1
+    finally:
+        env.close()
+    return n
+
+def mapping_entry(record):
+    identifier = record.doi
+    if identifier is not None and identifier.startswith("PMC"):
+        # for the PMC set, the pmcid is stored as DOI
+        entry = { "pmcid": identifier, "id": record.id }
+    else:
+        entry = { "doi": identifier, "id": record.id }
+    if record.canonical is not None:
+        # the resources of a duplicate are stored under its canonical entry
+        entry["canonical_id"] = record.canonical
+    return entry
+
+def key_ranges(nb_ranges):
+    """
+    Split the UUID keyspace into at most nb_ranges [start, end[ ranges of 2 hexadecimal characters prefixes
+    """
+    nb_ranges = max(1, min(nb_ranges, 256))
+    bounds = [round(i * 256 / nb_ranges) for i in range(nb_ranges)]
+    starts = [b'' if bound == 0 else ('%02x' % bound).encode() for bound in bounds]
+    return list(zip(starts, starts[1:] + [None]))
+
+def shard_path(dump_file, index):
+    """
+    dump.json.gz -> dump-003.json.gz
+    """
+    directory, name = os.path.split(dump_file)
+    base, dot, extension = name.partition('.')
+    return os.path.join(directory, base + "-%03d" % index + dot + extension)
+
+def _open(path):
+    if path.endswith(".gz"):
+        # a lower compression level than the default, the dump being mostly limited by compression
+        return gzip.open(path, 'wb', compresslevel=5)
+    if path.endswith(".zst"):
+        if zstandard is None:
+            raise ImportError("zstd dumps require zstandard, install it with: pip3 install zstandard")
+        return zstandard.ZstdCompressor().stream_writer(open(path, 'wb'), closefd=True)
+    return open(path, 'wb')
@@ -0,0 +1,237 @@
+import time
+import heapq
+import threading
+from collections import deque
+from urllib.parse import urlparse
+
+from Metrics import metrics
+
+"""
+Per-host politeness scheduler placed in front of the download workers.
+
+Queued download jobs are grouped by host. For each host, the scheduler enforces a concurrency cap and
+a minimal interval between two requests (max request rate). The concurrency cap is adapted following
+an AIMD scheme: it increases additively with the successful downloads and is halved when the host
+is throttling (HTTP 429/503, connection refused), in which case the host is also put in backoff for
+an exponentially growing delay. A slow or throttling host thus only delays its own jobs, the workers
+moving to the jobs of the other hosts.
+
+The per-host parameters can be set for given hosts with host_overrides in the config, a dict from
+the host name to the parameters (host_initial_concurrency, host_max_concurrency, host_rate,
+host_backoff, host_backoff_max) differing from the defaults, e.g. for a single server providing
+most of the jobs, as for PMC.
+
+Failed jobs to be retried within the run are put back with a delay (see RetryPolicy), they are not
+bounded by the queue size, so that a download worker never blocks when retrying a job.
+"""
+
+# default per-host parameters. The first backoff is short: an isolated 503 is common on a healthy
+# host, and with the rate limit even a delay of a few seconds costs most of the host throughput. The
+# delay doubles with the consecutive throttlings, so a host really throttling is still left alone.
+default_parameters = { 'host_initial_concurrency': 2, 'host_max_concurrency': 8, 'host_rate': 5, 
+                       'host_backoff': 0.5, 'host_backoff_max': 300 }
+
+class _Parameters(object):
+
+    def __init__(self, config, defaults=default_parameters):
+        values = dict(defaults)
+        values.update((name, config[name]) for name in default_parameters if name in config)
+        self.values = values
+        self.initial_concurrency = values['host_initial_concurrency']
+        self.max_concurrency = values['host_max_concurrency']
+        # minimal interval in seconds between two requests to the same host, 0 for no rate limit
+        self.interval = 1.0 / values['host_rate'] if values['host_rate'] else 0.0
+        self.backoff_base = values['host_backoff']
+        self.backoff_max = values['host_backoff_max']
+
+class _Host(object):
+
+    def __init__(self, name, parameters):
+        self.name = name
+        self.parameters = parameters
+        self.jobs = deque()
+        self.in_flight = 0
+        # AIMD congestion window, the concurrency cap is its integer part
+        self.window = float(parameters.initial_concurrency)
+        # earliest time for the next request, following the request rate
+        self.next_allowed = 0.0
+        # earliest time for the next request, following a throttling
+        self.backoff_until = 0.0
+        self.nb_backoffs = 0
+        # true when the host is either in the ready queue or in the timer heap
+        self.scheduled = False
+
+class HostScheduler(object):
+
+    def __init__(self, config):
+        self.max_queued = config.get('batch_size', 1000)
+        self.parameters = _Parameters(config)
+        self.overrides = { name: _Parameters(values, self.parameters.values) 
+            for name, values in config.get('host_overrides', {}).items() }
+
+        self.hosts = {}
+        # hosts having queued jobs and available capacity now
+        self.ready = deque()
+        # (time, sequence, host) for hosts waiting for their request rate or backoff delay
+        self.timers = []
+        self.sequence = 0
+        self.nb_queued = 0
+        # (time, sequence, job) for the jobs to be retried, queued again at the indicated time
+        self.delayed = []
+        # dispatched jobs whose result is not yet reported, they might be retried
+        self.nb_in_flight = 0
+        self.closed = False
+        self.condition = threading.Condition()
+        # optional callback to notify an event loop of a change, called with the lock held
+        self.on_change = None
+
+    def put(self, job):
+        """
+        Add a (url, filename, entry) download job, block while the total number of queued jobs
+        is at the maximum
+        """
+        with self.condition:
+            while self.nb_queued >= self.max_queued:
+                self.condition.wait()
+            self._enqueue(job, time.monotonic())
+            self._notify()
+
+    def put_later(self, job, delay):
+        """
+        Add a job to be retried after delay seconds, without blocking. For a dispatched job, it must be
+        called before done().
+        """
+        with self.condition:
+            self.sequence += 1
+            heapq.heappush(self.delayed, (time.monotonic() + delay, self.sequence, job))
+            self._notify()
+
+    def _enqueue(self, job, now):
+        host_name = _host(job[0])
+        host = self.hosts.get(host_name)
+        if host is None:
+            host = _Host(host_name, self.overrides.get(host_name, self.parameters))
+            self.hosts[host_name] = host
+        host.jobs.append((job, now))
+        self.nb_queued += 1
+        self._schedule(host, now)
+
+    def close(self):
+        """
+        No more jobs will be added by put(), get() returns None once all the queued jobs are dispatched
+        and completed without retry
+        """
+        with self.condition:
+            self.closed = True
+            self._notify()
+
+    def get(self):
+        """
+        Return the next job eligible for download, blocking until one is available, or None
+        when the scheduler is closed and all the jobs have been completed
+        """
+        with self.condition:
+            while True:
+                job, timeout, finished = self._next()
+                if job is not None or finished:
+                    return job
+                self.condition.wait(timeout)
+
+    def poll(self):
+        """
+        Non-blocking version of get() for the event loop: return the next eligible job (or None),
+        the delay before a job may become eligible (None if only a notification can make a job
+        eligible) and a boolean indicating if all the jobs have been dispatched
+        """
+        with self.condition:
+            return self._next()
+
+    def done(self, job, result):
+        """
+        Report the result of a dispatched job, for adapting the concurrency of its host
+        """
+        with self.condition:
+            host = self.hosts[_host(job[0])]
+            host.in_flight -= 1
+            self.nb_in_flight -= 1
+            now = time.monotonic()
+            if is_throttling(result):
+                # multiplicative decrease and exponential backoff
+                host.window = max(1.0, host.window / 2)
+                delay = min(host.parameters.backoff_max, host.parameters.backoff_base * (2 ** host.nb_backoffs))
+                host.nb_backoffs += 1
+                host.backoff_until = now + delay
+            elif result == "0":
+                # additive increase, around +1 when a full window of downloads succeeded
+                host.window = min(float(host.parameters.max_concurrency), host.window + 1.0 / host.window)
+                host.nb_backoffs = 0
+            if not host.jobs and host.in_flight == 0 and host.backoff_until <= now:
+                # forget idle hosts, the number of distinct hosts can be very large
+                del self.hosts[host.name]
+            else:
+                self._schedule(host, now)
+            self._notify()
+
+    def _next(self):
+        now = time.monotonic()
+        while self.delayed and self.delayed[0][0] <= now:
+            _, _, job = heapq.heappop(self.delayed)
+            self._enqueue(job, now)
+
+        while self.timers and self.timers[0][0] <= now:
+            _, _, host = heapq.heappop(self.timers)
+            host.scheduled = False
+            self._schedule(host, now)
+
+        while self.ready:
+            host = self.ready.popleft()
+            host.scheduled = False
+            if host.jobs and host.in_flight < int(host.window) and max(host.next_allowed, host.backoff_until) <= now:
+                job, queued_time = host.jobs.popleft()
+                metrics.observe("queue_wait_seconds", now - queued_time)
+                host.in_flight += 1
+                self.nb_in_flight += 1
+                host.next_allowed = now + host.parameters.interval
+                self.nb_queued -= 1
+                self._schedule(host, now)
+                # a slot is now free in the queue for the reader
+                self.condition.notify_all()
+                return job, None, False
+            self._schedule(host, now)
+
+        if self.closed and self.nb_queued == 0 and not self.delayed and self.nb_in_flight == 0:
+            return None, None, True
+        eligible = [heap[0][0] for heap in (self.timers, self.delayed) if heap]
+        timeout = min(eligible) - now if eligible else None
+        return None, timeout, False
+
+    def _schedule(self, host, now):
+        if host.scheduled or not host.jobs or host.in_flight >= int(host.window):
+            # a saturated host is scheduled again by done()
+            return
+        eligible = max(host.next_allowed, host.backoff_until)
+        if eligible <= now:
+            self.ready.append(host)
+        else:
+            self.sequence += 1
+            heapq.heappush(self.timers, (eligible, self.sequence, host))
+        host.scheduled = True
+
+    def _notify(self):
+        self.condition.notify_all()
+        if self.on_change is not None:
+            self.on_change()
+
+def is_throttling(result):
+    """
+    Return True if the download result indicates that the host is limiting our requests
+    """
+    if result is None:
+        return False
+    return result in ("http:429", "http:503") or result.startswith("refused:")
+
+def _host(url):
+    try:
+        return urlparse(url).hostname or ""
+    except ValueError:
+        return ""
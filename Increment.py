@@ -0,0 +1,136 @@
+import os
+import uuid
+import shutil
+
+import numpy
+
+import Records
+from Resume import doi_hash
+from Shard import in_shard
+
+"""
+Difference between a new Unpaywall snapshot and the stored entries, for incremental harvesting.
+
+Both sides are reduced to fixed size records (64 bits hashes of the DOI and of the PDF url) and
+distributed by DOI hash into partition files on disk, so that the memory usage is bounded by the size
+of one partition whatever the size of the snapshot and of the store. Each pair of partitions is then
+compared in memory, selecting:
+
+- the DOI of the snapshot having a PDF url and not present in the store,
+- the stored DOI whose download failed and whose PDF url changed in the snapshot, which are harvested
+  again with their existing UUID.
+
+The selection is returned as the offsets of the corresponding lines in the decompressed snapshot.
+"""
+
+stored_dtype = numpy.dtype([('doi', '<u8'), ('url', '<u8'), ('failed', 'u1'), ('uuid', 'V16')])
+snapshot_dtype = numpy.dtype([('doi', '<u8'), ('url', '<u8'), ('offset', '<u8'), ('line', '<u8')])
+selection_dtype = numpy.dtype([('offset', '<u8'), ('line', '<u8'), ('uuid', 'V16')])
+
+# number of records buffered per partition before being appended to its file
+buffer_size = 65536
+
+class _Partitions(object):
+    """
+    Append-only partition files of fixed size records, distributed by DOI hash
+    """
+
+    def __init__(self, directory, name, dtype, nb_partitions):
+        self.paths = [os.path.join(directory, "%s-%03d.bin" % (name, i)) for i in range(nb_partitions)]
+        self.dtype = dtype
+        self.buffers = [[] for _ in range(nb_partitions)]
+        for path in self.paths:
+            open(path, 'wb').close()
+
+    def add(self, record):
+        buffer = self.buffers[record[0] % len(self.buffers)]
+        buffer.append(record)
+        if len(buffer) >= buffer_size:
+            self._write(buffer, self.paths[record[0] % len(self.buffers)])
+
+    def flush(self):
+        for buffer, path in zip(self.buffers, self.paths):
+            self._write(buffer, path)
+
+    def load(self, i):
+        return numpy.fromfile(self.paths[i], dtype=self.dtype)
+
+    def _write(self, buffer, path):
+        if not buffer:
+            return
+        with open(path, 'ab') as f:
+            numpy.array(buffer, dtype=self.dtype).tofile(f)
+        del buffer[:]
+
+def diff(env, codec, reader, directory, nb_partitions=64, shard=None, env_fail=None):
+    """
+    Return the selected lines of the snapshot read by reader (an UnpaywallReader) with respect to the
+    entries lmdb env, as an array of (offset, line number, uuid) sorted by offset, the uuid being empty
+    for the new entries. With shard, only the lines of the snapshot belonging to the shard are selected.
+    The status of the pickled records not yet migrated is given by the fail lmdb env_fail.
+    """
+    os.makedirs(directory, exist_ok=True)
+    try:
+        stored = _Partitions(directory, "stored", stored_dtype, nb_partitions)
+        with env.begin(buffers=True) as txn:
+            txn_fail = env_fail.begin() if env_fail is not None else None
+            try:
+                for key, value in txn.cursor():
+                    # only the record header is decoded
+                    record = codec.decode(value)
+                    if record.doi is None:
+                        continue
+                    if record.status is None and txn_fail is not None:
+                        # pickled record of a previous version, without status
+                        failed = txn_fail.get(bytes(key)) is not None
+                    else:
+                        failed = record.status == Records.STATUS_FAILED
+                    stored.add((doi_hash(record.doi.encode(encoding='UTF-8')), _url_hash(record.url),
+                                failed, uuid.UUID(record.id).bytes))
+            finally:
+                if txn_fail is not None:
+                    txn_fail.abort()
+        stored.flush()
+
+        snapshot = _Partitions(directory, "snapshot", snapshot_dtype, nb_partitions)
+        for records, _, _ in reader.chunks():
+            for line_number, start, doi, pdf_url, _ in records:
+                if not in_shard(doi, shard):
+                    continue
+                snapshot.add((doi_hash(doi.encode(encoding='UTF-8')), _url_hash(pdf_url), start, line_number))
+        snapshot.flush()
+
+        selections = [_diff_partition(stored.load(i), snapshot.load(i)) for i in range(nb_partitions)]
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    selection = numpy.concatenate(selections) if selections else numpy.zeros(0, dtype=selection_dtype)
+    return selection[numpy.argsort(selection['offset'], kind='stable')]
+
+def _diff_partition(stored, snapshot):
+    # a DOI present several times in the snapshot is only considered once
+    _, first = numpy.unique(snapshot['doi'], return_index=True)
+    snapshot = snapshot[first]
+    stored = stored[numpy.argsort(stored['doi'], kind='stable')]
+    positions = numpy.searchsorted(stored['doi'], snapshot['doi'])
+    found = positions < len(stored)
+    found[found] = stored['doi'][positions[found]] == snapshot['doi'][found]
+
+    # failed entries with a new PDF url
+    changed = numpy.zeros(len(snapshot), dtype=bool)
+    matches = stored[positions[found]]
+    changed[found] = matches['failed'].astype(bool) & (matches['url'] != snapshot['url'][found])
+
+    selection = numpy.zeros(numpy.count_nonzero(~found) + numpy.count_nonzero(changed), dtype=selection_dtype)
+    new = snapshot[~found]
+    selection['offset'][:len(new)] = new['offset']
+    selection['line'][:len(new)] = new['line']
+    selection['offset'][len(new):] = snapshot['offset'][changed]
+    selection['line'][len(new):] = snapshot['line'][changed]
+    selection['uuid'][len(new):] = stored['uuid'][positions[changed]]
+    return selection
+
+def _url_hash(url):
+    if url is None:
+        return 0
+    return doi_hash(url.encode(encoding='UTF-8'))
@@ -0,0 +1,217 @@
+import json
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse
+
+import Records
+
+"""
+Instrumentation of the harvesting pipeline.
+
+The stages record counters and latency histograms in the process-wide registry `metrics`: parsing of
+the input, wait in the scheduler queue, connection establishment (DNS, TCP and TLS), time to first
+byte, body transfer, PDF validation, thumbnail generation, S3 upload and LMDB commit, plus the
+downloaded bytes and the download results by error class and by host. The registry is exposed with
+the Prometheus text format on a local HTTP endpoint (metrics_port in the config file) and/or written
+periodically as one JSON object per line (metrics_log and metrics_interval).
+
+The recording is a dictionary update under a lock, negligible compared to the instrumented operations.
+"""
+
+# upper bounds in seconds of the latency histogram buckets
+buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 25.0, 60.0, 120.0, float('inf'))
+
+# number of hosts reported, those with the most errors, the number of hosts being unbounded
+top_hosts = 20
+
+class _Histogram(object):
+
+    def __init__(self):
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        # upper bound of the bucket containing the quantile
+        rank = q * self.count
+        cumulated = 0
+        for bound, count in zip(buckets, self.counts):
+            cumulated += count
+            if cumulated >= rank:
+                return bound
+        return buckets[-1]
+
+class Registry(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (name, labels) -> value, labels being a sorted tuple of (label, value)
+        self.counters = {}
+        self.histograms = {}
+        # host -> [downloads, errors]
+        self.hosts = {}
+        self.start_time = time.time()
+        self.server = None
+        self.log_thread = None
+        self.stopped = threading.Event()
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = _Histogram()
+                self.histograms[key] = histogram
+            histogram.observe(seconds)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - start, **labels)
+
+    def download(self, url, result, seconds):
+        """
+        Record the result of a download job
+        """
+        error_class = "success" if result == "0" else Records.error_class(result or "empty file")
+        try:
+            host = urlparse(url).hostname or ""
+        except ValueError:
+            host = ""
+        self.inc("downloads", result=error_class)
+        self.observe("download_seconds", seconds)
+        with self.lock:
+            stats = self.hosts.get(host)
+            if stats is None:
+                stats = [0, 0]
+                self.hosts[host] = stats
+            stats[0] += 1
+            if result != "0":
+                stats[1] += 1
+
+    def snapshot(self):
+        """
+        Current state of the registry as a JSON serializable dict
+        """
+        with self.lock:
+            counters = {}
+            for (name, labels), value in self.counters.items():
+                counters[_name(name, labels)] = value
+            latencies = {}
+            for (name, labels), histogram in self.histograms.items():
+                latencies[_name(name, labels)] = { "count": histogram.count,
+                    "mean": round(histogram.sum / histogram.count, 6) if histogram.count else 0.0,
+                    "p50": histogram.quantile(0.5), "p90": histogram.quantile(0.9), "p99": histogram.quantile(0.99) }
+            hosts = self._top_hosts()
+        hosts = { host: { "downloads": stats[0], "errors": stats[1], "error_rate": round(stats[1] / stats[0], 4) }
+            for host, stats in hosts }
+        return { "time": round(time.time(), 3), "uptime": round(time.time() - self.start_time, 3),
+                 "counters": counters, "latencies": latencies, "hosts": hosts }
+
+    def prometheus(self):
+        """
+        Current state of the registry in the Prometheus text exposition format
+        """
+        lines = []
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append("oaharvester_%s_total%s %s" % (name, _labels(labels), value))
+            for (name, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0]):
+                cumulated = 0
+                for bound, count in zip(buckets, histogram.counts):
+                    cumulated += count
+                    le = "+Inf" if bound == float('inf') else repr(bound)
+                    lines.append("oaharvester_%s_bucket%s %d" % (name, _labels(labels + (("le", le),)), cumulated))
+                lines.append("oaharvester_%s_sum%s %f" % (name, _labels(labels), histogram.sum))
+                lines.append("oaharvester_%s_count%s %d" % (name, _labels(labels), histogram.count))
+            for host, stats in self._top_hosts():
+                lines.append("oaharvester_host_downloads_total%s %d" % (_labels((("host", host),)), stats[0]))
+                lines.append("oaharvester_host_errors_total%s %d" % (_labels((("host", host),)), stats[1]))
+        return "\n".join(lines) + "\n"
+
+    def _top_hosts(self):
+        return sorted(self.hosts.items(), key=lambda item: item[1][1], reverse=True)[:top_hosts]
+
+    def start(self, config):
+        """
+        Start the exposure of the metrics as indicated in the config
+        """
+        port = config.get('metrics_port')
+        if port and self.server is None:
+            registry = self
+            class Handler(BaseHTTPRequestHandler):
+                def do_GET(self):
+                    body = registry.prometheus().encode(encoding='UTF-8')
+                    self.send_response(200)
+                    self.send_header("Content-Type", "text/plain; version=0.0.4")
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                def log_message(self, format, *args):
+                    pass
+            self.server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+            threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+        path = config.get('metrics_log')
+        if path and self.log_thread is None:
+            interval = config.get('metrics_interval', 60)
+            self.stopped.clear()
+            self.log_thread = threading.Thread(target=self._log, args=(path, interval), daemon=True)
+            self.log_thread.start()
+
+    def stop(self):
+        if self.log_thread is not None:
+            self.stopped.set()
+            self.log_thread.join()
+            self.log_thread = None
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def _log(self, path, interval):
+        previous = None
+        while True:
+            stopped = self.stopped.wait(interval)
+            snapshot = self.snapshot()
+            # rates over the last interval
+            rates = {}
+            if previous is not None:
+                elapsed = snapshot["time"] - previous["time"]
+                for name, value in snapshot["counters"].items():
+                    rates[name] = round((value - previous["counters"].get(name, 0)) / elapsed, 3) if elapsed > 0 else 0.0
+            snapshot["rates"] = rates
+            with open(path, 'a') as f:
+                f.write(json.dumps(snapshot) + "\n")
+            previous = snapshot
+            if stopped:
+                break
+
+def _name(name, labels):
+    if not labels:
+        return name
+    return name + "{" + ",".join("%s=%s" % (label, value) for label, value in labels) + "}"
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('%s="%s"' % (label, str(value).replace('\\', '\\\\').replace('"', '\\"')) for label, value in labels) + "}"
+
+# process-wide registry
+metrics = Registry()
@@ -3,41 +3,62 @@ import botocore
 import sys
 import os
 import shutil
-import gzip
 import json
-import pickle
 import lmdb
 import uuid
 import subprocess
 import argparse
 import time
 import S3
+import Downloader
+import HostScheduler
+import Resume
+import Reader
+import Records
+import Dump
+import Increment
+import Shard
+import Storage
+import Pack
+from Storage import generateS3Path
+import UrlCache
+import RetryPolicy
+from Metrics import metrics
 from concurrent.futures import ThreadPoolExecutor
-import subprocess
-import  tarfile
-from random import randint
+import queue
+import asyncio
+import threading
+import random
+import logging
+from urllib.parse import urlparse
 
 import numpy
 import math
 
 map_size = 100 * 1024 * 1024 * 1024 
 shuffle_range = math.pow(10, 6)# we will consider 1million entry for the shuffle, but there are more
+# default number of download workers, can be changed with nb_workers in the config file
+default_nb_workers = 12
+# default number of processes parsing the Unpaywall snapshot, 0 to parse in the reader thread
+default_nb_parsers = min(4, os.cpu_count() or 1)
+
+# the per-entry messages (url, error) are logged at debug level
+logger = logging.getLogger("OAHarvester")
 
 '''
-This version uses the standard ThreadPoolExecutor for parallelizing the download/processing/upload processes. 
-Given the limits of ThreadPoolExecutor (input stored in memory, blocking Executor.map until the whole input
-is processed and output stored in memory until all input is consumed), it works with batches of PDF of a size 
-indicated in the config.json file (default is 100 entries). We are moving from first batch to the second one 
-only when the first is entirely processed. 
+This version uses a streaming producer/consumer pipeline for parallelizing the download/processing/upload 
+processes. The input entries are read and pushed into a bounded queue (of size batch_size as indicated in the
+config.json file), a pool of download workers (nb_workers, default 12) consumes this queue and a single writer 
+thread commits the results in LMDB as they complete. Contrary to the former batch approach based on 
+ThreadPoolExecutor.map, there is no barrier at the end of a batch waiting for the slowest download, and the 
+memory usage is bounded by the queue sizes.
 
 '''
 class OAHarverster(object):
 
-    def __init__(self, config_path='./config.json', thumbnail=False, sample=None):
+    def __init__(self, config_path='./config.json', thumbnail=False, sample=None, async_mode=False, seed=None, shard=None):
         self.config = None
 
-        self.size = size
-        
         # standard lmdb environment for storing biblio entries by uuid
         self.env = None
 
@@ -47,19 +68,81 @@ class OAHarverster(object):
         # lmdb environment for keeping track of failures
         self.env_fail = None
 
+        # lmdb environment indexing the failures by error class and by host
+        self.env_fail_index = None
+
+        # lmdb environment for storing mapping between PDF content hash and canonical uuid
+        self.env_hash = None
+
         self._load_config(config_path)
+
+        # (index, number of shards) when only a partition of the input is harvested, the state of 
+        # the shard being kept in its own directory under data_path
+        self.shard = shard
+        if self.shard is not None:
+            self.config["data_path"] = Shard.shard_data_path(self.config["data_path"], self.shard)
         
         # boolean indicating if we want to generate thumbnails of front page of PDF 
         self.thumbnail = thumbnail
+        # bounded pool of thumbnail rendering processes, independent from the number of I/O workers
+        self.thumbnail_executor = None
+        if self.thumbnail:
+            self.thumbnail_executor = ThreadPoolExecutor(
+                max_workers=self.config.get('thumbnail_workers', os.cpu_count() or 1))
+
+        # encoding of the records of the entries lmdb
+        self.records = Records.RecordCodec(self.config)
+
+        # grouped commits of the LMDB write operations, used only by the writer stage
+        self.lmdb_writer = LMDBBatchWriter(self.config)
+
+        # post-download stage (thumbnails, upload or local storage, cleaning), fed by the writer stage
+        self.post_processing = PostProcessing(self.config, self.manageFiles)
         self._init_lmdb()
 
         # if a sample value is provided, indicate that we only harvest the indicated number of PDF
         self.sample = sample
+        # random generator for the sampling, a seed makes the sample reproducible
+        self.random = random.Random(seed)
+
+        # boolean indicating if the downloads are realized with an event loop instead of threads
+        self.async_mode = async_mode
+
+        # resume accelerators, see _initResume()
+        self.checkpoint = None
+        self.doi_index = None
+
+        # uuid of the stored entries harvested again by an incremental harvesting
+        self.updated_ids = None
+
+        # persistent cache of the responses by URL, kept across runs and not removed by a reset
+        self.url_cache = None
+        if self.config.get('url_cache', True):
+            envFilePath = os.path.join(self.config["data_path"], 'url_cache')
+            if not os.path.exists(envFilePath):
+                os.makedirs(envFilePath)
+            self.url_cache = UrlCache.UrlCache(lmdb.open(envFilePath, map_size=map_size, sync=False), self.config)
+
+        # classification of the download failures and scheduling of their retries
+        self.retry_policy = RetryPolicy.RetryPolicy(self.config)
+
+        # in-process download engine, with keep-alive connection pools shared by the download workers
+        self.downloader = Downloader.Downloader(self.config, self.url_cache, self._hasContent)
+
+        # exposure of the pipeline metrics, if configured
+        metrics.start(self.config)
 
         self.s3 = None
         if self.config["bucket_name"] is not None and len(self.config["bucket_name"]) is not 0:
             self.s3 = S3.S3(self.config)
 
+        # local storage of the resources when no S3 bucket is used, or pack storage
+        self.storage = None
+        if self.config.get('storage') == 'pack':
+            self.storage = Pack.PackStorage(self.config, self.s3)
+        elif self.s3 is None:
+            self.storage = Storage.LocalStorage(self.config)
+
     def _load_config(self, path='./config.json'):
         """
         Load the json configuration 
@@ -84,131 +167,150 @@ class OAHarverster(object):
             os.makedirs(envFilePath)
         self.env_fail = lmdb.open(envFilePath, map_size=map_size)
 
+        envFilePath = os.path.join(self.config["data_path"], 'fail_index')
+        if not os.path.exists(envFilePath):
+            os.makedirs(envFilePath)
+        self.env_fail_index = lmdb.open(envFilePath, map_size=map_size)
+
+        envFilePath = os.path.join(self.config["data_path"], 'hash')
+        if not os.path.exists(envFilePath):
+            os.makedirs(envFilePath)
+        self.env_hash = lmdb.open(envFilePath, map_size=map_size)
+
+        # the doi mapping indicates that an entry is processed when resuming, so it is committed last 
+        self.lmdb_writer.last_env = self.env_doi
+
     def harvestUnpaywall(self, filepath):   
         """
         Main method, use the Unpaywall dataset for getting pdf url for Open Access resources, 
         download in parallel PDF, generate thumbnails, upload resources on S3 and update
         the json description of the entries
         """
-        batch_size_pdf = self.config['batch_size']
-        # batch size for lmdb commit
-        batch_size_lmdb = 10 
-        n = 0
-        i = 0
-        j = 0
-        urls = []
-        entries = []
-        filenames = []
-        selection = None
+        self._initResume(filepath)
+        try:
+            n = self.processEntries(self._unpaywallEntries(filepath), self._storeResult)
+        finally:
+            self._endResume()
+        print("total entries:", n)
 
+    def _unpaywallEntries(self, filepath):
+        """
+        Reader stage for the Unpaywall dataset: yield the (url, filename, entry) download jobs
+        for the entries not yet processed 
+        """
+        # decompression and parsing of the snapshot by chunks, parsed in parallel in a process pool
+        reader = Reader.UnpaywallReader(filepath, nb_parsers=self.config.get('nb_parsers', default_nb_parsers))
         if self.sample is not None:
-            # check the overall number of entries based on the line number
-            with gzip.open(filepath, 'rb') as gz:  
-                count = 0
-                while 1:
-                    buffer = gz.read(8192*1024)
-                    if not buffer: break
-                    count += buffer.count(b'\n')
-            # random selection corresponding to the requested sample size
-            selection = [randint(0, count-1) for p in range(0, sample)]
-            selection.sort()
-
-        gz = gzip.open(filepath, 'rt')
-        for count, line in enumerate(gz):
-            if selection is not None and not count in selection:
-                continue
-            #if n >= 100:
-            #    break
-            if i == batch_size_pdf:
-                failed = self.processBatch(urls, filenames, entries)#, txn, txn_doi, txn_fail)
-                # reinit
-                i = 0
-                urls = []
-                entries = []
-                filenames = []
-                n += batch_size_pdf
-
-            # one json entry per line
-            entry = json.loads(line)
-            doi = entry['doi']
-
-            # check if the entry has already been processed
-            if self.getUUIDByDoi(doi) is not None:
-                continue
-
-            if 'best_oa_location' in entry:
-                if entry['best_oa_location'] is not None:
-                    if 'url_for_pdf' in entry['best_oa_location']:
-                        pdf_url = entry['best_oa_location']['url_for_pdf']
-                        if pdf_url is not None:    
-                            print(pdf_url)
-                            urls.append(pdf_url)
-
-                            entry['id'] = str(uuid.uuid4())
-                            entries.append(entry)
-                            filenames.append(os.path.join(self.config["data_path"], entry['id']+".pdf"))
-                            i += 1
-            
-        gz.close()
-
-        # we need to process the latest incomplete batch (if not empty)
-        if len(urls) >0:
-            self.processBatch(urls, filenames, entries)#, txn, txn_doi, txn_fail)
-            n += len(urls)
+            # single pass random sampling of the lines of the snapshot
+            chunks = [(reader.sample(self.sample, self.random, parse=False), None, None)]
+        else:
+            offset, count = self._resumePosition(reader)
+            # the lines are parsed here, only for the entries not yet processed
+            chunks = reader.chunks(offset, count, parse=False)
+
+        for records, offset, count in chunks:
+            for line_number, start, doi, pdf_url, line in records:
+                if not Shard.in_shard(doi, self.shard):
+                    continue
 
+                # check if the entry has already been processed
+                if self._isProcessed(doi):
+                    continue
+
+                # the complete json entry is kept in the entries lmdb
+                entry = Reader.json_loads(line)
+                if pdf_url is None:
+                    pdf_url = Reader.pdf_url(entry)
+                    if pdf_url is None:
+                        continue
+                logger.debug(pdf_url)
+                entry['id'] = str(uuid.uuid4())
+                if self.checkpoint is not None:
+                    self.checkpoint.submit(entry['id'], start, line_number)
+                self.doi_index.add(doi)
+                yield pdf_url, self._downloadPath(entry['id'], ".pdf"), entry
+
+            if self.checkpoint is not None:
+                # all the lines of the chunk are handled
+                self.checkpoint.advance(offset, count)
+
+        reader.close()
+
+    def harvestIncrement(self, filepath):
+        """
+        Incremental harvesting with a new release of the Unpaywall dataset: only the new entries having 
+        a PDF url, and the failed entries whose PDF url changed, are harvested
+        """
+        reader = Reader.UnpaywallReader(filepath, nb_parsers=self.config.get('nb_parsers', default_nb_parsers))
+        print("computing the difference with the stored entries...")
+        selection = Increment.diff(self.env, self.records, reader, os.path.join(self.config["data_path"], 'increment'),
+            nb_partitions=self.config.get('increment_partitions', 64), shard=self.shard, env_fail=self.env_fail)
+        reader.close()
+
+        empty_uuid = bytes(16)
+        self.updated_ids = set(str(uuid.UUID(bytes=bytes(identifier))) for identifier in selection['uuid'] 
+            if bytes(identifier) != empty_uuid)
+        print(len(selection) - len(self.updated_ids), "new entries,", len(self.updated_ids), "failed entries with a new PDF url")
+
+        try:
+            n = self.processEntries(self._incrementEntries(filepath, selection), self._storeResult)
+        finally:
+            self.updated_ids = None
         print("total entries:", n)
 
+    def _incrementEntries(self, filepath, selection):
+        """
+        Reader stage of an incremental harvesting: yield the (url, filename, entry) download jobs
+        for the selected lines of the snapshot, accessed in a single pass without parsing the other lines
+        """
+        reader = Reader.UnpaywallReader(filepath)
+        empty_uuid = bytes(16)
+        for line, identifier in zip(reader.lines_at(selection['offset']), selection['uuid']):
+            entry = Reader.json_loads(line)
+            pdf_url = entry['best_oa_location']['url_for_pdf']
+            logger.debug(pdf_url)
+            if bytes(identifier) != empty_uuid:
+                # the stored entry is updated with the new PDF url
+                entry['id'] = str(uuid.UUID(bytes=bytes(identifier)))
+            else:
+                entry['id'] = str(uuid.uuid4())
+            yield pdf_url, self._downloadPath(entry['id'], ".pdf"), entry
+        reader.close()
+
     def harvestPMC(self, filepath):   
         """
         Main method for PMC, use the provided PMC list file for getting pdf url for Open Access resources, 
         or download the list file on NIH server if not provided, download in parallel PDF, generate thumbnails, 
         upload resources on S3 and update the json description of the entries
         """
-        batch_size_pdf = self.config['batch_size']
-        pmc_base = self.config['pmc_base']
-        # batch size for lmdb commit
-        batch_size_lmdb = 10 
-        n = 0
-        i = 0
-        urls = []
-        entries = []
-        filenames = []
+        self._initResume(filepath)
+        try:
+            n = self.processEntries(self._pmcEntries(filepath), self._storeResult)
+        finally:
+            self._endResume()
+        print("total entries:", n)
 
-        selection = None
+    def _pmcEntries(self, filepath):
+        """
+        Reader stage for the PMC file list: yield the (url, filename, entry) download jobs
+        for the entries not yet processed 
+        """
+        pmc_base = self.config['pmc_base']
 
-        if self.sample is not None:
-            # check the overall number of entries based on the line number
-            with open(filepath, 'rb') as fp:  
-                count = 0
-                while 1:
-                    buffer = fp.read(8192*1024)
-                    if not buffer: break
-                    count += buffer.count(b'\n')
-            # random selection corresponding to the requested sample size
-            selection = [randint(0, count-1) for p in range(0, sample)]
-            selection.sort()
-
-        with open(filepath, 'rt') as fp:  
-            for count, line in enumerate(fp):
-                if selection is not None and not count in selection:
-                    continue
+        with open(filepath, 'rb') as fp:  
+            if self.sample is not None:
+                # random sampling of lines, directly accessed with the line offset index of the file
+                lines = Reader.sample_lines(fp, self.sample, self.random, self.config['data_path'])
+            else:
+                lines = self._readLines(fp)
 
+            for line_number, start, line in lines:
                 # skip first line which gives the date when the list has been generated
-                if count == 0:
+                if line_number == 0:
                     continue
-                #if n >= 100:
-                #    break
-                if i == batch_size_pdf:
-                    self.processBatch(urls, filenames, entries)#, txn, txn_doi, txn_fail)
-                    # reinit
-                    i = 0
-                    urls = []
-                    entries = []
-                    filenames = []
-                    n += batch_size_pdf
 
                 # one PMC entry per line
-                tokens = line.split('\t')
+                tokens = line.decode(encoding='UTF-8').split('\t')
                 subpath = tokens[0]
                 pmcid = tokens[2]
                 pmid = tokens[3]
@@ -216,18 +318,17 @@ class OAHarverster(object):
                 if ind != -1:
                     pmid = pmid[ind+1:]
                 
-                if pmcid is None:
+                if pmcid is None or not Shard.in_shard(pmcid, self.shard):
                     continue
 
                 # check if the entry has already been processed
-                if self.getUUIDByDoi(pmcid) is not None:
+                if self._isProcessed(pmcid):
                     continue
 
                 if subpath is not None:
                     entry = {}
                     tar_url = pmc_base + subpath
-                    print(tar_url)
-                    urls.append(tar_url)
+                    logger.debug(tar_url)
 
                     entry['id'] = str(uuid.uuid4())
                     entry['pmcid'] = pmcid
@@ -236,260 +337,758 @@ class OAHarverster(object):
                     entry_url = {}
                     entry_url['url_for_pdf'] = tar_url
                     entry['best_oa_location'] = entry_url
-                    entries.append(entry)
-                    filenames.append(os.path.join(self.config["data_path"], entry['id']+".tar.gz"))
-                    i += 1
-            
-        # we need to process the latest incomplete batch (if not empty)
-        if len(urls) >0:
-            self.processBatch(urls, filenames, entries)#, txn, txn_doi, txn_fail)
-            n += len(urls)
+                    if self.checkpoint is not None:
+                        self.checkpoint.submit(entry['id'], start, line_number)
+                    self.doi_index.add(pmcid)
+                    yield tar_url, self._downloadPath(entry['id'], ".tar.gz"), entry
 
-        print("total entries:", n)
+    def _readLines(self, fp):
+        """
+        Yield the (line number, offset, line) of a binary input file from the checkpoint, if any,
+        and keep the checkpoint position updated
+        """
+        offset, count = self._resumePosition(fp)
+        for line in fp:
+            if self.checkpoint is not None:
+                # the previous line is handled
+                self.checkpoint.advance(offset, count)
+            yield count, offset, line
+            offset += len(line)
+            count += 1
+        if self.checkpoint is not None:
+            self.checkpoint.advance(offset, count)
+
+    def _initResume(self, filepath):
+        """
+        Prepare the resume accelerators: the membership index of the already processed entries and, 
+        except when sampling, the checkpoint of the input position before which everything is committed
+        """
+        with self.env_doi.begin() as txn:
+            nb_processed = txn.stat()['entries']
+        if nb_processed > 0:
+            print("building index of processed entries...")
+        self.doi_index = Resume.DoiIndex(self.env_doi)
+        if nb_processed > 0:
+            print(len(self.doi_index), "processed entries")
+
+        self.checkpoint = None
+        if self.sample is None:
+            self.checkpoint = Resume.Checkpoint(self.config['data_path'], filepath)
+            self.lmdb_writer.on_flush = self.checkpoint.commit
+
+    def _endResume(self):
+        self.lmdb_writer.on_flush = None
+        self.checkpoint = None
+        self.doi_index = None
+
+    def _resumePosition(self, fp):
+        """
+        Move the binary input file to the checkpoint if any, return the (offset, line number) 
+        of the reading start
+        """
+        if self.checkpoint is None:
+            return 0, 0
+        offset, count = self.checkpoint.start()
+        if offset > 0:
+            print("resuming from line", count)
+            # for a gzipped input, seeking still decompresses, but nothing is parsed
+            fp.seek(offset)
+        return offset, count
+
+    def _isProcessed(self, doi):
+        # during a harvesting, the index has the entries committed before the run and the entries
+        # submitted during the run, so no LMDB transaction is needed per line
+        if self.doi_index is not None:
+            return doi in self.doi_index
+        return self.getUUIDByDoi(doi) is not None
+
+    def processEntries(self, jobs, store_result):
+        """
+        Streaming pipeline replacing the former batch processing: the reader stage (the jobs iterator, 
+        consumed in the calling thread) feeds a bounded per-host scheduler, download workers pull the jobs
+        eligible for download from this scheduler and a single writer thread passes the results to 
+        store_result as they complete, so that all the LMDB write transactions are performed in the same 
+        thread. 
+
+        Contrary to ThreadPoolExecutor.map on a batch, a slow download never blocks the other workers 
+        and memory usage is bounded by the queue sizes. The scheduler enforces the concurrency and request 
+        rate per host, so a slow or throttling host does not hold back the whole run. The jobs failing with 
+        a transient error are put back in the scheduler to be retried after a delay, within the limits of 
+        the retry policy, before their result is stored. Return the number of submitted jobs.
+        """
+        self._postProcessLeftovers()
+
+        if self.async_mode:
+            n = asyncio.run(self._processEntriesAsync(jobs, store_result))
+            self._waitPostProcessing()
+            return n
+
+        queue_size = self.config['batch_size']
+        nb_workers = self.config.get('nb_workers', default_nb_workers)
+
+        scheduler = HostScheduler.HostScheduler(self._schedulerConfig())
+        result_queue = queue.Queue(maxsize=queue_size)
+        retries = RetryPolicy.InRunRetries(self.retry_policy)
+
+        def download_worker():
+            while True:
+                job = scheduler.get()
+                if job is None:
+                    break
+                start = time.monotonic()
+                try:
+                    result = self.downloader.download(*job)
+                except Exception as e:
+                    # the job must always produce a result, otherwise the entry would be lost 
+                    result = str(e), job[2], None
+                metrics.download(job[0], result[0], time.monotonic() - start)
+                retried = self._retryInRun(scheduler, retries, job, result[0])
+                scheduler.done(job, result[0])
+                if not retried:
+                    result_queue.put(result)
+
+        def writer():
+            while True:
+                try:
+                    result = result_queue.get(timeout=self.lmdb_writer.interval)
+                except queue.Empty:
+                    # no new result, but the pending writes might have to be committed
+                    self.lmdb_writer.flush_if_due()
+                    continue
+                if result is None:
+                    break
+                try:
+                    store_result(result)
+                    self.lmdb_writer.result_stored()
+                except Exception as e:
+                    # keep draining the result queue, otherwise the download workers would block
+                    print("error when storing result for entry", result[1]['id'], ":", str(e))
+            self.lmdb_writer.flush()
+
+        workers = [threading.Thread(target=download_worker, daemon=True) for _ in range(nb_workers)]
+        for worker in workers:
+            worker.start()
+        writer_thread = threading.Thread(target=writer)
+        writer_thread.start()
 
-    def processBatch(self, urls, filenames, entries):#, txn, txn_doi, txn_fail):
-        with ThreadPoolExecutor(max_workers=12) as executor:
-            results = executor.map(download, urls, filenames, entries)
-
-        # LMDB write transaction must be performed in the thread that created the transaction, so
-        # we need to have the following lmdb updates out of the paralell process
-        entries = []
-        i = 0
-        for result in results:
-            local_entry = result[1]
-            # conservative check if the downloaded file is of size 0 with a status code sucessful (code: 0),
-            # it should not happen *in theory*
-            empty_file = False
-            local_filename = os.path.join(self.config["data_path"], local_entry['id']+".pdf")
-            if os.path.isfile(local_filename): 
-                if os.path.getsize(local_filename) == 0:
-                    empty_file = True
-            
-            local_filename = os.path.join(self.config["data_path"], local_entry['id']+".tar.gz")
-            if os.path.isfile(local_filename): 
-                if os.path.getsize(local_filename) == 0:
-                    empty_file = True
-
-            if result[0] is None or result[0] == "0" and not empty_file:
-                #update DB
-                with self.env.begin(write=True) as txn:
-                    txn.put(local_entry['id'].encode(encoding='UTF-8'), _serialize_pickle(local_entry)) 
-
-                #print(" update txn_doi")
-                with self.env_doi.begin(write=True) as txn_doi:
-                    txn_doi.put(local_entry['doi'].encode(encoding='UTF-8'), local_entry['id'].encode(encoding='UTF-8'))
-
-                entries.append(local_entry)
-            else:
-                print(" error: " + result[0])
-                
-                #update DB
-                with self.env.begin(write=True) as txn:
-                    txn.put(local_entry['id'].encode(encoding='UTF-8'), _serialize_pickle(local_entry))  
-
-                with self.env_doi.begin(write=True) as txn_doi:
-                    txn_doi.put(local_entry['doi'].encode(encoding='UTF-8'), local_entry['id'].encode(encoding='UTF-8'))
-
-                with self.env_fail.begin(write=True) as txn_fail:
-                    txn_fail.put(local_entry['id'].encode(encoding='UTF-8'), result[0].encode(encoding='UTF-8'))
-
-                # if an empty pdf or tar file is present, we clean it
-                local_filename = os.path.join(self.config["data_path"], local_entry['id']+".pdf")
-                if os.path.isfile(local_filename): 
-                    os.remove(local_filename)
-                local_filename = os.path.join(self.config["data_path"], local_entry['id']+".tar.gz")
-                if os.path.isfile(local_filename): 
-                    os.remove(local_filename)
-                local_filename = os.path.join(self.config["data_path"], local_entry['id']+".nxml")
-                if os.path.isfile(local_filename): 
-                    os.remove(local_filename)
-
-        print("failed documents :", i)
-        # finally we can parallelize the thumbnail/upload/file cleaning steps for this batch
-        # with ThreadPoolExecutor(max_workers=12) as executor:
-        #     results = executor.map(self.manageFiles, entries)
-
-        return i
-
-
-    def processBatchReprocess(self, urls, filenames, entries):#, txn, txn_doi, txn_fail):
-        with ThreadPoolExecutor(max_workers=12) as executor:
-            results = executor.map(download, urls, filenames, entries)
-        
-        # LMDB write transactions in the thread that created the transaction
-        entries = []
-        for result in results: 
-            local_entry = result[1]
-            if result[0] is None or result[0] == "0":
-                entries.append(local_entry)
-                # remove the entry in fail, as it is now sucessful
-                with self.env_fail.begin(write=True) as txn_fail2:
-                    txn_fail2.delete(local_entry['id'].encode(encoding='UTF-8'))
-            else:
-                # still an error
-                # if an empty pdf file is present, we clean it
-                local_filename = os.path.join(self.config["data_path"], local_entry['id']+".pdf")
-                if os.path.isfile(local_filename): 
-                    os.remove(local_filename)
-                local_filename = os.path.join(self.config["data_path"], local_entry['id']+".tar.gz")
-                if os.path.isfile(local_filename): 
-                    os.remove(local_filename)
-                local_filename = os.path.join(self.config["data_path"], local_entry['id']+".nxml")
-                if os.path.isfile(local_filename): 
-                    os.remove(local_filename)
-
-        print("manage files")
-        # finally we can parallelize the thumbnail/upload/file cleaning steps for this batch
-        with ThreadPoolExecutor(max_workers=12) as executor:
-            results = executor.map(self.manageFiles, entries)
+        n = 0
+        try:
+            for job in jobs:
+                scheduler.put(job)
+                n += 1
+        finally:
+            # the workers stop after having consumed all the remaining jobs
+            scheduler.close()
+            for worker in workers:
+                worker.join()
+            result_queue.put(None)
+            writer_thread.join()
+
+        self._waitPostProcessing()
+        return n
+
+    def _schedulerConfig(self):
+        """
+        Config of the download scheduler. All the PMC archives come from the single PMC server, which 
+        by default may use all the download workers without request rate limit and with short 
+        throttling backoffs, instead of the limits of an ordinary host, unless set in host_overrides.
+        """
+        pmc_host = urlparse(self.config.get('pmc_base', '')).hostname
+        if pmc_host is None:
+            return self.config
+        nb_workers = self.config.get('nb_workers', default_nb_workers)
+        overrides = dict(self.config.get('host_overrides', {}))
+        pmc_parameters = { 'host_initial_concurrency': nb_workers, 'host_max_concurrency': nb_workers, 
+            'host_rate': 0, 'host_backoff': 0.5, 'host_backoff_max': 30 }
+        pmc_parameters.update(overrides.get(pmc_host, {}))
+        overrides[pmc_host] = pmc_parameters
+        config = dict(self.config)
+        config['host_overrides'] = overrides
+        return config
+
+    def _retryInRun(self, scheduler, retries, job, result):
+        """
+        Put back a failed job in the scheduler if it is to be retried within the run, return True in 
+        this case. Called before reporting the result of the job to the scheduler.
+        """
+        delay = retries.delay(job, result)
+        if delay is None:
+            return False
+        metrics.inc("retries", category=RetryPolicy.category(result))
+        logger.debug(" retry in " + str(round(delay, 1)) + "s after error: " + result)
+        scheduler.put_later(job, delay)
+        return True
+
+    def _waitPostProcessing(self):
+        # the files of the last stored entries are still being post-processed
+        self.post_processing.wait()
+        if self.storage is not None:
+            self.storage.flush()
+
+    async def _processEntriesAsync(self, jobs, store_result):
+        """
+        Asynchronous version of the streaming pipeline: the reader stage runs in its own thread and 
+        feeds the bounded per-host scheduler, a dispatcher starts a download coroutine for each eligible 
+        job within the limit of async_concurrency in-flight downloads (e.g. 500-2000), and a single writer 
+        task passes the results to store_result in a dedicated thread, so that the LMDB write transactions 
+        remain serialized and never block the event loop. 
+        """
+        loop = asyncio.get_running_loop()
+        downloader = Downloader.AsyncDownloader(self.config, self.url_cache, self._hasContent)
+        await downloader.open()
+
+        queue_size = self.config['batch_size']
+        scheduler = HostScheduler.HostScheduler(self._schedulerConfig())
+        # the reader thread and the completed downloads wake up the dispatcher
+        wake_up = asyncio.Event()
+        scheduler.on_change = lambda: loop.call_soon_threadsafe(wake_up.set)
+        result_queue = asyncio.Queue(maxsize=queue_size)
+        retries = RetryPolicy.InRunRetries(self.retry_policy)
+        writer_executor = ThreadPoolExecutor(max_workers=1)
+
+        def reader():
+            # blocking reading of the input, the scheduler applies the backpressure
+            n = 0
+            try:
+                for job in jobs:
+                    scheduler.put(job)
+                    n += 1
+            finally:
+                scheduler.close()
+            return n
+
+        async def download(job, slots):
+            start = time.monotonic()
+            try:
+                result = await downloader.download(*job)
+            except Exception as e:
+                result = str(e), job[2], None
+            finally:
+                slots.release()
+            metrics.download(job[0], result[0], time.monotonic() - start)
+            retried = self._retryInRun(scheduler, retries, job, result[0])
+            scheduler.done(job, result[0])
+            if not retried:
+                await result_queue.put(result)
+
+        async def dispatcher():
+            slots = asyncio.Semaphore(downloader.concurrency)
+            tasks = set()
+            while True:
+                await slots.acquire()
+                wake_up.clear()
+                job, timeout, finished = scheduler.poll()
+                if job is None:
+                    slots.release()
+                    if finished:
+                        break
+                    try:
+                        await asyncio.wait_for(wake_up.wait(), timeout)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                task = asyncio.create_task(download(job, slots))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            await asyncio.gather(*tasks)
+
+        def store(result):
+            store_result(result)
+            self.lmdb_writer.result_stored()
+
+        async def writer():
+            while True:
+                try:
+                    result = await asyncio.wait_for(result_queue.get(), self.lmdb_writer.interval)
+                except asyncio.TimeoutError:
+                    await loop.run_in_executor(writer_executor, self.lmdb_writer.flush_if_due)
+                    continue
+                if result is None:
+                    break
+                try:
+                    await loop.run_in_executor(writer_executor, store, result)
+                except Exception as e:
+                    print("error when storing result for entry", result[1]['id'], ":", str(e))
+            await loop.run_in_executor(writer_executor, self.lmdb_writer.flush)
 
+        dispatcher_task = asyncio.create_task(dispatcher())
+        writer_task = asyncio.create_task(writer())
 
-    def getUUIDByDoi(self, doi):
-        txn = self.env_doi.begin()
-        return txn.get(doi.encode(encoding='UTF-8'))
+        try:
+            n = await loop.run_in_executor(None, reader)
+        finally:
+            await dispatcher_task
+            await result_queue.put(None)
+            await writer_task
+            writer_executor.shutdown()
+            await downloader.close()
 
-    def manageFiles(self, local_entry):
-        local_filename = os.path.join(self.config["data_path"], local_entry['id']+".pdf")
-        local_filename_nxml = os.path.join(self.config["data_path"], local_entry['id']+".nxml")
+        return n
 
-        # generate thumbnails
-        if self.thumbnail:
-            generate_thumbnail(local_filename)
+    def _storeResult(self, result):
+        """
+        Writer stage of a harvesting: store the entry and the doi mapping in LMDB, and keep track 
+        of the failure if the download was not successful
+        """
+        local_entry = result[1]
+        if self.checkpoint is not None:
+            self.checkpoint.stored(local_entry['id'])
+
+        # conservative check if the downloaded file is of size 0 with a status code sucessful (code: 0),
+        # it should not happen *in theory*
+        empty_file = False
+        local_filename = self._downloadPath(local_entry['id'], ".pdf")
+        if os.path.isfile(local_filename): 
+            if os.path.getsize(local_filename) == 0:
+                empty_file = True
         
-        dest_path = generateS3Path(local_entry['id'])
-        thumb_file_small = local_filename.replace('.pdf', '-thumb-small.png')
-        thumb_file_medium = local_filename.replace('.pdf', '-thumb-medium.png')
-        thumb_file_large = local_filename.replace('.pdf', '-thumb-large.png')
-
-        if self.s3 is not None:
-            # upload to S3 
-            # upload is already in parallel for individual file (with parts)
-            # so we don't further upload in parallel at the level of the files
-            if os.path.isfile(local_filename):
-                self.s3.upload_file_to_s3(local_filename, dest_path, storage_class='ONEZONE_IA')
-            if os.path.isfile(local_filename_nxml):
-                self.s3.upload_file_to_s3(local_filename_nxml, dest_path, storage_class='ONEZONE_IA')
-
-            if (self.thumbnail):
-                if os.path.isfile(thumb_file_small):
-                    self.s3.upload_file_to_s3(thumb_file_small, dest_path, storage_class='ONEZONE_IA')
-
-                if os.path.isfile(thumb_file_medium): 
-                    self.s3.upload_file_to_s3(thumb_file_medium, dest_path, storage_class='ONEZONE_IA')
-                
-                if os.path.isfile(thumb_file_large): 
-                    self.s3.upload_file_to_s3(thumb_file_large, dest_path, storage_class='ONEZONE_IA')
+        local_filename = self._downloadPath(local_entry['id'], ".tar.gz")
+        if os.path.isfile(local_filename): 
+            if os.path.getsize(local_filename) == 0:
+                empty_file = True
+
+        success = (result[0] is None or result[0] == "0") and not empty_file
+        status = Records.STATUS_SUCCESS if success else Records.STATUS_FAILED
+        metrics.inc("stored_entries", status="success" if success else "failed")
+
+        canonical = None
+        if success:
+            canonical = self._canonicalId(local_entry, result[2])
+
+        #update DB, the write operations are committed by groups by the batch writer
+        self.lmdb_writer.put(self.env, local_entry['id'].encode(encoding='UTF-8'), self.records.encode(local_entry, status, canonical=canonical)) 
+        self.lmdb_writer.put(self.env_doi, local_entry['doi'].encode(encoding='UTF-8'), local_entry['id'].encode(encoding='UTF-8'))
+
+        previous = None
+        if self.updated_ids is not None and local_entry['id'] in self.updated_ids:
+            # entry harvested again by an incremental harvesting, replacing its previous failure
+            key = local_entry['id'].encode(encoding='UTF-8')
+            with self.env_fail.begin() as txn_fail:
+                value = txn_fail.get(key)
+            if value is not None:
+                previous = Records.decode_failure(value)
+                if success:
+                    self.lmdb_writer.delete(self.env_fail, key)
+                    self._deleteFailureIndex(key, previous)
+
+        if canonical is not None:
+            # identical to an already harvested PDF, the files of this entry are not kept
+            metrics.inc("duplicates")
+            self._cleanLocalFiles(local_entry)
+        elif success:
+            self.post_processing.submit(local_entry, self._localFiles(local_entry))
+
+        if success:
+            return
+
+        error = result[0] if result[0] is not None and result[0] != "0" else "empty file"
+        logger.debug(" error: " + error)
+
+        self._storeFailure(local_entry, error, previous)
+
+        # if an empty pdf or tar file is present, we clean it
+        self._cleanLocalFiles(local_entry)
+
+    def _canonicalId(self, local_entry, content_hash):
+        """
+        Return the uuid of the canonical entry having the same PDF content, or None if this PDF is
+        new, in which case the entry becomes the canonical entry of this content
+        """
+        if content_hash is None or not self.config.get('deduplication', True):
+            return None
+        value = self.lmdb_writer.get(self.env_hash, content_hash)
+        if value is not None:
+            canonical = value.decode(encoding='UTF-8')
+            if canonical != local_entry['id']:
+                return canonical
+            return None
+        self.lmdb_writer.put(self.env_hash, content_hash, local_entry['id'].encode(encoding='UTF-8'))
+        return None
+
+    def _hasContent(self, content_hash):
+        """
+        Indicate if a PDF content is already harvested, called by the download workers
+        """
+        if not self.config.get('deduplication', True):
+            return False
+        with self.env_hash.begin() as txn:
+            return txn.get(content_hash) is not None
+
+    def _storeFailure(self, local_entry, error, previous=None):
+        """
+        Store the failure record of an entry with the url and file name needed for reprocessing it
+        and the schedule of its next retry, and index it by error class and host. previous is the 
+        failure record being replaced, if any.
+        """
+        key = local_entry['id'].encode(encoding='UTF-8')
+        url = Records.url_of(local_entry)
+        if url is not None and url.endswith(".tar.gz"):
+            filename = local_entry['id']+".tar.gz"
         else:
-            # save under local storate indicated by data_path in the config json
-            try:
-                local_dest_path = os.path.join(self.config["data_path"], dest_path)
-                os.makedirs(os.path.dirname(local_dest_path), exist_ok=True)
-                if os.path.isfile(local_filename):
-                    shutil.copyfile(local_filename, os.path.join(local_dest_path, local_entry['id']+".pdf"))
-                if os.path.isfile(local_filename_nxml):
-                    shutil.copyfile(local_filename_nxml, os.path.join(local_dest_path, local_entry['id']+".nxml"))
+            filename = local_entry['id']+".pdf"
+        category, retries, next_retry = self.retry_policy.schedule(error, previous, url)
+        value = Records.encode_failure(error, url, filename, local_entry.get('doi'), category, retries, next_retry)
+        if previous is not None:
+            self._deleteFailureIndex(key, previous)
+        self.lmdb_writer.put(self.env_fail, key, value)
+        for index_key in Records.failure_index_keys(key, Records.decode_failure(value)):
+            self.lmdb_writer.put(self.env_fail_index, index_key, b'')
+
+    def _deleteFailureIndex(self, key, failure):
+        for index_key in Records.failure_index_keys(key, failure):
+            self.lmdb_writer.delete(self.env_fail_index, index_key)
+
+    def _storeReprocessResult(self, result):
+        """
+        Writer stage of a reprocessing: remove the successful entries from the fail lmdb and submit 
+        them to the thumbnail/upload/file cleaning steps
+        """
+        local_entry = result[1]
+        key = local_entry['id'].encode(encoding='UTF-8')
+        with self.env_fail.begin() as txn_fail:
+            value = txn_fail.get(key)
+        previous = Records.decode_failure(value) if value is not None else None
+        if result[0] is None or result[0] == "0":
+            # remove the entry in fail and in the fail index, as it is now sucessful
+            self.lmdb_writer.delete(self.env_fail, key)
+            if previous is not None:
+                self._deleteFailureIndex(key, previous)
+            with self.env.begin() as txn:
+                value = txn.get(key)
+            canonical = self._canonicalId(local_entry, result[2])
+            if canonical is not None and value is not None:
+                # identical to an already harvested PDF, stored as a pointer to the canonical entry
+                record = self.records.decode(value)
+                self.lmdb_writer.put(self.env, key, self.records.encode(record.entry(), Records.STATUS_SUCCESS, 
+                    created=record.created, canonical=canonical))
+                self._cleanLocalFiles(local_entry)
+                return
+            if value is not None and Records.is_compact(value):
+                self.lmdb_writer.put(self.env, key, Records.with_status(value, Records.STATUS_SUCCESS))
+            self.post_processing.submit(local_entry, self._localFiles(local_entry))
+        else:
+            # still an error, possibly of another class
+            self._storeFailure(local_entry, result[0] or "empty file", previous)
+            # if an empty pdf file is present, we clean it
+            self._cleanLocalFiles(local_entry)
+
+    def _cleanLocalFiles(self, local_entry):
+        local_filename = self._downloadPath(local_entry['id'], ".pdf")
+        if os.path.isfile(local_filename): 
+            os.remove(local_filename)
+        local_filename = self._downloadPath(local_entry['id'], ".tar.gz")
+        if os.path.isfile(local_filename): 
+            os.remove(local_filename)
+        local_filename = self._downloadPath(local_entry['id'], ".nxml")
+        if os.path.isfile(local_filename): 
+            os.remove(local_filename)
+        if isinstance(self.storage, Storage.LocalStorage) and self.storage.direct:
+            # the final directory was created for the download
+            self.storage.remove_directory(local_entry['id'])
+
+    def _localFiles(self, local_entry):
+        """
+        Downloaded files of an entry waiting for the post-download stage
+        """
+        local_files = [self._downloadPath(local_entry['id'], ".pdf"), self._downloadPath(local_entry['id'], ".nxml")]
+        return [local_file for local_file in local_files if os.path.isfile(local_file)]
 
-                if (self.thumbnail):
-                    if os.path.isfile(thumb_file_small):
-                        shutil.copyfile(thumb_file_small, os.path.join(local_dest_path, local_entry['id']+"-thumb-small.png"))
+    def _downloadPath(self, identifier, extension):
+        """
+        Path of a downloaded file of an entry: directly its final location for the local storage, 
+        if configured, otherwise a temporary file in data_path 
+        """
+        if self.storage is not None:
+            return self.storage.download_path(identifier, extension)
+        return os.path.join(self.config["data_path"], identifier+extension)
 
-                    if os.path.isfile(thumb_file_medium):
-                        shutil.copyfile(thumb_file_medium, os.path.join(local_dest_path, local_entry['id']+"-thumb-medium.png"))
+    def _postProcessLeftovers(self):
+        """
+        Submit to the post-download stage the downloaded files of the entries committed as successful 
+        by a previous run which was interrupted before storing them, or whose upload failed
+        """
+        identifiers = set()
+        for f in os.listdir(self.config["data_path"]):
+            if (f.endswith(".pdf") or f.endswith(".nxml")) and "-thumb-" not in f:
+                identifiers.add(f.rsplit('.', 1)[0])
+        if not identifiers:
+            return
+        n = 0
+        with self.env.begin() as txn:
+            for identifier in sorted(identifiers):
+                value = txn.get(identifier.encode(encoding='UTF-8'))
+                if value is None or not Records.is_compact(value):
+                    continue
+                record = self.records.decode(value)
+                if record.status != Records.STATUS_SUCCESS or record.canonical is not None:
+                    continue
+                local_entry = { 'id': identifier }
+                self.post_processing.submit(local_entry, self._localFiles(local_entry))
+                n += 1
+        if n > 0:
+            print(n, "stored entries with downloaded files not yet stored, submitted to post-processing")
 
-                    if os.path.isfile(thumb_file_large):
-                        shutil.copyfile(thumb_file_large, os.path.join(local_dest_path, local_entry['id']+"-thumb-larger.png"))
+    def getUUIDByDoi(self, doi):
+        with self.env_doi.begin() as txn:
+            return txn.get(doi.encode(encoding='UTF-8'))
 
-            except IOError as e:
-                print("invalid path", str(e))       
+    def manageFiles(self, local_entry):
+        """
+        Post-download stage of an entry: generate the thumbnails, then upload the files to S3 or store
+        them with the local or pack storage. Return the futures of the S3 uploads, after which the local 
+        files are removed.
+        """
+        local_filename = self._downloadPath(local_entry['id'], ".pdf")
+        if not os.path.isfile(local_filename):
+            # left at the root of data_path by a previous run with another download location
+            local_filename = os.path.join(self.config["data_path"], local_entry['id']+".pdf")
+        local_filename_nxml = local_filename.replace('.pdf', '.nxml')
 
-        # clean pdf and thumbnail files
-        try:
-            if os.path.isfile(local_filename):
-                os.remove(local_filename)
-            if os.path.isfile(local_filename_nxml):
-                os.remove(local_filename_nxml)
-            if (self.thumbnail):
-                if os.path.isfile(thumb_file_small): 
-                    os.remove(thumb_file_small)
-                if os.path.isfile(thumb_file_medium): 
-                    os.remove(thumb_file_medium)
-                if os.path.isfile(thumb_file_large): 
-                    os.remove(thumb_file_large)
-        except IOError as e:
-            print("temporary file cleaning failed:", str(e))       
-
-
-    def reprocessFailed(self):
-        """
-        Retry to access OA resources stored in the fail lmdb
-        """
-        batch_size_pdf = self.config['batch_size']
-        # batch size for lmdb commit
-        batch_size_lmdb = 100 
-        n = 0
-        i = 0
-        urls = []
-        entries = []
-        filenames = []
-        
-        with self.env.begin(write=True) as txn:
+        # generate thumbnails
+        if self.thumbnail:
+            # rendering is CPU bound, it runs in the bounded pool of renderers and not in the I/O worker 
+            self.thumbnail_executor.submit(generate_thumbnail, local_filename, 
+                self.config.get('thumbnail_density', 100), self.config.get('thumbnail_timeout', 60)).result()
+
+        local_files = [local_filename, local_filename_nxml]
+        if (self.thumbnail):
+            local_files += [local_filename.replace('.pdf', '-thumb-small.png'), 
+                            local_filename.replace('.pdf', '-thumb-medium.png'), 
+                            local_filename.replace('.pdf', '-thumb-large.png')]
+
+        if self.storage is not None:
+            # save under local storage indicated by data_path in the config json: the files are moved 
+            # (if not already downloaded at their final location) or appended to a pack
+            try:
+                for local_file in local_files:
+                    if os.path.isfile(local_file):
+                        self.storage.store(local_file, local_entry['id'])
+            except OSError as e:
+                print("invalid path", str(e))
+            return []
+
+        # upload to S3 
+        # the uploads are queued and realized concurrently by the upload workers of the S3 module, 
+        # across the files of the entry and across entries, the local files being removed once uploaded
+        dest_path = generateS3Path(local_entry['id'])
+        uploads = []
+        for upload_file in local_files:
+            if os.path.isfile(upload_file):
+                uploads.append(self.s3.submit_upload(upload_file, dest_path, storage_class='ONEZONE_IA', 
+                    callback=_clean_uploaded_file))
+        return uploads
+
+    def reprocessFailed(self, classes=None, hosts=None, retry_all=False):
+        """
+        Retry to access OA resources stored in the fail lmdb, optionally only the failures of the
+        given error classes (e.g. timeout, http:503, or http for all the http errors) and/or hosts.
+        Only the recoverable failures whose next retry time is reached are retried, unless retry_all 
+        is set.
+        """
+        with self.env.begin() as txn:
             nb_total = txn.stat()['entries']
 
-        with self.env_fail.begin(write=True) as txn_fail:
+        with self.env_fail.begin() as txn_fail:
             nb_fails = txn_fail.stat()['entries']
         
         print("number of failed entries with OA link:", nb_fails, "out of", nb_total, "entries")
 
-        # iterate over the fail lmdb
-        with self.env.begin(write=True) as txn:
-            cursor = txn.cursor()
-            for key, value in cursor:
-                if i == batch_size_pdf:
-                    self.processBatchReprocess(urls, filenames, entries)#, txn, txn_doi, txn_fail)
-                    # reinit
-                    i = 0
-                    urls = []
-                    entries = []
-                    filenames = []
-                    n += batch_size_pdf
-
-                with self.env_fail.begin() as txn_f:
-                    value_error = txn_f.get(key)
-                    if value_error is None:
-                       continue
-
-                local_entry = _deserialize_pickle(value)
-                pdf_url = local_entry['best_oa_location']['url_for_pdf']  
-                print(pdf_url)
-                urls.append(pdf_url)
-                entries.append(local_entry)
-                if pdf_url.endswith(".tar.gz"):
-                    filenames.append(os.path.join(self.config["data_path"], local_entry['id']+".tar.gz"))
-                else:  
-                    filenames.append(os.path.join(self.config["data_path"], local_entry['id']+".pdf"))
-                i += 1
-
-        # we need to process the latest incomplete batch (if not empty)
-        if len(urls)>0:
-            self.processBatchReprocess(urls, filenames, entries)#, txn, txn_doi, txn_fail)
-
-    def dump(self, dump_file):
-        # init lmdb transactions
-        txn = self.env.begin(write=True)
-        
-        nb_total = txn.stat()['entries']
+        skipped = {}
+        n = self.processEntries(self._failedEntries(classes, hosts, retry_all, skipped), self._storeReprocessResult)
+        print("reprocessed entries:", n)
+        for category in sorted(skipped):
+            print("    not retried,", category, ":", skipped[category])
+
+    def _failedEntries(self, classes=None, hosts=None, retry_all=False, skipped=None):
+        """
+        Reader stage of a reprocessing: yield the (url, filename, entry) download jobs for the 
+        entries stored in the fail lmdb, which is iterated directly (or through the fail index 
+        when selecting error classes or hosts), so that the cost does not depend on the number 
+        of successful entries. Unless retry_all, the failures not eligible for a retry are counted 
+        by category in skipped.
+        """
+        now = time.time()
+        with self.env_fail.begin() as txn_fail:
+            if classes or hosts:
+                failures = self._selectedFailures(txn_fail, classes, hosts)
+            else:
+                failures = txn_fail.cursor()
+            for key, value in failures:
+                failure = Records.decode_failure(value)
+                if not retry_all and not self.retry_policy.is_eligible(failure, now):
+                    if skipped is not None:
+                        category = self.retry_policy.status(failure, now)
+                        skipped[category] = skipped.get(category, 0) + 1
+                    continue
+                if failure['url'] is None or failure['doi'] is None:
+                    # failure stored by a previous version, the url and the doi are in the entry record
+                    with self.env.begin() as txn:
+                        value = txn.get(key)
+                    if value is None:
+                        continue
+                    record = self.records.decode(value)
+                    if failure['doi'] is None:
+                        failure['doi'] = record.doi
+                if failure['url'] is None:
+                    failure['url'] = record.url
+                    if failure['url'] is None:
+                        continue
+                    if failure['url'].endswith(".tar.gz"):
+                        failure['filename'] = key.decode(encoding='UTF-8')+".tar.gz"
+                    else:
+                        failure['filename'] = key.decode(encoding='UTF-8')+".pdf"
+
+                pdf_url = failure['url']
+                local_entry = { 'id': key.decode(encoding='UTF-8'), 'doi': failure['doi'], 'best_oa_location': { 'url_for_pdf': pdf_url } }
+                logger.debug(pdf_url)
+                extension = ".tar.gz" if failure['filename'].endswith(".tar.gz") else ".pdf"
+                yield pdf_url, self._downloadPath(local_entry['id'], extension), local_entry
+
+    def _selectedFailures(self, txn_fail, classes, hosts):
+        """
+        Yield the (key, value) of the fail lmdb for the failures of the given error classes and/or hosts,
+        using the fail index. A class without status code also selects the classes with status code
+        (http selects http:404, http:503, etc.). A failure selected by several overlapping classes or 
+        hosts is yielded once.
+        """
+        yielded = set()
+        if classes:
+            kind, names = Records.INDEX_CLASS, classes
+        else:
+            kind, names = Records.INDEX_HOST, hosts
+        with self.env_fail_index.begin() as txn_index:
+            for name in names:
+                cursor = txn_index.cursor()
+                prefix = kind + name.encode(encoding='UTF-8')
+                if not cursor.set_range(prefix):
+                    continue
+                for index_key in cursor.iternext(values=False):
+                    if not index_key.startswith(prefix):
+                        break
+                    indexed_name, _, key = index_key[len(kind):].partition(b'\x00')
+                    if kind == Records.INDEX_CLASS and indexed_name != name.encode(encoding='UTF-8') \
+                        and not indexed_name.startswith(name.encode(encoding='UTF-8') + b':'):
+                        continue
+                    if kind == Records.INDEX_HOST and indexed_name != name.encode(encoding='UTF-8'):
+                        continue
+                    value = txn_fail.get(key)
+                    if value is None:
+                        continue
+                    if classes and hosts and Records.failure_host(Records.decode_failure(value)) not in hosts:
+                        continue
+                    if key in yielded:
+                        continue
+                    yielded.add(key)
+                    yield key, value
+
+    def dump(self, dump_file, shards=False, mapping=False):
+        """
+        Write all the entries in JSONL, in parallel by key ranges, compressed if dump_file ends with
+        .gz or .zst. With shards, one file is written per key range instead of a single file. With 
+        mapping, only the identifiers (DOI or pmcid and UUID) are written.
+        """
+        with self.env.begin() as txn:
+            nb_total = txn.stat()['entries']
         print("number of entries with OA link:", nb_total)
 
-        with open(dump_file,'w') as file_out:
-            # iterate over the fail lmdb
-            cursor = txn.cursor()
-            for key, value in cursor:
-                if txn.get(key) is None:
+        Dump.dump(self.config, dump_file, shards=shards, mapping=mapping)
+
+    def mergeShards(self, paths=None):
+        """
+        Merge the harvesting state and the files of shard directories (by default all the shard 
+        directories under data_path) into data_path
+        """
+        if not paths:
+            paths = Shard.shard_paths(self.config["data_path"])
+        if not paths:
+            print("no shard directory to merge in", self.config["data_path"])
+            return
+        envs = { 'entries': self.env, 'doi': self.env_doi, 'fail': self.env_fail, 
+            'fail_index': self.env_fail_index, 'hash': self.env_hash }
+        packs = self.storage if isinstance(self.storage, Pack.PackStorage) else None
+        n = Shard.merge(self.config, envs, paths, packs=packs)
+        print("merged entries:", n)
+
+    def compactPacks(self):
+        """
+        Reclaim the space of the packs occupied by resources stored several times or no longer used
+        """
+        if not isinstance(self.storage, Pack.PackStorage):
+            print("compaction only applies to the pack storage (\"storage\": \"pack\" in the config file)")
+            return
+        n = self.storage.compact(self.env, self.records, ratio=self.config.get('pack_compact_ratio', 0.5))
+        print("compacted packs:", n)
+
+    def migrate(self, batch_size=10000):
+        """
+        Convert the pickled records of the entries lmdb into the compact record format. If zstd 
+        compression is configured with a dictionary not yet available, the dictionary is first 
+        trained on a sample of the entries.
+        """
+        if self.records.compression == 'zstd' and self.records.dictionary_path is not None and self.records.dictionary is None:
+            with self.env.begin() as txn:
+                sample = []
+                for key, value in txn.cursor():
+                    sample.append(self.records.decode(value).entry())
+                    if len(sample) == batch_size:
+                        break
+            if len(sample) > 0:
+                print("training zstd dictionary on", len(sample), "entries")
+                self.records.train_dictionary(sample)
+
+        nb_migrated = 0
+        batch = []
+        with self.env.begin() as txn, self.env_fail.begin() as txn_fail:
+            for key, value in txn.cursor():
+                if Records.is_compact(value):
                     continue
-                local_entry = _deserialize_pickle(txn.get(key))
-                local_entry["id"] = key.decode(encoding='UTF-8');
-                file_out.write(json.dumps(local_entry))
-                file_out.write("\n")
+                local_entry = self.records.decode(value).entry()
+                local_entry['id'] = key.decode(encoding='UTF-8')
+                status = Records.STATUS_FAILED if txn_fail.get(key) is not None else Records.STATUS_SUCCESS
+                batch.append((key, self.records.encode(local_entry, status)))
+                if len(batch) == batch_size:
+                    nb_migrated += self._writeBatch(self.env, batch)
+                    batch = []
+        nb_migrated += self._writeBatch(self.env, batch)
+        print("migrated entries:", nb_migrated)
+
+        # failure records with url and file name, and fail index
+        nb_failures = 0
+        batch = []
+        index_batch = []
+        with self.env.begin() as txn, self.env_fail.begin() as txn_fail:
+            for key, value in txn_fail.cursor():
+                failure = Records.decode_failure(value)
+                if failure['url'] is None:
+                    entry_value = txn.get(key)
+                    local_entry = self.records.decode(entry_value).entry() if entry_value is not None else {}
+                    local_entry['id'] = key.decode(encoding='UTF-8')
+                    url = Records.url_of(local_entry)
+                    if url is not None and url.endswith(".tar.gz"):
+                        filename = local_entry['id']+".tar.gz"
+                    else:
+                        filename = local_entry['id']+".pdf"
+                    value = Records.encode_failure(failure['error'], url, filename, local_entry.get('doi'), 
+                        failure['category'], failure['retries'], failure['next_retry'])
+                    batch.append((key, value))
+                    failure = Records.decode_failure(value)
+                for index_key in Records.failure_index_keys(key, failure):
+                    index_batch.append((index_key, b''))
+                nb_failures += 1
+                if len(index_batch) >= batch_size:
+                    self._writeBatch(self.env_fail, batch)
+                    self._writeBatch(self.env_fail_index, index_batch)
+                    batch = []
+                    index_batch = []
+        self._writeBatch(self.env_fail, batch)
+        self._writeBatch(self.env_fail_index, index_batch)
+        print("indexed failures:", nb_failures)
+
+    def _writeBatch(self, env, batch):
+        with env.begin(write=True) as txn:
+            for key, value in batch:
+                txn.put(key, value)
+        return len(batch)
 
     def reset(self):
         """
@@ -500,6 +1099,8 @@ class OAHarverster(object):
         self.env.close()
         self.env_doi.close()
         self.env_fail.close()
+        self.env_fail_index.close()
+        self.env_hash.close()
 
         envFilePath = os.path.join(self.config["data_path"], 'entries')
         shutil.rmtree(envFilePath)
@@ -510,6 +1111,16 @@ class OAHarverster(object):
         envFilePath = os.path.join(self.config["data_path"], 'fail')
         shutil.rmtree(envFilePath)
 
+        envFilePath = os.path.join(self.config["data_path"], 'fail_index')
+        shutil.rmtree(envFilePath)
+
+        envFilePath = os.path.join(self.config["data_path"], 'hash')
+        shutil.rmtree(envFilePath)
+
+        checkpointPath = os.path.join(self.config["data_path"], Resume.checkpoint_file)
+        if os.path.isfile(checkpointPath):
+            os.remove(checkpointPath)
+
         # re-init the environments
         self._init_lmdb()
 
@@ -528,119 +1139,244 @@ class OAHarverster(object):
         nb_total = txn.stat()['entries']
         print("number of failed entries with OA link:", nb_fails, "out of", nb_total, "entries")
 
-def _serialize_pickle(a):
-    return pickle.dumps(a)
-
-def _deserialize_pickle(serialized):
-    return pickle.loads(serialized)
-
-def download(url, filename, entry):
-    #cmd = "wget -c --quiet" + " -O " + filename + ' --connect-timeout=10 --waitretry=10 ' + \
-    cmd = "wget -c --quiet" + " -O " + filename + '  --timeout=2 --waitretry=0 --tries=5 --retry-connrefused ' + \
-        '--header="User-Agent: Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:60.0) Gecko/20100101 Firefox/60.0" ' + \
-        '--header="Accept: application/pdf, text/html;q=0.9,*/*;q=0.8" --header="Accept-Encoding: gzip, deflate" ' + \
-        '"' + url + '"'
-        #'--header="Referer: https://www.google.com"' +
-        #' --random-wait' +
-    # Check pdf integrity
-    pdftotext = shutil.which('pdftotext');
-    if pdftotext is not None:
-        print("Found pdftotext executable : " + pdftotext)
-        cmd += "; " + pdftotext + " " + filename
-
-    print(cmd)
-    #print(cmd)
-    try:
-        result = subprocess.check_call(cmd, shell=True)
-        #print("result:", result)
-        # check if finename exists
-        if filename.endswith(".tar.gz") and os.path.isfile(filename):
-            # for PMC we still have to extract the PDF from archive
-            #print(filename, "is an archive")
-            thedir = os.path.dirname(filename)
-            # we need to extract the PDF, the NLM extra file, change file name and remove the tar file
-            tar = tarfile.open(filename)
-            pdf_found = False
-            for member in tar.getmembers():
-                if not pdf_found and member.isfile() and (member.name.endswith(".pdf") or member.name.endswith(".PDF")):
-                    member.name = os.path.basename(member.name)
-                    f = tar.extract(member, path=thedir)
-                    #print("extracted file:", member.name)
-                    os.rename(os.path.join(thedir,member.name), filename.replace(".tar.gz", ".pdf"))
-                    pdf_found = True
-                    #break
-                if member.isfile() and member.name.endswith(".nxml"):
-                    member.name = os.path.basename(member.name)
-                    f = tar.extract(member, path=thedir)
-                    #print("extracted file:", member.name)
-                    os.rename(os.path.join(thedir,member.name), filename.replace(".tar.gz", ".nxml"))
-            tar.close()
-            if not pdf_found:
-                print("warning: no pdf found in archive:", filename)
-            if os.path.isfile(filename):
-                os.remove(filename)
+        # failures by error class, from the fail index
+        nb_by_class = {}
+        with self.env_fail_index.begin() as txn_index:
+            cursor = txn_index.cursor()
+            if cursor.set_range(Records.INDEX_CLASS):
+                for index_key in cursor.iternext(values=False):
+                    if not index_key.startswith(Records.INDEX_CLASS):
+                        break
+                    error_class = index_key[1:index_key.index(b'\x00')].decode(encoding='UTF-8')
+                    nb_by_class[error_class] = nb_by_class.get(error_class, 0) + 1
+        for error_class in sorted(nb_by_class, key=nb_by_class.get, reverse=True):
+            print("   ", error_class, ":", nb_by_class[error_class])
+
+        # failures by retry status, for knowing what a reprocessing would retry
+        nb_by_status = {}
+        now = time.time()
+        with self.env_fail.begin() as txn_fail:
+            for _, value in txn_fail.cursor():
+                status = self.retry_policy.status(Records.decode_failure(value), now)
+                nb_by_status[status] = nb_by_status.get(status, 0) + 1
+        if nb_by_status:
+            print("retry status of the failed entries:")
+        for status in sorted(nb_by_status, key=nb_by_status.get, reverse=True):
+            print("   ", status, ":", nb_by_status[status])
+
+class LMDBBatchWriter(object):
+    """
+    Buffer the LMDB write operations of the writer stage and commit them with one transaction per 
+    environment every commit_size results or every commit_interval milliseconds, instead of one 
+    transaction (and one fsync) per operation. In case of crash, at most the results of the pending
+    group are lost, they will simply be harvested again when resuming. 
+    All the methods must be called from the same (writer) thread.
+    """
 
-    except subprocess.CalledProcessError as e:   
-        print("e.returncode", e.returncode)
-        print("e.output", e.output)
-        #if e.output is not None and e.output.startswith('error: {'):
-        if  e.output is not None:
-            error = json.loads(e.output[7:]) # Skip "error: "
-            print("error code:", error['code'])
-            print("error message:", error['message'])
-            result = error['message']
-        else:
-            result = e.returncode
+    def __init__(self, config):
+        self.commit_size = config.get('commit_size', 100)
+        # in seconds
+        self.interval = config.get('commit_interval', 1000) / 1000.0
+        # pending operations by environment, as (key, value) with value None for a deletion
+        self.pending = {}
+        self.nb_results = 0
+        self.first_pending_time = None
+        # environment to be committed after the other ones
+        self.last_env = None
+        # optional callback after each commit
+        self.on_flush = None
+
+    def put(self, env, key, value):
+        self._add(env, key, value)
+
+    def get(self, env, key):
+        """
+        Read a value, taking into account the pending write operations
+        """
+        for pending_key, value in reversed(self.pending.get(env, [])):
+            if pending_key == key:
+                return value
+        with env.begin() as txn:
+            return txn.get(key)
+
+    def delete(self, env, key):
+        self._add(env, key, None)
+
+    def _add(self, env, key, value):
+        if env not in self.pending:
+            self.pending[env] = []
+        self.pending[env].append((key, value))
+        if self.first_pending_time is None:
+            self.first_pending_time = time.time()
+
+    def result_stored(self):
+        self.nb_results += 1
+        self.flush_if_due()
+
+    def flush_if_due(self):
+        if self.first_pending_time is None:
+            return
+        if self.nb_results >= self.commit_size or time.time() - self.first_pending_time >= self.interval:
+            self.flush()
+
+    def flush(self):
+        start = time.monotonic()
+        for env in sorted(self.pending, key=lambda env: env is self.last_env):
+            with env.begin(write=True) as txn:
+                for key, value in self.pending[env]:
+                    if value is None:
+                        txn.delete(key)
+                    else:
+                        txn.put(key, value)
+        if self.pending:
+            metrics.observe("lmdb_commit_seconds", time.monotonic() - start)
+        self.pending = {}
+        self.nb_results = 0
+        self.first_pending_time = None
+        if self.on_flush is not None:
+            self.on_flush()
+
+class PostProcessing(object):
+    """
+    Post-download stage, run by its own pool of nb_post_workers threads as soon as an entry is stored, 
+    so that the downloads and the uploads overlap. The downloaded files remain in data_path until they 
+    are post-processed (and uploaded for S3): submit() blocks while the size of these files exceeds 
+    temp_disk_limit (in MB), which blocks in turn the writer and the download workers, so that the 
+    temporary disk usage remains bounded whatever the upload throughput.
+    """
+
+    def __init__(self, config, process):
+        # process(local_entry) realizes the stage, and returns the futures of the uploads of the files
+        self.process = process
+        self.executor = ThreadPoolExecutor(max_workers=config.get('nb_post_workers', 4))
+        self.disk_limit = config.get('temp_disk_limit', 10240) * 1024 * 1024
+        # the entries waiting for a worker are bounded too, whatever the size of their files
+        self.queue_slots = threading.BoundedSemaphore(config.get('batch_size', 100))
+        self.disk_used = 0
+        self.nb_pending = 0
+        self.condition = threading.Condition()
+
+    def submit(self, local_entry, local_files):
+        size = sum(os.path.getsize(local_file) for local_file in local_files)
+        start = time.monotonic()
+        self.queue_slots.acquire()
+        with self.condition:
+            # a single entry larger than the limit is still accepted when nothing else is pending
+            while self.disk_used > 0 and self.disk_used + size > self.disk_limit:
+                self.condition.wait()
+            self.disk_used += size
+            self.nb_pending += 1
+        metrics.observe("temp_disk_wait_seconds", time.monotonic() - start)
+        self.executor.submit(self._run, local_entry, size)
+
+    def _run(self, local_entry, size):
+        uploads = []
+        try:
+            with metrics.timer("post_processing_seconds"):
+                uploads = self.process(local_entry) or []
+        except Exception as e:
+            print("post-processing failed for entry", local_entry['id'], ":", str(e))
+        finally:
+            self.queue_slots.release()
+        if not uploads:
+            self._release(size)
+            return
+        # the files are removed from data_path when all their uploads are completed
+        remaining = [len(uploads)]
+        lock = threading.Lock()
+        def uploaded(future):
+            with lock:
+                remaining[0] -= 1
+                completed = remaining[0] == 0
+            if completed:
+                self._release(size)
+        for upload in uploads:
+            upload.add_done_callback(uploaded)
+
+    def _release(self, size):
+        with self.condition:
+            self.disk_used -= size
+            self.nb_pending -= 1
+            self.condition.notify_all()
+
+    def wait(self):
+        """
+        Block until all the submitted entries are post-processed and their files uploaded
+        """
+        with self.condition:
+            while self.nb_pending > 0:
+                self.condition.wait()
 
-    return str(result), entry
+def _clean_uploaded_file(file_path, error):
+    # a file failing to upload is kept
+    if error is None and os.path.isfile(file_path):
+        os.remove(file_path)
 
-def generate_thumbnail(pdfFile):
+def generate_thumbnail(pdfFile, density=100, timeout=60):
     """
     Generate a PNG thumbnails (3 different sizes) for the front page of a PDF. 
-    Use ImageMagick for this.
+    Use ImageMagick for this, with a single process rasterizing the front page once: the large 
+    thumbnail is written first, then downscaled in memory for the medium and small ones. 
+    The process is killed if it does not complete within the timeout (in seconds).
     """
-    thumb_file = pdfFile.replace('.pdf', '-thumb-small.png')
-    cmd = 'convert -quiet -density 200 -thumbnail x150 -flatten ' + pdfFile+'[0] ' + thumb_file
-    try:
-        subprocess.check_call(cmd, shell=True)
-    except subprocess.CalledProcessError as e:   
-        print("e.returncode", e.returncode)
-
-    thumb_file = pdfFile.replace('.pdf', '-thumb-medium.png')
-    cmd = 'convert -quiet -density 200 -thumbnail x300 -flatten ' + pdfFile+'[0] ' + thumb_file
+    if not os.path.isfile(pdfFile):
+        return
+    thumb_files = [pdfFile.replace('.pdf', '-thumb-large.png'), 
+                   pdfFile.replace('.pdf', '-thumb-medium.png'), 
+                   pdfFile.replace('.pdf', '-thumb-small.png')]
+    cmd = ['convert', '-quiet', '-density', str(density), pdfFile+'[0]', '-flatten', 
+           '-thumbnail', 'x500', '-write', thumb_files[0], 
+           '-thumbnail', 'x300', '-write', thumb_files[1], 
+           '-thumbnail', 'x150', thumb_files[2]]
     try:
-        subprocess.check_call(cmd, shell=True)
+        with metrics.timer("thumbnail_seconds"):
+            subprocess.run(cmd, check=True, timeout=timeout, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
     except subprocess.CalledProcessError as e:   
         print("e.returncode", e.returncode)
-
-    thumb_file = pdfFile.replace('.pdf', '-thumb-large.png')
-    cmd = 'convert -quiet -density 200 -thumbnail x500 -flatten ' + pdfFile+'[0] ' + thumb_file
-    try:
-        subprocess.check_call(cmd, shell=True)
-    except subprocess.CalledProcessError as e:   
-        print("e.returncode", e.returncode)
-
-def generateS3Path(filename):
-    '''
-    Convert a file name into a path with file prefix as directory paths:
-    123456789 -> 12/34/56/123456789
-    '''
-    return filename[:2] + '/' + filename[2:4] + '/' + filename[4:6] + "/" + filename[6:8] + "/"
+    except subprocess.TimeoutExpired:
+        print("thumbnail generation timeout for", pdfFile)
+        # do not keep partial thumbnails
+        for thumb_file in thumb_files:
+            if os.path.isfile(thumb_file):
+                os.remove(thumb_file)
+    except OSError as e:
+        print("thumbnail generation failed:", str(e))
 
 def test():
     harvester = OAHarverster()
 
+def positive_int(value):
+    """
+    argparse type of the strictly positive integer options
+    """
+    number = int(value)
+    if number <= 0:
+        raise argparse.ArgumentTypeError("must be a positive integer: " + value)
+    return number
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description = "Open Access PDF harvester")
     parser.add_argument("--unpaywall", default=None, help="path to the Unpaywall dataset (gzipped)") 
     parser.add_argument("--pmc", default=None, help="path to the pmc file list, as available on NIH's site") 
     parser.add_argument("--config", default="./config.json", help="path to the config file, default is ./config.json")
     parser.add_argument("--dump", default="dump.json", help="write all JSON entries having a sucessful OA link with their UUID") 
+    parser.add_argument("--dump-shards", action="store_true", help="with --dump, write one file per key range instead of a single file") 
+    parser.add_argument("--dump-mapping", action="store_true", help="with --dump, write only the identifier mapping (doi or pmcid and UUID)") 
     parser.add_argument("--reprocess", action="store_true", help="reprocessed failed entries with OA link") 
+    parser.add_argument("--fail-class", dest="fail_classes", action="append", default=None, help="with --reprocess, reprocess only the failures of this error class (e.g. timeout, http:503, http), can be repeated") 
+    parser.add_argument("--retry-all", action="store_true", help="with --reprocess, retry also the permanent failures and the failures not yet due for a retry") 
+    parser.add_argument("--fail-host", dest="fail_hosts", action="append", default=None, help="with --reprocess, reprocess only the failures of this host, can be repeated") 
     parser.add_argument("--reset", action="store_true", help="ignore previous processing states, and re-init the harvesting process from the beginning") 
     parser.add_argument("--increment", action="store_true", help="augment an existing harvesting with a new released Unpaywall dataset (gzipped)") 
     parser.add_argument("--thumbnail", action="store_true", help="generate thumbnail files for the front page of the PDF") 
-    parser.add_argument("--sample", type=int, default=None, help="Harvest only a random sample of indicated size")
+    parser.add_argument("--sample", type=positive_int, default=None, help="Harvest only a random sample of indicated size")
+    parser.add_argument("--shard", default=None, help="harvest only the partition i of N of the input (e.g. 0/4), with its own state in data_path/shard-i-of-N") 
+    parser.add_argument("--merge", nargs='*', default=None, help="merge shard directories into data_path, by default all the shard directories under data_path") 
+    parser.add_argument("--compact-packs", action="store_true", help="rewrite the packs having a low proportion of used data, with the pack storage") 
+    parser.add_argument("--migrate", action="store_true", help="convert the stored entries of a previous version into the compact record format") 
+    parser.add_argument("--log-level", default=None, help="debug for logging each processed url, default is info or log_level in the config file")
+    parser.add_argument("--seed", type=int, default=None, help="seed of the random sampling, for reproducible samples")
+    parser.add_argument("--async", dest="async_mode", action="store_true", help="download with an event loop and a high number of concurrent requests (async_concurrency in the config file)") 
     args = parser.parse_args()
 
     unpaywall = args.unpaywall
@@ -648,19 +1384,56 @@ if __name__ == "__main__":
     config_path = args.config
     reprocess = args.reprocess
     reset = args.reset
+    increment = args.increment
     dump = args.dump
+    dump_shards = args.dump_shards
+    dump_mapping = args.dump_mapping
     thumbnail = args.thumbnail
     sample = args.sample
+    async_mode = args.async_mode
+    seed = args.seed
+    migrate = args.migrate
+    fail_classes = args.fail_classes
+    fail_hosts = args.fail_hosts
+    retry_all = args.retry_all
+    merge = args.merge
+    compact_packs = args.compact_packs
+
+    shard = None
+    if args.shard is not None:
+        if merge is not None:
+            parser.error("--merge is realized without --shard")
+        try:
+            shard = Shard.parse_shard(args.shard)
+        except ValueError as e:
+            parser.error(str(e))
+
+    with open(config_path) as config_file:
+        log_level = args.log_level or json.load(config_file).get('log_level', 'info')
+    logging.basicConfig(format="%(message)s", level=log_level.upper())
+    if log_level.lower() != 'debug':
+        # the connection retries are logged by urllib3 as warnings, one line per attempt
+        logging.getLogger("urllib3").setLevel(logging.ERROR)
 
-    harvester = OAHarverster(config_path=config_path, thumbnail=thumbnail, sample=sample)
+    harvester = OAHarverster(config_path=config_path, thumbnail=thumbnail, sample=sample, async_mode=async_mode, seed=seed, shard=shard)
 
     if reset:
         harvester.reset()
 
     start_time = time.time()
 
-    if reprocess:
-        harvester.reprocessFailed()
+    if merge is not None:
+        harvester.mergeShards(merge)
+        harvester.diagnostic()
+    elif compact_packs:
+        harvester.compactPacks()
+    elif migrate:
+        harvester.migrate()
+    elif reprocess:
+        harvester.reprocessFailed(classes=fail_classes, hosts=fail_hosts, retry_all=retry_all)
+        harvester.diagnostic()
+    elif unpaywall is not None and increment:
+        harvester.harvestIncrement(unpaywall)
         harvester.diagnostic()
     elif unpaywall is not None: 
         harvester.harvestUnpaywall(unpaywall)
@@ -671,6 +1444,7 @@ if __name__ == "__main__":
 
     runtime = round(time.time() - start_time, 3)
     print("runtime: %s seconds " % (runtime))
+    metrics.stop()
 
     if dump is not None:
-        harvester.dump(dump)
+        harvester.dump(dump, shards=dump_shards, mapping=dump_mapping)
@@ -0,0 +1,348 @@
+import os
+import re
+import glob
+import time
+import uuid
+import struct
+import tarfile
+import threading
+
+import lmdb
+
+from Storage import generateS3Path
+
+"""
+Pack storage of the harvested resources, as an alternative to one file (or one S3 object) per resource.
+
+The files of the entries (PDF, NLM file and thumbnails) are appended to large rolling pack files
+data_path/packs/pack-<random id>.tar of pack_size MB (default 1024), the random ids keeping the pack
+names unique across the shards of a distributed harvesting. A pack is a standard tar archive, whose
+member names follow the usual layout of the resources (see generateS3Path), so a pack can be extracted
+with tar. The pack being written has the extension .tar.part, and is renamed in .tar once sealed, with
+the end of archive marker. With an S3 bucket, the sealed packs are uploaded as packs/pack-<id>.tar
+objects, one PUT for thousands of resources.
+
+The position of each resource is indexed by uuid and kind (pdf, nxml, thumb-small, thumb-medium,
+thumb-large) in the lmdb data_path/pack_index, which gives a random access to any resource with
+read(), from the local pack or with a range request to the S3 pack object. The appended files are
+removed once the pack has been synced and their index entries committed, by groups of
+pack_commit_size files. After a crash, the pack being written is truncated at the last commit and the
+remaining downloaded files are stored again at the next run.
+
+Resources appended several times (post-processing resumed after a crash, reprocessing) and resources of
+entries removed or deduplicated leave unused space in the packs, which is reclaimed by compact().
+"""
+
+# index value: pack id, offset of the resource data in the pack, size
+location = struct.Struct('>16sQQ')
+# index key of the state of the pack being written: pack id and committed size
+writer_key = b'writer'
+writer_state = struct.Struct('>16sQ')
+
+block_size = tarfile.BLOCKSIZE
+pack_pattern = re.compile(r'pack-([0-9a-f]{32})\.tar(\.part)?$')
+map_size = 100 * 1024 * 1024 * 1024
+
+class PackStorage(object):
+
+    def __init__(self, config, s3=None):
+        self.data_path = config["data_path"]
+        self.directory = os.path.join(self.data_path, 'packs')
+        os.makedirs(self.directory, exist_ok=True)
+        envFilePath = os.path.join(self.data_path, 'pack_index')
+        os.makedirs(envFilePath, exist_ok=True)
+        self.env = lmdb.open(envFilePath, map_size=map_size)
+        self.s3 = s3
+        self.pack_size = config.get('pack_size', 1024) * 1024 * 1024
+        self.commit_size = config.get('pack_commit_size', 1000)
+        # appended files whose index entries are not yet committed: (key, value, local file)
+        self.pending = []
+        self.lock = threading.Lock()
+        self.fd = None
+        self.pack_id = None
+        self.offset = 0
+
+    def download_path(self, identifier, extension):
+        """
+        Path where the resource of an entry is downloaded, before being appended to a pack
+        """
+        return os.path.join(self.data_path, identifier + extension)
+
+    def store(self, local_file, identifier):
+        """
+        Append a downloaded or generated file of an entry to the current pack, the file is removed
+        once its index entry is committed
+        """
+        kind = file_kind(os.path.basename(local_file), identifier)
+        name = generateS3Path(identifier) + os.path.basename(local_file)
+        with self.lock:
+            if self.fd is None:
+                self._open()
+            key = index_key(identifier, kind)
+            data_offset, size = self._append(name, local_file)
+            self.pending.append((key, location.pack(self.pack_id, data_offset, size), local_file))
+            if self.offset >= self.pack_size:
+                self._seal()
+            elif len(self.pending) >= self.commit_size:
+                self._commit()
+
+    def flush(self):
+        """
+        Commit the appended files, and with S3 seal and upload the current pack, so that all the stored
+        resources are in the bucket at the end of a run
+        """
+        with self.lock:
+            if self.fd is None:
+                return
+            if self.s3 is not None and self.offset > 0:
+                self._seal()
+            else:
+                self._commit()
+        if self.s3 is not None:
+            self.s3.wait_uploads()
+
+    def read(self, identifier, kind):
+        """
+        Return the content of a resource of an entry (kind being pdf, nxml, thumb-small, thumb-medium
+        or thumb-large), None if not stored
+        """
+        with self.env.begin() as txn:
+            value = txn.get(index_key(identifier, kind))
+        if value is None:
+            return None
+        return self._read(*location.unpack(value))
+
+    def _read(self, pack_id, offset, size):
+        for path in (pack_path(self.directory, pack_id), pack_path(self.directory, pack_id) + ".part"):
+            try:
+                with open(path, 'rb') as f:
+                    return os.pread(f.fileno(), size, offset)
+            except FileNotFoundError:
+                continue
+        if self.s3 is not None and size > 0:
+            return self.s3.get_range(pack_key(pack_id), offset, size)
+        raise FileNotFoundError("pack " + pack_id.hex() + " not found")
+
+    def _open(self):
+        """
+        Open the pack being written, truncated at its last commit, or a new pack
+        """
+        with self.env.begin() as txn:
+            value = txn.get(writer_key)
+        pack_id, committed = writer_state.unpack(value) if value is not None else (uuid.uuid4().bytes, 0)
+        path = pack_path(self.directory, pack_id) + ".part"
+        if not os.path.isfile(path):
+            committed = 0
+        # a pack interrupted between its seal and its renaming
+        for part_path in glob.glob(os.path.join(self.directory, "pack-*.tar.part")):
+            if part_path != path:
+                self._publish(part_path[:-len(".part")])
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        os.ftruncate(self.fd, committed)
+        self.pack_id = pack_id
+        self.offset = committed
+
+    def _append(self, name, local_file):
+        """
+        Write a tar member for the file at the end of the pack, return the offset and the size of its data
+        """
+        size = os.path.getsize(local_file)
+        info = tarfile.TarInfo(name)
+        info.size = size
+        info.mtime = int(time.time())
+        info.mode = 0o644
+        header = info.tobuf(format=tarfile.GNU_FORMAT)
+        os.pwrite(self.fd, header, self.offset)
+        data_offset = self.offset + len(header)
+        with open(local_file, 'rb') as f_in:
+            _copy_range(f_in.fileno(), self.fd, size, data_offset)
+        end = data_offset + size
+        if end % block_size:
+            padding = block_size - end % block_size
+            os.pwrite(self.fd, bytes(padding), end)
+            end += padding
+        self.offset = end
+        return data_offset, size
+
+    def _commit(self, next_state=None):
+        if self.fd is not None:
+            os.fdatasync(self.fd)
+        with self.env.begin(write=True) as txn:
+            for key, value, _ in self.pending:
+                txn.put(key, value)
+            txn.put(writer_key, next_state or writer_state.pack(self.pack_id, self.offset))
+        for _, _, local_file in self.pending:
+            if local_file is not None and os.path.isfile(local_file):
+                os.remove(local_file)
+        self.pending = []
+
+    def _seal(self):
+        """
+        Terminate the current pack with the end of archive marker, the next file goes to a new pack
+        """
+        os.pwrite(self.fd, bytes(2 * block_size), self.offset)
+        self._commit(next_state=writer_state.pack(uuid.uuid4().bytes, 0))
+        os.close(self.fd)
+        self.fd = None
+        self._publish(pack_path(self.directory, self.pack_id))
+
+    def _publish(self, path):
+        os.rename(path + ".part", path)
+        if self.s3 is not None:
+            self.s3.submit_upload(path, "packs/", storage_class='ONEZONE_IA', callback=_clean_uploaded_pack)
+
+    def compact(self, env_entries, codec, ratio=0.5):
+        """
+        Rewrite the live resources of the sealed packs whose proportion of live data is below ratio
+        into the current pack, and remove these packs. A resource is live if its entry is stored, and
+        is not a duplicate of another entry. Return the number of removed packs.
+        """
+        self.flush()
+        live = {}
+        total = {}
+        dead_keys = []
+        with self.env.begin() as txn, env_entries.begin() as txn_entries:
+            for key, value in txn.cursor():
+                if len(key) <= 16:
+                    continue
+                pack_id, offset, size = location.unpack(value)
+                entry_value = txn_entries.get(str(uuid.UUID(bytes=key[:16])).encode(encoding='UTF-8'))
+                if entry_value is None or codec.decode(entry_value).canonical is not None:
+                    dead_keys.append(key)
+                    continue
+                # with its tar header and padding
+                live[pack_id] = live.get(pack_id, 0) + block_size + -(-size // block_size) * block_size
+        for path in sealed_packs(self.directory, self.s3):
+            pack_id = bytes.fromhex(pack_pattern.search(path).group(1))
+            total[pack_id] = self._pack_size(pack_id) - 2 * block_size
+        candidates = set(pack_id for pack_id in total if total[pack_id] > 0 and live.get(pack_id, 0) / total[pack_id] < ratio)
+        if not candidates and not dead_keys:
+            return 0
+
+        with self.env.begin(write=True) as txn:
+            for key in dead_keys:
+                txn.delete(key)
+        moved = []
+        with self.env.begin() as txn:
+            for key, value in txn.cursor():
+                if len(key) > 16 and location.unpack(value)[0] in candidates:
+                    moved.append((key, value))
+        tmp_file = os.path.join(self.data_path, "compaction.tmp")
+        for key, value in moved:
+            identifier = str(uuid.UUID(bytes=key[:16]))
+            kind = key[16:].decode(encoding='UTF-8')
+            with open(tmp_file, 'wb') as f:
+                f.write(self._read(*location.unpack(value)))
+            with self.lock:
+                if self.fd is None:
+                    self._open()
+                data_offset, size = self._append(generateS3Path(identifier) + identifier + kind_suffix(kind), tmp_file)
+                self.pending.append((key, location.pack(self.pack_id, data_offset, size), None))
+                if self.offset >= self.pack_size:
+                    self._seal()
+        if os.path.isfile(tmp_file):
+            os.remove(tmp_file)
+        self.flush()
+
+        for pack_id in candidates:
+            path = pack_path(self.directory, pack_id)
+            if os.path.isfile(path):
+                os.remove(path)
+            elif self.s3 is not None:
+                self.s3.delete_object(pack_key(pack_id))
+        return len(candidates)
+
+    def merge(self, path):
+        """
+        Add the packs and the pack index of a shard directory, the pack being written by the shard is
+        sealed at its last commit
+        """
+        envFilePath = os.path.join(path, 'pack_index')
+        if not os.path.isdir(envFilePath):
+            return
+        env_shard = lmdb.open(envFilePath, readonly=True, lock=False)
+        with env_shard.begin() as txn_shard, self.env.begin(write=True) as txn:
+            for key, value in txn_shard.cursor():
+                if key == writer_key:
+                    pack_id, committed = writer_state.unpack(value)
+                    part_path = pack_path(os.path.join(path, 'packs'), pack_id) + ".part"
+                    if os.path.isfile(part_path):
+                        with open(part_path, 'r+b') as f:
+                            f.truncate(committed)
+                            f.seek(committed)
+                            f.write(bytes(2 * block_size))
+                        os.rename(part_path, part_path[:-len(".part")])
+                    continue
+                txn.put(key, value)
+        env_shard.close()
+        for shard_pack in glob.glob(os.path.join(path, 'packs', "pack-*.tar")):
+            os.replace(shard_pack, os.path.join(self.directory, os.path.basename(shard_pack)))
+
+    def _pack_size(self, pack_id):
+        path = pack_path(self.directory, pack_id)
+        if os.path.isfile(path):
+            return os.path.getsize(path)
+        return self.s3.object_size(pack_key(pack_id))
+
+    def close(self):
+        self.flush()
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        self.env.close()
+
+def file_kind(filename, identifier):
+    """
+    1ba0...-thumb-small.png -> thumb-small, 1ba0....pdf -> pdf
+    """
+    suffix = filename[len(identifier):]
+    if suffix.endswith(".png"):
+        suffix = suffix[:-len(".png")]
+    return suffix.lstrip('.-')
+
+def kind_suffix(kind):
+    if kind.startswith("thumb-"):
+        return "-" + kind + ".png"
+    return "." + kind
+
+def index_key(identifier, kind):
+    return uuid.UUID(identifier).bytes + kind.encode(encoding='UTF-8')
+
+def pack_path(directory, pack_id):
+    return os.path.join(directory, "pack-%s.tar" % pack_id.hex())
+
+def pack_key(pack_id):
+    return "packs/pack-%s.tar" % pack_id.hex()
+
+def sealed_packs(directory, s3=None):
+    paths = glob.glob(os.path.join(directory, "pack-*.tar"))
+    if s3 is not None:
+        local = set(os.path.basename(path) for path in paths)
+        paths += [key for key in s3.get_s3_results("packs/") if key not in local]
+    return paths
+
+def _copy_range(fd_in, fd_out, size, offset):
+    """
+    Copy size bytes of fd_in at offset of fd_out, in the kernel when possible
+    """
+    copied = 0
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while copied < size:
+                n = os.copy_file_range(fd_in, fd_out, size - copied, copied, offset + copied)
+                if n == 0:
+                    break
+                copied += n
+        except OSError:
+            pass
+    while copied < size:
+        chunk = os.pread(fd_in, min(1024 * 1024, size - copied), copied)
+        if not chunk:
+            raise IOError("file truncated while appended to the pack")
+        os.pwrite(fd_out, chunk, offset + copied)
+        copied += len(chunk)
+
+def _clean_uploaded_pack(file_path, error):
+    # the pack is read from the bucket once uploaded
+    if error is None and os.path.isfile(file_path):
+        os.remove(file_path)
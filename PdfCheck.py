@@ -0,0 +1,97 @@
+import os
+import re
+import shutil
+import threading
+import subprocess
+
+"""
+In-process validation of the downloaded PDF, replacing a full pdftotext extraction for every file.
+
+The quick check only reads the beginning and the end of the file: the %PDF- header, the %%EOF marker and
+the startxref offset, which must point to a cross-reference table or stream. It distinguishes in a few
+microseconds the HTML pages served instead of a PDF (landing pages, login or captcha pages), the
+truncated files and the structurally valid PDF. The rare ambiguous files (e.g. a wrong xref offset,
+which PDF readers usually recover) are either accepted, or checked with pdftotext when the full mode
+is configured, with a bounded number of concurrent pdftotext processes.
+"""
+
+# looked up only once, pdftotext is only used by the full check mode
+pdftotext = shutil.which('pdftotext')
+
+# the header may be preceded by some garbage, readers look at the first 1024 bytes
+head_size = 1024
+# the %%EOF marker may be followed by some garbage
+tail_size = 4096
+
+html_pattern = re.compile(rb'<(!doctype\s+html|html|head|body|script|meta)[\s>]', re.IGNORECASE)
+startxref_pattern = re.compile(rb'startxref\s+(\d+)\s+%%EOF')
+xref_object_pattern = re.compile(rb'\s*\d+\s+\d+\s+obj')
+
+AMBIGUOUS = None
+
+class PdfChecker(object):
+
+    def __init__(self, config):
+        # "quick": the ambiguous files are accepted, "full": they are checked with pdftotext
+        self.mode = config.get('pdf_check', 'quick')
+        self.pdftotext_slots = threading.BoundedSemaphore(config.get('pdftotext_workers', os.cpu_count() or 1))
+
+    def check(self, filename):
+        """
+        Return "0" if the file is a PDF, an error code of class pdf otherwise
+        """
+        result = quick_check(filename)
+        if result is not AMBIGUOUS:
+            return result
+        if self.mode != 'full' or pdftotext is None:
+            return "0"
+        with self.pdftotext_slots:
+            return full_check(filename)
+
+def quick_check(filename):
+    """
+    Structural check of a PDF file, return "0" if valid, an error code if not and AMBIGUOUS if the
+    structure is unusual
+    """
+    try:
+        size = os.path.getsize(filename)
+        if size == 0:
+            return "pdf:empty"
+        with open(filename, 'rb') as f:
+            head = f.read(head_size)
+            tail_offset = max(0, size - tail_size)
+            f.seek(tail_offset)
+            tail = f.read(tail_size)
+
+            if head.find(b'%PDF-') == -1:
+                if html_pattern.search(head):
+                    return "pdf:html"
+                return "pdf:not pdf"
+
+            if tail.rfind(b'%%EOF') == -1:
+                return "pdf:truncated"
+
+            matches = list(startxref_pattern.finditer(tail))
+            if not matches:
+                return AMBIGUOUS
+            xref_offset = int(matches[-1].group(1))
+            if xref_offset >= size:
+                return AMBIGUOUS
+            # a cross-reference table, or a cross-reference stream object
+            f.seek(xref_offset)
+            xref = f.read(32)
+            if xref.lstrip().startswith(b'xref') or xref_object_pattern.match(xref):
+                return "0"
+            return AMBIGUOUS
+    except OSError as e:
+        return "io:" + str(e)
+
+def full_check(filename):
+    """
+    Complete text extraction with pdftotext, the text is discarded
+    """
+    try:
+        subprocess.check_call([pdftotext, '-q', filename, '-'], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    except subprocess.CalledProcessError as e:
+        return "pdf:" + str(e.returncode)
+    return "0"
@@ -0,0 +1,252 @@
+import os
+import re
+import gzip
+import json
+import math
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy
+
+from Metrics import metrics
+
+# use a faster JSON parser when one is installed
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    try:
+        import ujson
+        json_loads = ujson.loads
+    except ImportError:
+        json_loads = json.loads
+
+"""
+Reader stage for the Unpaywall snapshot.
+
+The gzipped snapshot is decompressed by large blocks, cut into chunks of complete lines, and the chunks
+are parsed in a process pool. Only the fields needed for scheduling the downloads are sent back (line
+number and offset, DOI and PDF url) together with the raw line, which is parsed again only for the
+entries actually submitted for download. The chunks are returned in input order.
+
+For the harvesting, the JSON parsing can be left to the caller: the DOI is then cut directly from the
+raw line, so that the lines of the entries already processed are skipped without being parsed.
+
+Random samples are selected in a single pass with reservoir sampling for the Unpaywall snapshot, and 
+with a line offset index of the file, kept as a sidecar file, for the PMC file lists.
+"""
+
+# presence of a non null PDF url in a raw Unpaywall line
+pdf_url_pattern = re.compile(rb'"url_for_pdf": ?"')
+
+# DOI of a raw Unpaywall line, when written without escape sequence (no other object has a doi field)
+doi_pattern = re.compile(rb'"doi": ?"([^"\\]*)"')
+
+# size of the decompressed blocks cut into chunks
+chunk_size = 4 * 1024 * 1024
+
+class UnpaywallReader(object):
+
+    def __init__(self, filepath, nb_parsers=0):
+        self.gz = gzip.open(filepath, 'rb')
+        # 0 means that the chunks are parsed in the current process
+        self.nb_parsers = nb_parsers
+
+    def seek(self, offset):
+        # seeking in a gzipped file still decompresses, but nothing is parsed
+        self.gz.seek(offset)
+
+    def close(self):
+        self.gz.close()
+
+    def chunks(self, offset=0, line=0, parse=True):
+        """
+        Yield for each chunk, in input order, the list of (line number, offset, doi, pdf url, raw line)
+        for the lines having a PDF url, and the offset and line number at the end of the chunk.
+        offset and line give the current position of the file. If parse is False, the lines are not
+        parsed when their DOI can be read directly: the pdf url of their records is then None, and the
+        line might have no PDF url for its best OA location (see pdf_url()).
+        """
+        if self.nb_parsers == 0:
+            for chunk, chunk_offset, chunk_line in self._read(offset, line):
+                yield _recorded(timed_parse_chunk(chunk, chunk_offset, chunk_line, parse))
+            return
+
+        with ProcessPoolExecutor(max_workers=self.nb_parsers) as pool:
+            # bounded number of chunks in progress, which keeps the memory usage constant
+            pending = deque()
+            for chunk, chunk_offset, chunk_line in self._read(offset, line):
+                pending.append(pool.submit(timed_parse_chunk, chunk, chunk_offset, chunk_line, parse))
+                if len(pending) >= 2 * self.nb_parsers:
+                    yield _recorded(pending.popleft().result())
+            while pending:
+                yield _recorded(pending.popleft().result())
+
+    def sample(self, k, rng, parse=True):
+        """
+        Single pass reservoir sampling (algorithm L) of k lines among all the lines of the snapshot,
+        rng being a random.Random instance. Return the records of the selected lines having a PDF url, 
+        in input order. The random numbers are only drawn for the lines entering the reservoir, 
+        O(k.log(N/k)) instead of one per line. parse is as for chunks().
+        """
+        if k <= 0:
+            return []
+        reservoir = [None] * k
+        w = math.exp(math.log(_uniform(rng)) / k)
+        next_line = k + int(math.log(_uniform(rng)) / math.log(1 - w))
+        start_line = 0
+        for records, offset, end_line in self.chunks(parse=parse):
+            by_line = None
+            if start_line < k:
+                # filling of the reservoir with the first k lines
+                by_line = { record[0]: record for record in records }
+                for line in range(start_line, min(k, end_line)):
+                    reservoir[line] = by_line.get(line)
+            while next_line < end_line:
+                if by_line is None:
+                    by_line = { record[0]: record for record in records }
+                # a line without PDF url remains in the sample as an empty slot
+                reservoir[rng.randrange(k)] = by_line.get(next_line)
+                w *= math.exp(math.log(_uniform(rng)) / k)
+                next_line += int(math.log(_uniform(rng)) / math.log(1 - w)) + 1
+            start_line = end_line
+        records = [record for record in reservoir if record is not None]
+        records.sort()
+        return records
+
+    def lines_at(self, offsets):
+        """
+        Yield the raw lines starting at the given offsets, sorted in increasing order, in a single
+        pass over the snapshot without parsing the other lines
+        """
+        offsets = numpy.asarray(offsets, dtype=numpy.uint64)
+        i = 0
+        for chunk, chunk_offset, _ in self._read(0, 0):
+            if i == len(offsets):
+                break
+            end = numpy.searchsorted(offsets, numpy.uint64(chunk_offset + len(chunk)))
+            for offset in offsets[i:end]:
+                start = int(offset) - chunk_offset
+                end_of_line = chunk.find(b'\n', start)
+                yield chunk[start:end_of_line] if end_of_line != -1 else chunk[start:]
+            i = end
+
+    def _read(self, offset, line):
+        rest = b''
+        while True:
+            block = self.gz.read(chunk_size)
+            if not block:
+                if rest:
+                    yield rest, offset, line
+                break
+            block = rest + block
+            cut = block.rfind(b'\n') + 1
+            if cut == 0:
+                rest = block
+                continue
+            chunk, rest = block[:cut], block[cut:]
+            yield chunk, offset, line
+            offset += len(chunk)
+            line += chunk.count(b'\n')
+
+def parse_chunk(chunk, offset, line, parse=True):
+    """
+    Parse a chunk of complete Unpaywall lines, starting at the given offset and line number
+    """
+    records = []
+    end_offset = offset + len(chunk)
+    raw_lines = chunk.split(b'\n')
+    if raw_lines[-1] == b'':
+        raw_lines.pop()
+    for raw_line in raw_lines:
+        start, line_number = offset, line
+        offset += len(raw_line) + 1
+        line += 1
+        # cheap pre-check, most of the entries have no PDF url at all
+        if not pdf_url_pattern.search(raw_line):
+            continue
+        if not parse:
+            match = doi_pattern.search(raw_line)
+            if match is not None:
+                records.append((line_number, start, match.group(1).decode('UTF-8'), None, raw_line))
+                continue
+        entry = json_loads(raw_line)
+        url = pdf_url(entry)
+        if url is None:
+            continue
+        records.append((line_number, start, entry['doi'], url, raw_line))
+    return records, end_offset, line
+
+def pdf_url(entry):
+    """
+    PDF url of the best OA location of a parsed Unpaywall entry, None if not available
+    """
+    location = entry.get('best_oa_location')
+    if location is None:
+        return None
+    return location.get('url_for_pdf')
+
+def timed_parse_chunk(chunk, offset, line, parse=True):
+    """
+    parse_chunk() with its duration, measured in the parser process
+    """
+    start = time.monotonic()
+    result = parse_chunk(chunk, offset, line, parse)
+    return result, time.monotonic() - start, line
+
+def _recorded(timed_result):
+    result, seconds, start_line = timed_result
+    metrics.observe("parse_seconds", seconds)
+    metrics.inc("parsed_lines", result[2] - start_line)
+    metrics.inc("parsed_pdf_entries", len(result[0]))
+    return result
+
+def sample_lines(fp, k, rng, index_dir):
+    """
+    Yield the (line number, offset, line) of k random lines of a binary file, excluding the first line, 
+    in file order. The lines are accessed directly with the line offset index of the file.
+    """
+    offsets = line_offsets(fp.name, index_dir)
+    nb_lines = len(offsets) - 1
+    selection = rng.sample(range(1, nb_lines), min(k, max(nb_lines - 1, 0)))
+    selection.sort()
+    for line_number in selection:
+        offset = int(offsets[line_number])
+        fp.seek(offset)
+        yield line_number, offset, fp.readline()
+
+def line_offsets(filepath, index_dir):
+    """
+    Return the start offsets of the lines of a file, followed by the file size, as a numpy array. 
+    The array is saved in index_dir and reused as long as the file does not change.
+    """
+    index_path = os.path.join(index_dir, os.path.basename(filepath) + ".offsets.npy")
+    file_size = os.path.getsize(filepath)
+    if os.path.isfile(index_path) and os.path.getmtime(index_path) >= os.path.getmtime(filepath):
+        offsets = numpy.load(index_path)
+        if len(offsets) > 0 and offsets[-1] == file_size:
+            return offsets
+
+    parts = [numpy.zeros(1, dtype=numpy.uint64)]
+    position = 0
+    with open(filepath, 'rb') as f:
+        while True:
+            block = f.read(chunk_size)
+            if not block:
+                break
+            newlines = numpy.flatnonzero(numpy.frombuffer(block, dtype=numpy.uint8) == ord('\n'))
+            parts.append((newlines + position + 1).astype(numpy.uint64))
+            position += len(block)
+    offsets = numpy.concatenate(parts)
+    if offsets[-1] != position:
+        # last line without newline
+        offsets = numpy.append(offsets, numpy.uint64(position))
+
+    os.makedirs(index_dir, exist_ok=True)
+    numpy.save(index_path, offsets)
+    return offsets
+
+def _uniform(rng):
+    # uniform in ]0, 1[, as we take its logarithm
+    return max(rng.random(), 1e-300)
@@ -0,0 +1,328 @@
+import os
+import json
+import time
+import uuid
+import struct
+import pickle
+import threading
+from urllib.parse import urlparse
+
+# msgpack and zstandard are optional, the payload is otherwise encoded in JSON without compression
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+"""
+Compact versioned record encoding for the entries lmdb, replacing the pickled Unpaywall JSON entries.
+
+A record is made of a fixed header, followed by the PDF url and the DOI (or pmcid) as length prefixed
+UTF-8 strings, and finally the payload with the rest of the entry:
+
+    magic "OAH" | version (1 byte) | flags (1 byte) | status (1 byte) | uuid (16 bytes)
+    | created (uint32, epoch seconds) | updated (uint32) | [canonical uuid (16 bytes)]
+    | url length (uint16) | url | doi length (uint16) | doi | payload
+
+The canonical uuid is only present (flag FLAG_CANONICAL) for an entry whose PDF is identical to the
+PDF of another entry, the canonical one, under which the resources are stored. A url or a DOI too long
+for its length prefix is left empty in the header (flag FLAG_LONG_FIELDS), it is then read from the
+payload.
+
+The payload is msgpack (JSON if msgpack is not installed), optionally zstd compressed with a trained
+dictionary. Records are decoded lazily: the fields of the header, the url and the DOI are available
+without decoding the payload. The pickled records of the previous versions are still readable.
+
+The fail lmdb stores for each failed entry a small JSON failure record with the error, its class, the
+PDF url and the name of the downloaded file, so that a reprocessing only iterates over the failures,
+and its retry state: retry category, number of retries and earliest time of the next retry (see
+RetryPolicy).
+The fail index lmdb gives the failed entries by error class and by host, with keys made of a prefix
+(class or host), the class or host name and the uuid.
+"""
+
+magic = b'OAH'
+version = 1
+header = struct.Struct('>3sBBB16sII')
+length = struct.Struct('>H')
+status_offset = 5
+updated_offset = header.size - 4
+
+# status of an entry
+STATUS_SUCCESS = 0
+STATUS_FAILED = 1
+
+# flags
+FLAG_MSGPACK = 1
+FLAG_ZSTD = 2
+FLAG_ZSTD_DICT = 4
+FLAG_CANONICAL = 8
+FLAG_LONG_FIELDS = 16
+
+# max size in bytes of the url and the DOI in the header
+max_field_size = 0xFFFF
+
+# size of the trained zstd dictionary
+dictionary_size = 112 * 1024
+
+class RecordCodec(object):
+
+    def __init__(self, config):
+        self.compression = config.get('record_compression')
+        if self.compression == 'zstd' and zstandard is None:
+            raise ImportError("zstd record compression requires zstandard, install it with: pip3 install zstandard")
+        self.dictionary_path = config.get('record_dictionary')
+        self.dictionary = None
+        if self.dictionary_path is not None and os.path.isfile(self.dictionary_path):
+            with open(self.dictionary_path, 'rb') as f:
+                self.dictionary = zstandard.ZstdCompressionDict(f.read())
+        # zstd compressors and decompressors cannot be shared between threads
+        self.local = threading.local()
+
+    def encode(self, entry, status, created=None, canonical=None):
+        """
+        Encode an entry dict (having its uuid as 'id') with the given status, and the uuid of its
+        canonical entry if it is a duplicate
+        """
+        now = int(time.time())
+        payload_entry = dict(entry)
+        identifier = uuid.UUID(payload_entry.pop('id'))
+        url = url_of(entry) or ''
+        doi = entry.get('doi') or ''
+
+        flags = 0
+        if msgpack is not None:
+            payload = msgpack.packb(payload_entry, use_bin_type=True)
+            flags |= FLAG_MSGPACK
+        else:
+            payload = json.dumps(payload_entry).encode(encoding='UTF-8')
+        if self.compression == 'zstd':
+            payload = self._compressor().compress(payload)
+            flags |= FLAG_ZSTD
+            if self.dictionary is not None:
+                flags |= FLAG_ZSTD_DICT
+
+        canonical_bytes = b''
+        if canonical is not None:
+            canonical_bytes = uuid.UUID(canonical).bytes
+            flags |= FLAG_CANONICAL
+
+        url_bytes = url.encode(encoding='UTF-8')
+        doi_bytes = doi.encode(encoding='UTF-8')
+        if len(url_bytes) > max_field_size or len(doi_bytes) > max_field_size:
+            # both are still in the payload
+            flags |= FLAG_LONG_FIELDS
+            if len(url_bytes) > max_field_size:
+                url_bytes = b''
+            if len(doi_bytes) > max_field_size:
+                doi_bytes = b''
+        return b''.join([header.pack(magic, version, flags, status, identifier.bytes, created or now, now), canonical_bytes,
+                         length.pack(len(url_bytes)), url_bytes, length.pack(len(doi_bytes)), doi_bytes, payload])
+
+    def decode(self, value):
+        """
+        Return a lazy record for a stored value, compact or pickled
+        """
+        if is_compact(value):
+            return Record(value, self)
+        return PickledRecord(value)
+
+    def decode_payload(self, payload, flags):
+        if flags & FLAG_ZSTD:
+            if flags & FLAG_ZSTD_DICT and self.dictionary is None:
+                raise ValueError("the record payload requires the zstd dictionary " + str(self.dictionary_path))
+            payload = self._decompressor(flags & FLAG_ZSTD_DICT).decompress(payload)
+        if flags & FLAG_MSGPACK:
+            if msgpack is None:
+                raise ImportError("decoding these records requires msgpack, install it with: pip3 install msgpack")
+            return msgpack.unpackb(payload, raw=False)
+        return json.loads(payload)
+
+    def _compressor(self):
+        compressor = getattr(self.local, 'compressor', None)
+        if compressor is None:
+            compressor = zstandard.ZstdCompressor(dict_data=self.dictionary)
+            self.local.compressor = compressor
+        return compressor
+
+    def _decompressor(self, with_dictionary):
+        name = 'dict_decompressor' if with_dictionary else 'decompressor'
+        decompressor = getattr(self.local, name, None)
+        if decompressor is None:
+            decompressor = zstandard.ZstdDecompressor(dict_data=self.dictionary if with_dictionary else None)
+            setattr(self.local, name, decompressor)
+        return decompressor
+
+    def train_dictionary(self, entries):
+        """
+        Train a zstd dictionary on a sample of entries and save it under record_dictionary
+        """
+        samples = []
+        for entry in entries:
+            payload_entry = dict(entry)
+            payload_entry.pop('id', None)
+            if msgpack is not None:
+                samples.append(msgpack.packb(payload_entry, use_bin_type=True))
+            else:
+                samples.append(json.dumps(payload_entry).encode(encoding='UTF-8'))
+        self.dictionary = zstandard.train_dictionary(dictionary_size, samples)
+        with open(self.dictionary_path, 'wb') as f:
+            f.write(self.dictionary.as_bytes())
+        # compressors created with the previous dictionary are obsolete
+        self.local = threading.local()
+
+class Record(object):
+    """
+    Lazy view on a compact record
+    """
+
+    def __init__(self, value, codec):
+        self.value = value
+        self.codec = codec
+        _, self.version, self.flags, self.status, uuid_bytes, self.created, self.updated = header.unpack_from(value)
+        self.uuid_bytes = uuid_bytes
+        position = header.size
+        self.canonical_bytes = None
+        if self.flags & FLAG_CANONICAL:
+            self.canonical_bytes = value[position:position+16]
+            position += 16
+        url_length, = length.unpack_from(value, position)
+        position += length.size
+        self.url_bytes = value[position:position+url_length]
+        position += url_length
+        doi_length, = length.unpack_from(value, position)
+        position += length.size
+        self.doi_bytes = value[position:position+doi_length]
+        self.payload_offset = position + doi_length
+
+    @property
+    def id(self):
+        return str(uuid.UUID(bytes=bytes(self.uuid_bytes)))
+
+    @property
+    def canonical(self):
+        if self.canonical_bytes is None:
+            return None
+        return str(uuid.UUID(bytes=bytes(self.canonical_bytes)))
+
+    @property
+    def url(self):
+        if self.flags & FLAG_LONG_FIELDS and len(self.url_bytes) == 0:
+            return url_of(self.entry())
+        return bytes(self.url_bytes).decode(encoding='UTF-8') or None
+
+    @property
+    def doi(self):
+        if self.flags & FLAG_LONG_FIELDS and len(self.doi_bytes) == 0:
+            return self.entry().get('doi')
+        return bytes(self.doi_bytes).decode(encoding='UTF-8') or None
+
+    def entry(self):
+        """
+        Decode the complete entry, with its uuid as 'id'
+        """
+        entry = self.codec.decode_payload(bytes(self.value[self.payload_offset:]), self.flags)
+        entry['id'] = self.id
+        return entry
+
+class PickledRecord(object):
+    """
+    Same interface as Record for the pickled entries of the previous versions
+    """
+
+    def __init__(self, value):
+        self._entry = pickle.loads(value)
+        self.status = None
+        self.created = None
+        self.updated = None
+        self.canonical = None
+
+    @property
+    def id(self):
+        return self._entry['id']
+
+    @property
+    def url(self):
+        return url_of(self._entry)
+
+    @property
+    def doi(self):
+        return self._entry.get('doi')
+
+    def entry(self):
+        return dict(self._entry)
+
+def is_compact(value):
+    return bytes(value[:3]) == magic
+
+def with_status(value, status):
+    """
+    Return a compact record with a new status and update time, without decoding the payload
+    """
+    record = bytearray(value)
+    record[status_offset] = status
+    struct.pack_into('>I', record, updated_offset, int(time.time()))
+    return bytes(record)
+
+def url_of(entry):
+    """
+    PDF url of an entry dict, None if it has none
+    """
+    location = entry.get('best_oa_location')
+    if location is None:
+        return None
+    return location.get('url_for_pdf')
+
+def encode_failure(error, url, filename, doi=None, category=None, retries=0, next_retry=None):
+    failure = { 'error': error, 'class': error_class(error), 'url': url, 'filename': filename, 
+                'doi': doi, 'time': int(time.time()), 'category': category, 'retries': retries, 
+                'next_retry': next_retry }
+    return json.dumps(failure).encode(encoding='UTF-8')
+
+def decode_failure(value):
+    """
+    Return the failure record of a fail lmdb value, the previous versions only stored the error, then
+    no retry state: these failures are eligible for a retry, their category being None
+    """
+    if bytes(value[:1]) == b'{':
+        failure = json.loads(bytes(value))
+        if 'retries' not in failure:
+            failure.update({ 'category': None, 'retries': 0, 'next_retry': 0 })
+        return failure
+    error = bytes(value).decode(encoding='UTF-8')
+    return { 'error': error, 'class': error_class(error), 'url': None, 'filename': None, 'doi': None, 'time': None,
+             'category': None, 'retries': 0, 'next_retry': 0 }
+
+def error_class(error):
+    """
+    Class of a download error: protocol and status code for http and ftp errors (e.g. http:404), 
+    the error type otherwise (e.g. timeout, dns)
+    """
+    tokens = error.split(':')
+    if tokens[0] in ('http', 'ftp') and len(tokens) > 1:
+        return tokens[0] + ':' + tokens[1].strip()
+    return tokens[0].strip().replace(' ', '_')
+
+def failure_host(failure):
+    try:
+        return urlparse(failure['url'] or '').hostname or ''
+    except ValueError:
+        return ''
+
+# prefixes of the keys of the fail index
+INDEX_CLASS = b'c'
+INDEX_HOST = b'h'
+
+def failure_index_keys(identifier, failure):
+    """
+    Keys of a failure in the fail index, identifier being the uuid as bytes
+    """
+    return [index_prefix(INDEX_CLASS, failure['class']) + identifier, 
+            index_prefix(INDEX_HOST, failure_host(failure)) + identifier]
+
+def index_prefix(kind, name):
+    return kind + name.encode(encoding='UTF-8') + b'\x00'
@@ -0,0 +1,152 @@
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy
+
+"""
+Resume accelerator for the harvesting of large input files.
+
+- Checkpoint keeps track of the byte offset in the (decompressed) input before which all the entries
+  have been committed in LMDB, and persists it after each commit, so that a resumed harvesting can
+  seek directly past the completed work.
+
+- DoiIndex is a compact in-memory membership structure (sorted array of 64 bits DOI hashes) built
+  from the doi lmdb, completed with the entries submitted during the run, for checking the remaining
+  lines without any LMDB transaction per line.
+"""
+
+checkpoint_file = "checkpoint.json"
+
+class Checkpoint(object):
+
+    def __init__(self, data_path, input_path):
+        self.path = os.path.join(data_path, checkpoint_file)
+        self.input_name = os.path.basename(input_path)
+        self.input_size = os.path.getsize(input_path)
+        # submitted entries not yet committed: id -> (start offset, line number) of their input line
+        self.in_flight = OrderedDict()
+        # entries stored in the pending LMDB group, committed at the next flush
+        self.stored_ids = []
+        # (offset, line number) after the last input line handled by the reader
+        self.position = (0, 0)
+        self.lock = threading.Lock()
+
+    def start(self):
+        """
+        Return the (offset, line number) where the reading of the input can start, (0, 0) if
+        no checkpoint is available for this input
+        """
+        if os.path.isfile(self.path):
+            try:
+                with open(self.path) as f:
+                    state = json.load(f)
+                if state['input'] == self.input_name and state['input_size'] == self.input_size:
+                    self.position = (state['offset'], state['line'])
+            except (ValueError, KeyError) as e:
+                print("invalid checkpoint file, ignored:", str(e))
+        return self.position
+
+    def submit(self, identifier, offset, line):
+        """
+        Called by the reader for an entry sent to download, before moving to the next line
+        """
+        with self.lock:
+            self.in_flight[identifier] = (offset, line)
+
+    def advance(self, offset, line):
+        """
+        Called by the reader after having handled a line (submitted or skipped)
+        """
+        self.position = (offset, line)
+
+    def stored(self, identifier):
+        """
+        Called by the writer stage when the entry is added to the pending LMDB writes
+        """
+        self.stored_ids.append(identifier)
+
+    def commit(self):
+        """
+        Called by the writer stage after the pending LMDB writes have been committed
+        """
+        with self.lock:
+            for identifier in self.stored_ids:
+                self.in_flight.pop(identifier, None)
+            self.stored_ids = []
+            if self.in_flight:
+                # all the lines before the oldest uncommitted entry are completed
+                offset, line = next(iter(self.in_flight.values()))
+            else:
+                offset, line = self.position
+        state = { "input": self.input_name, "input_size": self.input_size, "offset": offset, "line": line }
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.path)
+
+    def reset(self):
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+
+class DoiIndex(object):
+    """
+    Sorted array of the 64 bits hashes of the DOI (or pmcid) keys of the doi lmdb, 8 bytes per entry.
+    A false positive requires a 64 bits hash collision, which is negligible at our scale. The DOI
+    submitted during the run are appended to a small buffer, scanned linearly, which is sorted into
+    an array of recent hashes when full. The recent hashes are merged into the main array when they
+    reach a fraction of its size, so that the additions also cost 8 bytes per entry and a merge of
+    the main array is rare.
+    """
+
+    # number of added hashes before sorting them into the recent hashes
+    buffer_size = 4096
+    # the recent hashes are merged into the main array above this fraction of its size
+    recent_fraction = 16
+
+    def __init__(self, env_doi):
+        with env_doi.begin() as txn:
+            nb_entries = txn.stat()['entries']
+            cursor = txn.cursor()
+            hashes = numpy.fromiter((doi_hash(key) for key in cursor.iternext(values=False)),
+                                    dtype=numpy.uint64, count=nb_entries)
+        hashes.sort()
+        self.hashes = hashes
+        # sorted hashes of the DOI submitted during the run, not yet merged into the main array
+        self.recent = numpy.empty(0, dtype=numpy.uint64)
+        # hashes of the last DOI submitted during the run, unsorted
+        self.buffer = numpy.empty(self.buffer_size, dtype=numpy.uint64)
+        self.nb_buffered = 0
+
+    def __len__(self):
+        return len(self.hashes) + len(self.recent) + self.nb_buffered
+
+    def add(self, doi):
+        self.buffer[self.nb_buffered] = doi_hash(doi.encode(encoding='UTF-8'))
+        self.nb_buffered += 1
+        if self.nb_buffered == self.buffer_size:
+            self.recent = _merge_sorted(self.recent, numpy.sort(self.buffer))
+            self.nb_buffered = 0
+            if len(self.recent) * self.recent_fraction > len(self.hashes):
+                self.hashes = _merge_sorted(self.hashes, self.recent)
+                self.recent = numpy.empty(0, dtype=numpy.uint64)
+
+    def __contains__(self, doi):
+        value = numpy.uint64(doi_hash(doi.encode(encoding='UTF-8')))
+        return (_sorted_contains(self.hashes, value) or _sorted_contains(self.recent, value) or
+                bool((self.buffer[:self.nb_buffered] == value).any()))
+
+def _sorted_contains(array, value):
+    position = numpy.searchsorted(array, value)
+    return position < len(array) and array[position] == value
+
+def _merge_sorted(first, second):
+    merged = numpy.concatenate((first, second))
+    # the stable sort (timsort) merges the two sorted runs in linear time
+    merged.sort(kind='stable')
+    return merged
+
+def doi_hash(key):
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'little')
@@ -0,0 +1,165 @@
+import time
+import random
+import threading
+
+import HostScheduler
+
+"""
+Retry policy of the failed downloads.
+
+A download error is classified into a retry category:
+
+- transient: timeouts, connection errors, server errors (HTTP 5xx, 408), truncated PDF, ...
+- throttled: the host is limiting our requests (HTTP 429 and 503, connection refused), as for the
+  per-host scheduler
+- permanent: dead links and client errors (HTTP 4xx, FTP 550), TLS errors, too many redirections
+- content-invalid: the server answered, but not with a PDF (HTML landing page, empty or not PDF file,
+  PMC archive without PDF)
+
+Transient and throttled failures are recoverable: they are first retried within the run, up to
+retry_in_run times (default 2) after a short delay (retry_in_run_delay, default 5 seconds, doubled
+at each attempt), the host scheduler keeping on with the other jobs meanwhile. A failure still
+recoverable at the end of these attempts is stored with its number of retries and the earliest time
+of its next retry, following an exponential backoff from retry_backoff seconds (default one hour) up
+to retry_backoff_max (default one week). After retry_max stored retries (default 5), the failure is
+given up. The delays have a random jitter (between half and the full delay), so that the retries of
+the failures of a same host are spread over time.
+
+Permanent and content-invalid failures are never retried automatically.
+"""
+
+TRANSIENT = "transient"
+THROTTLED = "throttled"
+PERMANENT = "permanent"
+CONTENT_INVALID = "content-invalid"
+
+recoverable_categories = (TRANSIENT, THROTTLED)
+
+def category(error):
+    """
+    Retry category of a download error string
+    """
+    if error is None or error == "0":
+        return None
+    if HostScheduler.is_throttling(error):
+        return THROTTLED
+    tokens = error.split(':')
+    kind = tokens[0].strip()
+    detail = tokens[1].strip() if len(tokens) > 1 else ""
+    if kind == "http":
+        if detail == "408" or detail.startswith("5"):
+            return TRANSIENT
+        return PERMANENT
+    if kind == "ftp":
+        # 4xx FTP replies are transient, 5xx permanent (e.g. 550 file not found)
+        if detail.startswith("4"):
+            return TRANSIENT
+        return PERMANENT
+    if kind in ("tls", "redirect"):
+        return PERMANENT
+    if kind == "pdf":
+        # a truncated file is usually an interrupted transfer
+        if detail == "truncated":
+            return TRANSIENT
+        return CONTENT_INVALID
+    if kind in ("archive", "empty file"):
+        return CONTENT_INVALID
+    # timeout, connection, dns, io, request, and unexpected exceptions
+    return TRANSIENT
+
+def is_recoverable(error):
+    return category(error) in recoverable_categories
+
+class RetryPolicy(object):
+
+    def __init__(self, config):
+        self.max_retries = config.get('retry_max', 5)
+        # in seconds
+        self.backoff = config.get('retry_backoff', 3600)
+        self.backoff_max = config.get('retry_backoff_max', 7 * 24 * 3600)
+        self.max_in_run = config.get('retry_in_run', 2)
+        self.in_run_delay = config.get('retry_in_run_delay', 5)
+        self.random = random.Random()
+
+    def delay(self, retries, base, maximum=None):
+        """
+        Exponential backoff delay in seconds before the retry number retries (starting at 0),
+        with a random jitter between half and the full delay
+        """
+        delay = base * (2 ** retries)
+        if maximum is not None:
+            delay = min(maximum, delay)
+        return delay / 2 + self.random.uniform(0, delay / 2)
+
+    def schedule(self, error, previous=None, url=None):
+        """
+        Return the (category, retries, next_retry) of a new failure, previous being the failure record
+        it replaces, if any. next_retry is the epoch time from which the failure can be retried, None
+        if it must not be retried automatically.
+        """
+        failure_category = category(error)
+        retries = 0
+        if previous is not None and (url is None or previous.get('url') in (None, url)):
+            # the same url failed again, a new url starts a new series of retries
+            retries = previous.get('retries', 0) + 1
+        next_retry = None
+        if failure_category in recoverable_categories and retries < self.max_retries:
+            next_retry = int(time.time() + self.delay(retries, self.backoff, self.backoff_max))
+        return failure_category, retries, next_retry
+
+    def is_eligible(self, failure, now=None):
+        """
+        Indicate if a stored failure record can be retried now
+        """
+        failure_category = failure.get('category') or category(failure['error'])
+        if failure_category not in recoverable_categories:
+            return False
+        next_retry = failure.get('next_retry', 0)
+        if next_retry is None:
+            # given up after retry_max retries
+            return False
+        return next_retry <= (now or time.time())
+
+    def status(self, failure, now=None):
+        """
+        Retry status of a stored failure record: its category, qualified for the recoverable ones by
+        whether they can be retried now, later, or are given up
+        """
+        failure_category = failure.get('category') or category(failure['error'])
+        if failure_category not in recoverable_categories:
+            return failure_category
+        if self.is_eligible(failure, now):
+            return failure_category + " (eligible)"
+        if failure.get('next_retry') is None:
+            return failure_category + " (given up)"
+        return failure_category + " (scheduled)"
+
+class InRunRetries(object):
+    """
+    Counts the attempts of the download jobs of a run, to decide if a failed job is queued again
+    in the scheduler. Called by the download workers.
+    """
+
+    def __init__(self, policy):
+        self.policy = policy
+        # number of retries by entry uuid, only for the jobs being retried
+        self.attempts = {}
+        self.lock = threading.Lock()
+
+    def delay(self, job, error):
+        """
+        Return the delay in seconds after which the failed job is retried, or None if the result
+        of the job is final
+        """
+        identifier = job[2]['id']
+        if error == "0" or not is_recoverable(error):
+            with self.lock:
+                self.attempts.pop(identifier, None)
+            return None
+        with self.lock:
+            attempt = self.attempts.get(identifier, 0)
+            if attempt >= self.policy.max_in_run:
+                self.attempts.pop(identifier, None)
+                return None
+            self.attempts[identifier] = attempt + 1
+        return self.policy.delay(attempt, self.policy.in_run_delay)
@@ -1,9 +1,21 @@
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from boto3 import client
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+
+from Metrics import metrics
 
 """
 This is derived from:
 https://gist.github.com/freewayz/1fbd00928058c3d682a0e25367cc8ea4
+
+Uploads can be queued with submit_upload(), they are then realized concurrently by a pool of upload 
+workers independent from the download workers, sharing the same client and connection pool. Most of the 
+harvested objects are small, so the parallelism comes from uploading several files at the same time 
+rather than from multipart transfers. An S3 compatible endpoint (e.g. minio or moto server) can be 
+indicated with s3_endpoint_url in the config. 
 """
 
 class S3(object):
@@ -15,10 +27,30 @@ class S3(object):
         else:
             region = "us-west-2"
         self.bucket_name = self.config['bucket_name']
+
+        self.upload_workers = self.config.get('s3_upload_workers', 16)
+        # max concurrent threads for the parts of one multipart upload
+        max_concurrency = self.config.get('s3_max_concurrency', 4)
+        # the connection pool is shared by all the upload workers and their multipart threads
+        pool_size = self.config.get('s3_max_pool_connections', self.upload_workers * max_concurrency)
         self.conn = client('s3', 
                             region_name=region, 
+                            endpoint_url=self.config.get('s3_endpoint_url') or None,
                             aws_access_key_id=self.config['aws_access_key_id'],
-                            aws_secret_access_key=self.config['aws_secret_access_key'])
+                            aws_secret_access_key=self.config['aws_secret_access_key'],
+                            config=Config(max_pool_connections=pool_size))
+
+        self.transfer_config = TransferConfig(
+                            multipart_threshold=self.config.get('s3_multipart_threshold', 16 * 1024 * 1024),
+                            multipart_chunksize=self.config.get('s3_multipart_chunksize', 16 * 1024 * 1024),
+                            max_concurrency=max_concurrency,
+                            use_threads=max_concurrency > 1)
+
+        # upload work queue, bounded so that submit_upload() blocks when the uploads are late
+        self.executor = ThreadPoolExecutor(max_workers=self.upload_workers)
+        self.queue_slots = threading.BoundedSemaphore(self.config.get('s3_upload_queue', 1000))
+        self.nb_pending = 0
+        self.pending_condition = threading.Condition()
 
     def upload_file_to_s3(self, file_path, dest_path=None, storage_class='STANDARD_IA'):
         """
@@ -36,7 +68,46 @@ class S3(object):
                 full_path = dest_path + "/" + file_name
         else:
             full_path = file_name
-        s3_client.upload_file(file_path, self.bucket_name, full_path, ExtraArgs={"Metadata": {"StorageClass": storage_class}})
+        s3_client.upload_file(file_path, self.bucket_name, full_path, ExtraArgs={"StorageClass": storage_class}, 
+                              Config=self.transfer_config)
+
+    def submit_upload(self, file_path, dest_path=None, storage_class='STANDARD_IA', callback=None):
+        """
+        Queue the upload of a file, to be realized concurrently with the other queued uploads. 
+        Block if the upload queue is full. If provided, callback(file_path, error) is called when the upload 
+        is completed, with error None if successful.
+        """
+        self.queue_slots.acquire()
+        with self.pending_condition:
+            self.nb_pending += 1
+        return self.executor.submit(self._upload_task, file_path, dest_path, storage_class, callback)
+
+    def _upload_task(self, file_path, dest_path, storage_class, callback):
+        error = None
+        try:
+            with metrics.timer("upload_seconds"):
+                self.upload_file_to_s3(file_path, dest_path, storage_class=storage_class)
+            metrics.inc("uploaded_bytes", os.path.getsize(file_path))
+        except Exception as e:
+            print("upload failed for", file_path, ":", str(e))
+            metrics.inc("upload_errors")
+            error = e
+        try:
+            if callback is not None:
+                callback(file_path, error)
+        finally:
+            self.queue_slots.release()
+            with self.pending_condition:
+                self.nb_pending -= 1
+                self.pending_condition.notify_all()
+
+    def wait_uploads(self):
+        """
+        Block until all the queued uploads are completed
+        """
+        with self.pending_condition:
+            while self.nb_pending > 0:
+                self.pending_condition.wait()
 
     def upload_object(self, body, s3_key, storage_class='STANDARD_IA'):
         """
@@ -45,7 +116,21 @@ class S3(object):
         Possible storage classes are: STANDARD, STANDARD_IA, REDUCED_REDUNDANCY or ONEZONE_IA
         """
         s3_client = self.conn
-        return s3_client.put_object(Body=body, Key=s3_key, ExtraArgs={"Metadata": {"StorageClass": storage_class}})
+        return s3_client.put_object(Body=body, Bucket=self.bucket_name, Key=s3_key, StorageClass=storage_class)
+
+    def get_range(self, s3_key, offset, size):
+        """
+        Return size bytes of an object from offset, with a range request
+        """
+        response = self.conn.get_object(Bucket=self.bucket_name, Key=s3_key, 
+                                        Range="bytes=%d-%d" % (offset, offset + size - 1))
+        return response['Body'].read()
+
+    def object_size(self, s3_key):
+        return self.conn.head_object(Bucket=self.bucket_name, Key=s3_key)['ContentLength']
+
+    def delete_object(self, s3_key):
+        return self.conn.delete_object(Bucket=self.bucket_name, Key=s3_key)
 
     def download_file(self, file_path, dest_path):
         """
@@ -0,0 +1,158 @@
+import os
+import glob
+import shutil
+
+import lmdb
+
+import Records
+from Resume import doi_hash
+from Storage import generateS3Path
+
+"""
+Deterministic partition of the harvesting over several processes or machines.
+
+With --shard i/N, a harvester only processes the entries whose DOI (or pmcid for PMC) hash modulo N
+is i, so that N harvesters reading the same input share the work without coordination, and keeps its
+state (lmdb environments, checkpoint, URL cache and downloaded files) in its own directory
+shard-i-of-N under data_path.
+
+The shard directories are then combined by merge() into the stores of data_path, from which the
+dump is realized as for a single harvester. As the DOI are partitioned, the keys of the shards are
+disjoint, except the PDF content hashes: a PDF harvested by several shards keeps the canonical entry of
+the first merged shard, and the canonical entries of the other shards become duplicates of it (their
+local files are removed, not the files already uploaded to S3).
+"""
+
+# lmdb environments of the harvesting state, merged in this order (the hash before the entries)
+merged_envs = ('hash', 'entries', 'doi', 'fail', 'fail_index')
+
+# shard files and directories which are not merged
+state_names = set(merged_envs) | { 'url_cache', 'increment', 'checkpoint.json', 'pack_index', 'packs' }
+
+# number of records written per merge transaction
+merge_batch_size = 10000
+
+def parse_shard(value):
+    """
+    "3/16" -> (3, 16)
+    """
+    index, _, count = value.partition('/')
+    try:
+        index, count = int(index), int(count)
+    except ValueError:
+        raise ValueError("invalid shard " + value + ", expected i/N, e.g. 0/4")
+    if count < 1 or index < 0 or index >= count:
+        raise ValueError("invalid shard " + value + ", i must be between 0 and N-1")
+    return index, count
+
+def shard_data_path(data_path, shard):
+    return os.path.join(data_path, "shard-%d-of-%d" % shard)
+
+def in_shard(doi, shard):
+    """
+    Indicate if the entry with the given DOI (or pmcid) belongs to the shard
+    """
+    if shard is None:
+        return True
+    return doi_hash(doi.encode(encoding='UTF-8')) % shard[1] == shard[0]
+
+def shard_paths(data_path):
+    """
+    Shard directories present under data_path, in shard order
+    """
+    paths = glob.glob(os.path.join(data_path, "shard-*-of-*"))
+    return sorted(paths, key=lambda path: int(os.path.basename(path).split('-')[1]))
+
+def merge(config, envs, paths, packs=None):
+    """
+    Merge the harvesting state and the files of the shard directories into data_path, envs giving
+    the lmdb environments of data_path by name, and packs the pack storage of data_path if used. 
+    Return the number of merged entries.
+    """
+    codec = Records.RecordCodec(config)
+    nb_entries = 0
+    for path in paths:
+        print("merging", path)
+        # canonical uuid of the shard -> canonical uuid already merged for the same PDF
+        canonicals = {}
+        for name in merged_envs:
+            envFilePath = os.path.join(path, name)
+            if not os.path.isdir(envFilePath):
+                continue
+            env_shard = lmdb.open(envFilePath, readonly=True, lock=False)
+            with env_shard.begin() as txn_shard:
+                if name == 'hash':
+                    _merge_hashes(envs[name], txn_shard, canonicals)
+                elif name == 'entries':
+                    nb_entries += _merge_records(envs[name], txn_shard,
+                        lambda key, value: _merged_entry(codec, value, canonicals))
+                else:
+                    _merge_records(envs[name], txn_shard)
+            env_shard.close()
+        for identifier in canonicals:
+            _remove_files(path, identifier)
+        if packs is not None:
+            packs.merge(path)
+        _move_files(path, config["data_path"])
+    return nb_entries
+
+def _merge_records(env, txn_shard, convert=None):
+    n = 0
+    batch = []
+    for key, value in txn_shard.cursor():
+        if convert is not None:
+            value = convert(key, value)
+        batch.append((key, value))
+        if len(batch) == merge_batch_size:
+            n += _write(env, batch)
+            batch = []
+    return n + _write(env, batch)
+
+def _merge_hashes(env, txn_shard, canonicals):
+    with env.begin(write=True) as txn:
+        for content_hash, identifier in txn_shard.cursor():
+            merged = txn.get(content_hash)
+            if merged is None:
+                txn.put(content_hash, identifier)
+            elif merged != identifier:
+                canonicals[identifier.decode(encoding='UTF-8')] = merged.decode(encoding='UTF-8')
+
+def _merged_entry(codec, value, canonicals):
+    if not canonicals or not Records.is_compact(value):
+        return value
+    record = codec.decode(value)
+    canonical = canonicals.get(record.canonical or record.id)
+    if canonical is None:
+        return value
+    entry = record.entry()
+    entry['id'] = record.id
+    return codec.encode(entry, record.status, created=record.created, canonical=canonical)
+
+def _write(env, batch):
+    with env.begin(write=True) as txn:
+        for key, value in batch:
+            txn.put(key, value)
+    return len(batch)
+
+def _remove_files(path, identifier):
+    # the files of a shard canonical entry which is a duplicate after the merge, downloaded or in the
+    # local storage (see generateS3Path)
+    prefix = generateS3Path(identifier)
+    for pattern in (os.path.join(path, identifier + "*"), os.path.join(path, prefix, identifier + "*")):
+        for f in glob.glob(pattern):
+            os.remove(f)
+
+def _move_files(path, data_path):
+    """
+    Move the downloaded and stored files of a shard to the same relative path under data_path
+    """
+    for name in os.listdir(path):
+        if name in state_names:
+            continue
+        source = os.path.join(path, name)
+        destination = os.path.join(data_path, name)
+        if os.path.isdir(source) and os.path.isdir(destination):
+            _move_files(source, destination)
+            shutil.rmtree(source, ignore_errors=True)
+        else:
+            shutil.move(source, destination)
@@ -0,0 +1,160 @@
+import os
+import errno
+import shutil
+import threading
+from collections import OrderedDict
+
+"""
+Local storage of the harvested resources, used when no S3 bucket is configured.
+
+The resources are stored under data_path in a tree of 4 levels of 2 characters prefixes of their
+UUID (see generateS3Path), the same layout as in the S3 bucket. The files are never copied when
+possible:
+
+- with direct placement (local_direct in the config file, default true), the downloads are written
+  directly into their final directory, so that storing them is a no-op,
+- otherwise the files are moved with an atomic rename when data_path is on a single filesystem, and
+  with an in-kernel copy (copy_file_range, or sendfile) when the temporary files are on another
+  filesystem.
+
+The prefix directories are created lazily. The parent directories (3 first levels), shared by many
+entries, are cached in a bounded LRU of the directories known to exist, so that only the last level,
+specific to an entry, is created with a single mkdir. With direct placement, the last level of a
+failed entry is removed with its files (see remove_directory).
+"""
+
+class LocalStorage(object):
+
+    def __init__(self, config):
+        self.data_path = config["data_path"]
+        # downloads written directly at their final location
+        self.direct = config.get('local_direct', True)
+        # parent directories known to exist, least recently used first
+        self.directories = OrderedDict()
+        self.max_directories = config.get('directory_cache_size', 65536)
+        self.lock = threading.Lock()
+
+    def directory(self, identifier):
+        """
+        Final directory of the resources of an entry, created if needed
+        """
+        path = os.path.join(self.data_path, generateS3Path(identifier))
+        parent = os.path.dirname(os.path.dirname(path))
+        with self.lock:
+            known = parent in self.directories
+            if known:
+                self.directories.move_to_end(parent)
+        if not known:
+            os.makedirs(parent, exist_ok=True)
+            with self.lock:
+                self.directories[parent] = True
+                if len(self.directories) > self.max_directories:
+                    self.directories.popitem(last=False)
+        try:
+            os.mkdir(path)
+        except FileExistsError:
+            pass
+        except FileNotFoundError:
+            # the cached parent has just been removed as empty by another worker
+            os.makedirs(path, exist_ok=True)
+        return path
+
+    def remove_directory(self, identifier):
+        """
+        Remove the final directory of an entry if it is empty, e.g. created for a failed download,
+        and then its parent directories left empty, up to data_path
+        """
+        path = os.path.dirname(os.path.join(self.data_path, generateS3Path(identifier)))
+        root = os.path.normpath(self.data_path)
+        while os.path.normpath(path) != root:
+            try:
+                os.rmdir(path)
+            except OSError:
+                # not empty, or already removed
+                return
+            with self.lock:
+                self.directories.pop(path, None)
+            path = os.path.dirname(path)
+
+    def download_path(self, identifier, extension):
+        """
+        Path where the resource of an entry is downloaded
+        """
+        if self.direct:
+            return os.path.join(self.directory(identifier), identifier + extension)
+        return os.path.join(self.data_path, identifier + extension)
+
+    def store(self, local_file, identifier):
+        """
+        Move a downloaded or generated file of an entry to its final location, if not already there
+        """
+        destination = os.path.join(self.directory(identifier), os.path.basename(local_file))
+        if local_file != destination:
+            move_file(local_file, destination)
+
+    def flush(self):
+        # the files are stored as soon as they are moved
+        pass
+
+def move_file(source, destination):
+    """
+    Move a file with an atomic rename on the same filesystem, otherwise with an in-kernel copy
+    """
+    try:
+        os.replace(source, destination)
+        return
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+    tmp_destination = destination + ".tmp"
+    copy_file(source, tmp_destination)
+    os.replace(tmp_destination, destination)
+    os.remove(source)
+
+def copy_file(source, destination):
+    """
+    Copy a file without going through user space buffers when the system allows it
+    """
+    with open(source, 'rb') as f_in, open(destination, 'wb') as f_out:
+        size = os.fstat(f_in.fileno()).st_size
+        for copy in (_copy_file_range, _sendfile):
+            try:
+                if copy(f_in.fileno(), f_out.fileno(), size):
+                    return
+            except OSError as e:
+                # not supported for these filesystems, the next method is tried from the beginning
+                if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                    raise
+            f_in.seek(0)
+            f_out.seek(0)
+            f_out.truncate()
+        shutil.copyfileobj(f_in, f_out, 1024 * 1024)
+
+def _copy_file_range(fd_in, fd_out, size):
+    if not hasattr(os, 'copy_file_range'):
+        return False
+    copied = 0
+    while copied < size:
+        n = os.copy_file_range(fd_in, fd_out, size - copied)
+        if n == 0:
+            break
+        copied += n
+    return copied == size
+
+def _sendfile(fd_in, fd_out, size):
+    if not hasattr(os, 'sendfile'):
+        return False
+    copied = 0
+    while copied < size:
+        n = os.sendfile(fd_out, fd_in, copied, size - copied)
+        if n == 0:
+            break
+        copied += n
+    return copied == size
+
+def generateS3Path(filename):
+    '''
+    Convert a file name into a path with file prefix as directory paths:
+    123456789 -> 12/34/56/123456789
+    '''
+    return filename[:2] + '/' + filename[2:4] + '/' + filename[4:6] + "/" + filename[6:8] + "/"
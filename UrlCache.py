@@ -0,0 +1,94 @@
+import json
+import time
+import threading
+from urllib.parse import urlsplit, urlunsplit
+
+"""
+Persistent cache of the responses to the PDF URLs, kept across runs in an lmdb keyed by normalized URL.
+
+For a successful download, the cache keeps the final URL after redirections, which is then requested
+directly, the ETag and Last-Modified validators of the response and the content hash of the body. A new
+download of the same URL is then a conditional request: when the server answers 304 Not Modified and
+the content is already harvested, the body is not transferred again and the download is resolved by
+deduplication to the already stored PDF.
+
+Hard failures (HTTP 404 and 410) are kept as negative entries for negative_ttl seconds, during which
+the URL is not requested again. Expired negative entries are removed when they are looked up.
+"""
+
+# status of the failures kept as negative entries
+negative_status = ("http:404", "http:410")
+
+default_ports = { "http": 80, "https": 443 }
+
+class UrlCache(object):
+
+    def __init__(self, env, config):
+        # lmdb environment of the cache, which is not a critical state (opened without fsync)
+        self.env = env
+        # in seconds, default one week
+        self.negative_ttl = config.get('url_cache_negative_ttl', 7 * 24 * 3600)
+        self.lock = threading.Lock()
+
+    def get(self, url):
+        """
+        Return the cache entry of the url as a dict, or None
+        """
+        key = _key(url)
+        if key is None:
+            return None
+        with self.env.begin() as txn:
+            value = txn.get(key)
+        if value is None:
+            return None
+        cached = json.loads(value)
+        if cached.get('status') is not None and cached.get('expires', 0) < time.time():
+            # expired negative entry
+            with self.lock, self.env.begin(write=True) as txn:
+                txn.delete(key)
+            return None
+        return cached
+
+    def put_success(self, url, final_url, etag, last_modified, content_hash):
+        self._put(url, { 'final_url': final_url if final_url != url else None, 'etag': etag,
+            'last_modified': last_modified, 'hash': content_hash.hex() if content_hash is not None else None,
+            'time': int(time.time()) })
+
+    def put_failure(self, url, status):
+        """
+        Record the failure of a download, only hard failures are kept as negative entries
+        """
+        if status in negative_status:
+            now = int(time.time())
+            self._put(url, { 'status': status, 'time': now, 'expires': now + self.negative_ttl })
+
+    def _put(self, url, cached):
+        key = _key(url)
+        if key is None:
+            return
+        # write transactions are serialized by lmdb, the lock avoids blocking several threads on it
+        with self.lock, self.env.begin(write=True) as txn:
+            txn.put(key, json.dumps(cached).encode(encoding='UTF-8'))
+
+def normalize_url(url):
+    """
+    Lower case scheme and host, without default port nor fragment
+    """
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or '').lower()
+    if parts.port is not None and parts.port != default_ports.get(scheme):
+        host += ":" + str(parts.port)
+    if parts.username is not None:
+        host = parts.username + (":" + parts.password if parts.password else "") + "@" + host
+    return urlunsplit((scheme, host, parts.path or "/", parts.query, ""))
+
+def _key(url):
+    try:
+        key = normalize_url(url).encode(encoding='UTF-8')
+    except ValueError:
+        return None
+    # lmdb max key size
+    if len(key) > 511:
+        return None
+    return key
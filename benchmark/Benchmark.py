@@ -0,0 +1,260 @@
+import os
+import sys
+import json
+import math
+import time
+import shutil
+import socket
+import argparse
+import subprocess
+
+benchmark_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(benchmark_path))
+sys.path.insert(0, benchmark_path)
+
+import Generate
+
+"""
+Reproducible benchmark of the harvester against the local stand-in servers (see Servers.py), with
+synthetic inputs (see Generate.py).
+
+The scenarios are run in sequence, each in its own process so that its CPU time and peak memory (RSS)
+are measured separately:
+
+- unpaywall: harvestUnpaywall on a synthetic snapshot, from an empty data_path,
+- reprocess: reprocessFailed on the recoverable failures of the previous scenario (transient errors succeed),
+- dump: dump of the entries of the previous scenarios, in gzipped JSONL,
+- pmc: harvestPMC on a synthetic PMC file list, over HTTP (or FTP with --ftp).
+
+For each scenario, the report gives the number of documents (downloads, or dumped entries), the
+documents and bytes per second, the p50 and p99 latency of a document download (computed from the
+latencies of all the downloads, and not from the histogram buckets of Metrics.py), the CPU time and
+the peak RSS. With --baseline, the report is compared with a previous report and the regressions
+beyond the threshold (throughput, latency or resources) are flagged, with a non zero exit status, so
+that a slower version is noticed before being deployed.
+"""
+
+scenarios = ("unpaywall", "reprocess", "dump", "pmc")
+
+# prefix of the result line of a scenario process
+result_marker = "BENCHMARK_RESULT "
+
+def run_scenario(scenario, config_path, input_path, async_mode):
+    """
+    Run a scenario in the current process, print its result line
+    """
+    import OAHarvester
+    from Metrics import metrics
+
+    harvester = OAHarvester.OAHarverster(config_path=config_path, async_mode=async_mode)
+
+    # latency of each download, recorded besides the metrics
+    latencies = []
+    record_download = metrics.download
+    def download(url, result, seconds):
+        latencies.append(seconds)
+        record_download(url, result, seconds)
+    metrics.download = download
+
+    start = time.monotonic()
+    if scenario == "unpaywall":
+        harvester.harvestUnpaywall(input_path)
+    elif scenario == "pmc":
+        harvester.harvestPMC(input_path)
+    elif scenario == "reprocess":
+        harvester.reprocessFailed()
+    elif scenario == "dump":
+        harvester.dump(input_path)
+    seconds = time.monotonic() - start
+
+    snapshot = metrics.snapshot()
+    counters = snapshot["counters"]
+    if scenario == "dump":
+        with harvester.env.begin() as txn:
+            nb_documents = txn.stat()['entries']
+    else:
+        nb_documents = sum(value for name, value in counters.items() if name.startswith("downloads{"))
+    latencies.sort()
+    result = { "documents": nb_documents, "seconds": round(seconds, 3),
+        "bytes": counters.get("downloaded_bytes", 0),
+        "errors": sum(value for name, value in counters.items() if name.startswith("downloads{") and "result=success" not in name),
+        "p50": percentile(latencies, 0.5), "p99": percentile(latencies, 0.99) }
+    print(result_marker + json.dumps(result), flush=True)
+
+def percentile(values, q):
+    """
+    Percentile q (in [0, 1]) of sorted values by the nearest-rank method, None if there is no value
+    """
+    if not values:
+        return None
+    rank = max(1, int(math.ceil(q * len(values))))
+    return round(values[rank - 1], 4)
+
+def measure(scenario, config_path, input_path, async_mode, log_path):
+    """
+    Run a scenario in a child process, return its result with its CPU time and peak RSS
+    """
+    command = [sys.executable, os.path.abspath(__file__), "--child", scenario, "--config", config_path, "--input", input_path]
+    if async_mode:
+        command.append("--async")
+    with open(log_path, 'w') as log:
+        process = subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT, cwd=os.path.dirname(benchmark_path))
+        # resource usage of this child only, and not of all the children as with getrusage
+        _, status, usage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+    result = None
+    with open(log_path) as log:
+        for line in log:
+            if line.startswith(result_marker):
+                result = json.loads(line[len(result_marker):])
+    if result is None:
+        raise RuntimeError("scenario " + scenario + " failed, see " + log_path)
+    result["cpu_seconds"] = round(usage.ru_utime + usage.ru_stime, 3)
+    # in KB on Linux
+    result["rss_mb"] = round(usage.ru_maxrss / 1024, 1)
+    result["documents_per_second"] = round(result["documents"] / result["seconds"], 2) if result["seconds"] > 0 else 0.0
+    result["mb_per_second"] = round(result["bytes"] / result["seconds"] / 1024 / 1024, 2) if result["seconds"] > 0 else 0.0
+    return result
+
+def start_servers(args, work_path):
+    command = [sys.executable, os.path.join(benchmark_path, "Servers.py"), "--port", str(args.port), "--hosts", str(args.hosts),
+        "--latency", str(args.latency), "--bandwidth", str(args.bandwidth), "--error-rate", str(args.error_rate),
+        "--transient-rate", str(args.transient_rate), "--html-rate", str(args.html_rate), "--redirect-rate", str(args.redirect_rate),
+        "--host-rate", str(args.host_rate), "--mean-size", str(args.mean_size)]
+    if args.s3:
+        command += ["--s3-port", str(args.port + 1), "--s3-keep"]
+    if args.ftp:
+        command += ["--ftp-port", str(args.port + 2), "--ftp-directory", os.path.join(work_path, "ftp")]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    line = process.stdout.readline()
+    if line.strip() != "ready":
+        process.kill()
+        raise RuntimeError("benchmark servers failed to start: " + line + process.stdout.read())
+    return process
+
+def harvester_config(args, work_path, data_path):
+    config = { "data_path": data_path, "aws_access_key_id": "", "aws_secret_access_key": "", "bucket_name": "", "region": "",
+        "batch_size": 100, "nb_workers": 12, "pmc_base": "http://127.0.0.1:%d/" % args.port,
+        # the recoverable failures are due immediately for the reprocess scenario
+        "retry_backoff": 0 }
+    if args.ftp:
+        config["pmc_base"] = "ftp://127.0.0.1:%d/" % (args.port + 2)
+    if args.s3:
+        config.update({ "aws_access_key_id": "benchmark", "aws_secret_access_key": "benchmark", "bucket_name": "benchmark",
+            "region": "us-east-1", "s3_endpoint_url": "http://127.0.0.1:%d" % (args.port + 1) })
+    if args.config is not None:
+        # tuned parameters (nb_workers, batch_size, host_max_concurrency, etc.)
+        with open(args.config) as f:
+            config.update(json.load(f))
+        config["data_path"] = data_path
+    os.makedirs(data_path, exist_ok=True)
+    config_path = os.path.join(work_path, "config-" + os.path.basename(data_path) + ".json")
+    with open(config_path, 'w') as f:
+        json.dump(config, f, indent=4)
+    return config_path
+
+def report(results, baseline=None, threshold=0.1):
+    """
+    Print the results, compared to the baseline if any, return the list of regressions
+    """
+    columns = ("documents", "documents_per_second", "mb_per_second", "p50", "p99", "cpu_seconds", "rss_mb", "errors")
+    print("%-10s" % "scenario" + "".join("%14s" % column.replace("documents_per_second", "docs/s").replace("mb_per_second", "MB/s") for column in columns))
+    regressions = []
+    for scenario, result in results.items():
+        print("%-10s" % scenario + "".join("%14s" % result.get(column) for column in columns))
+        if baseline is None or scenario not in baseline:
+            continue
+        previous = baseline[scenario]
+        # lower is worse for the rates, higher is worse for the latencies and the resources
+        for column, lower_is_worse in (("documents_per_second", True), ("mb_per_second", True), ("p50", False), ("p99", False),
+                                       ("cpu_seconds", False), ("rss_mb", False)):
+            before, after = previous.get(column), result.get(column)
+            if not before or after is None:
+                continue
+            change = (after - before) / before
+            if (lower_is_worse and change < -threshold) or (not lower_is_worse and change > threshold):
+                regressions.append((scenario, column, before, after, change))
+    for scenario, column, before, after, change in regressions:
+        print("REGRESSION %s %s: %s -> %s (%+.1f%%)" % (scenario, column, before, after, change * 100))
+    return regressions
+
+def _wait_port(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError("port " + str(port) + " not available")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Benchmark of the harvester with local stand-in servers")
+    parser.add_argument("--work", default="/tmp/oaharvester-benchmark", help="working directory, removed at the beginning of a run")
+    parser.add_argument("--scenarios", default=",".join(scenarios), help="comma separated scenarios among " + ", ".join(scenarios))
+    parser.add_argument("--entries", type=int, default=20000, help="number of Unpaywall entries, default 20000 (about 4000 with a PDF url)")
+    parser.add_argument("--pmc-entries", type=int, default=2000, help="number of PMC entries, default 2000")
+    parser.add_argument("--hosts", type=int, default=10, help="number of document hosts, default 10")
+    parser.add_argument("--port", type=int, default=8780, help="port of the document servers, +1 for S3 and +2 for FTP, default 8780")
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds before each response, default 0.05")
+    parser.add_argument("--bandwidth", type=float, default=0, help="bytes per second of each response, default no limit")
+    parser.add_argument("--error-rate", type=float, default=0.05, help="proportion of dead links, default 0.05")
+    parser.add_argument("--transient-rate", type=float, default=0.02, help="proportion of random 503 errors, default 0.02")
+    parser.add_argument("--html-rate", type=float, default=0.02, help="proportion of HTML pages instead of the PDF, default 0.02")
+    parser.add_argument("--redirect-rate", type=float, default=0.1, help="proportion of redirected urls, default 0.1")
+    parser.add_argument("--host-rate", type=float, default=0, help="max requests per second per host, default no limit")
+    parser.add_argument("--mean-size", type=int, default=200 * 1024, help="mean size of the PDF in bytes, default 200KB")
+    parser.add_argument("--s3", action="store_true", help="upload the harvested files to the S3 stand-in")
+    parser.add_argument("--ftp", action="store_true", help="download the PMC archives from the FTP stand-in (requires pyftpdlib)")
+    parser.add_argument("--async", dest="async_mode", action="store_true", help="run the harvester in asynchronous mode")
+    parser.add_argument("--config", default=None, help="JSON file of harvester config values to benchmark (e.g. nb_workers, batch_size)")
+    parser.add_argument("--report", default=None, help="write the results in this JSON file")
+    parser.add_argument("--baseline", default=None, help="JSON report of a previous run to compare with")
+    parser.add_argument("--threshold", type=float, default=0.1, help="relative change reported as a regression, default 0.1")
+    parser.add_argument("--child", default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--input", default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        run_scenario(args.child, args.config, args.input, args.async_mode)
+        sys.exit(0)
+
+    work_path = os.path.abspath(args.work)
+    shutil.rmtree(work_path, ignore_errors=True)
+    os.makedirs(work_path)
+    selected = [scenario for scenario in args.scenarios.split(",") if scenario]
+
+    print("generating inputs...")
+    unpaywall_path = os.path.join(work_path, "unpaywall.jsonl.gz")
+    Generate.unpaywall(unpaywall_path, args.entries, args.port, args.hosts)
+    pmc_path = os.path.join(work_path, "pmc_list.txt")
+    Generate.pmc_list(pmc_path, args.pmc_entries, "pmc/")
+    if args.ftp:
+        Generate.pmc_archives(os.path.join(work_path, "ftp"), args.pmc_entries, args.mean_size)
+
+    servers = start_servers(args, work_path)
+    try:
+        _wait_port(args.port)
+        unpaywall_config = harvester_config(args, work_path, os.path.join(work_path, "data"))
+        pmc_config = harvester_config(args, work_path, os.path.join(work_path, "data-pmc"))
+        inputs = { "unpaywall": (unpaywall_config, unpaywall_path), "reprocess": (unpaywall_config, ""),
+            "dump": (unpaywall_config, os.path.join(work_path, "dump.json.gz")), "pmc": (pmc_config, pmc_path) }
+        results = {}
+        for scenario in selected:
+            print("running", scenario, "...")
+            config_path, input_path = inputs[scenario]
+            results[scenario] = measure(scenario, config_path, input_path, args.async_mode,
+                os.path.join(work_path, scenario + ".log"))
+    finally:
+        servers.kill()
+        servers.wait()
+
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+    regressions = report(results, baseline, args.threshold)
+    if args.report is not None:
+        with open(args.report, 'w') as f:
+            json.dump({ "time": time.strftime("%Y-%m-%dT%H:%M:%S"), "arguments": vars(args), "results": results }, f, indent=4)
+    sys.exit(1 if regressions else 0)
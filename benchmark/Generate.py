@@ -0,0 +1,122 @@
+import io
+import os
+import gzip
+import json
+import tarfile
+import random
+import argparse
+
+"""
+Synthetic inputs for the benchmark: an Unpaywall snapshot (.jsonl.gz) and a PMC file list, whose PDF
+urls point to the local benchmark servers (see Servers.py), and the synthetic documents served.
+
+The urls are spread over several hosts, 127.0.0.1 to 127.0.0.<nb_hosts>, which are all local addresses
+of the loopback interface on Linux but are distinct hosts for the per-host scheduling of the harvester.
+The path of a url encodes the document number, from which the server derives the size and the content
+of the PDF, so that the documents are distinct (no deduplication) and the runs are reproducible.
+"""
+
+# fields of an Unpaywall entry, filled with realistic values to keep a realistic line size
+publishers = ["Elsevier BV", "Springer Nature", "Wiley", "PLoS", "MDPI AG", "Frontiers Media SA"]
+genres = ["journal-article", "proceedings-article", "book-chapter", "posted-content"]
+licenses = ["cc-by", "cc-by-nc", "cc0", None]
+
+def host_url(port, host, scheme="http"):
+    return "%s://127.0.0.%d:%d/" % (scheme, host + 1, port)
+
+def unpaywall(path, nb_entries, port, nb_hosts=10, oa_ratio=0.2, seed=0):
+    """
+    Write a gzipped Unpaywall snapshot of nb_entries lines, a proportion oa_ratio of them having a PDF
+    url. Return the number of entries with a PDF url.
+    """
+    rng = random.Random(seed)
+    nb_pdf = 0
+    with gzip.open(path, 'wt', compresslevel=5) as f:
+        for i in range(nb_entries):
+            doi = "10.%d/bench.%d" % (1000 + i % 9000, i)
+            best_oa_location = None
+            oa_locations = []
+            if rng.random() < oa_ratio:
+                url = host_url(port, rng.randrange(nb_hosts)) + "pdf/%d.pdf" % i
+                best_oa_location = { "url_for_pdf": url, "url": url, "host_type": "repository",
+                    "license": rng.choice(licenses), "version": "publishedVersion", "evidence": "oa repository (via OAI-PMH doi match)",
+                    "url_for_landing_page": url.replace("/pdf/", "/landing/") }
+                oa_locations.append(best_oa_location)
+                nb_pdf += 1
+            entry = { "doi": doi, "doi_url": "https://doi.org/" + doi, "title": "Synthetic document %d for benchmarking" % i,
+                "genre": rng.choice(genres), "publisher": rng.choice(publishers), "journal_name": "Journal of Benchmarks",
+                "journal_issns": "1234-5678", "year": 1990 + i % 30, "is_oa": best_oa_location is not None,
+                "best_oa_location": best_oa_location, "oa_locations": oa_locations, "updated": "2018-06-21T16:45:48",
+                "z_authors": [{ "family": "Author%d" % j, "given": "A." } for j in range(1 + i % 5)] }
+            f.write(json.dumps(entry))
+            f.write("\n")
+    return nb_pdf
+
+def pmc_list(path, nb_entries, base):
+    """
+    Write a PMC file list of nb_entries archives, whose subpaths are relative to the pmc_base of the 
+    harvester config, all on a single host as for the NIH server. Return the number of entries.
+    """
+    with open(path, 'w') as f:
+        f.write("2018-06-21 16:45:48\n")
+        for i in range(nb_entries):
+            f.write("%sPMC%d.tar.gz\tJ Bench. 2018 Jan; %d:%d\tPMC%d\tPMID:%d\tCC BY\n" % (base, i, i % 100, i, i, 10000000 + i))
+    return nb_entries
+
+def pmc_archives(directory, nb_entries, mean_size=200 * 1024):
+    """
+    Write the PMC archives of pmc_list() into directory, for the FTP stand-in
+    """
+    os.makedirs(os.path.join(directory, "pmc"), exist_ok=True)
+    for i in range(nb_entries):
+        with open(os.path.join(directory, "pmc", "PMC%d.tar.gz" % i), 'wb') as f:
+            f.write(archive(i, mean_size))
+
+def document(number, mean_size=200 * 1024):
+    """
+    Content of the PDF number, a structurally valid PDF of random size (log-normal around mean_size), 
+    identical for the same number and mean size
+    """
+    rng = random.Random(number)
+    size = max(1024, int(rng.lognormvariate(0, 0.6) * mean_size / 1.2))
+    body = b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n1 0 obj\n<< /Length " + str(size).encode() + b" >>\nstream\n"
+    body += rng.getrandbits(size * 8).to_bytes(size, 'little') + b"\nendstream\nendobj\n"
+    xref = len(body)
+    return body + b"xref\n0 2\n0000000000 65535 f \n0000000015 00000 n \ntrailer\n<< /Size 2 >>\nstartxref\n" + str(xref).encode() + b"\n%%EOF\n"
+
+def nlm(number):
+    return ('<?xml version="1.0"?>\n<article><front><article-meta><article-id pub-id-type="pmc">%d</article-id>'
+            '<title-group><article-title>Synthetic document %d</article-title></title-group></article-meta>'
+            '</front><body>%s</body></article>\n' % (number, number, "<p>text</p>" * 200)).encode()
+
+def archive(number, mean_size=200 * 1024):
+    """
+    Content of the PMC archive number, with the NLM file and the PDF
+    """
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode='w:gz', compresslevel=1) as tar:
+        for name, content in (("PMC%d/article.nxml" % number, nlm(number)), ("PMC%d/article.pdf" % number, document(number, mean_size))):
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+    return buffer.getvalue()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Generate synthetic inputs for benchmarking the harvester")
+    parser.add_argument("--unpaywall", default=None, help="path of the Unpaywall snapshot to write (.jsonl.gz)")
+    parser.add_argument("--pmc", default=None, help="path of the PMC file list to write")
+    parser.add_argument("--entries", type=int, default=10000, help="number of entries, default 10000")
+    parser.add_argument("--port", type=int, default=8780, help="port of the benchmark HTTP server, default 8780")
+    parser.add_argument("--hosts", type=int, default=10, help="number of distinct hosts, default 10")
+    parser.add_argument("--oa-ratio", type=float, default=0.2, help="proportion of Unpaywall entries with a PDF url, default 0.2")
+    parser.add_argument("--pmc-base", default="pmc/", help="prefix of the archive subpaths in the PMC file list, default pmc/")
+    parser.add_argument("--archives", default=None, help="directory where to write the PMC archives, for the FTP stand-in")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the generation")
+    args = parser.parse_args()
+
+    if args.unpaywall is not None:
+        print(unpaywall(args.unpaywall, args.entries, args.port, args.hosts, args.oa_ratio, args.seed), "entries with a PDF url")
+    if args.pmc is not None:
+        print(pmc_list(args.pmc, args.entries, args.pmc_base), "PMC entries")
+    if args.archives is not None:
+        pmc_archives(args.archives, args.entries)
@@ -0,0 +1,304 @@
+import re
+import sys
+import time
+import uuid
+import random
+import hashlib
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs, unquote
+
+import Generate
+
+# pyftpdlib is optional, only needed for the FTP stand-in
+try:
+    from pyftpdlib.authorizers import DummyAuthorizer
+    from pyftpdlib.handlers import FTPHandler
+    from pyftpdlib.servers import ThreadedFTPServer
+except ImportError:
+    ThreadedFTPServer = None
+
+"""
+Local stand-ins of the servers accessed by the harvester, for benchmarking without the internet.
+
+- The document servers listen on 127.0.0.1 to 127.0.0.<nb_hosts>, one distinct host per address, and
+  serve the synthetic PDF (/pdf/<n>.pdf) and PMC archives (/pmc/PMC<n>.tar.gz) of Generate.py. The
+  behaviour of the servers is given by a profile: latency before the response, bandwidth of each
+  response, proportion of dead links (404), of transient errors (503), of HTML landing pages instead
+  of the PDF and of redirections, and a max request rate per host above which the requests are
+  rejected with 429. The permanent behaviours (dead links, landing pages, redirections) depend only on
+  the document number, the transient errors are random.
+- The S3 stand-in implements the subset of the S3 API used by the harvester (put, multipart upload,
+  head, ranged get, list, delete). The uploaded bodies are read and discarded, unless kept in memory
+  for the pack storage which reads them back.
+- The FTP stand-in serves the PMC archives written by Generate.py --archives, if pyftpdlib is installed.
+"""
+
+class Profile(object):
+
+    def __init__(self, latency=0.05, jitter=0.5, bandwidth=0, error_rate=0.05, transient_rate=0.02,
+                 html_rate=0.02, redirect_rate=0.1, host_rate=0, mean_size=200 * 1024):
+        # seconds before the response, varying of +/- jitter (relative)
+        self.latency = latency
+        self.jitter = jitter
+        # bytes per second for each response, 0 for no limit
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.transient_rate = transient_rate
+        self.html_rate = html_rate
+        self.redirect_rate = redirect_rate
+        # max requests per second per host, 0 for no limit
+        self.host_rate = host_rate
+        self.mean_size = mean_size
+
+def _draw(number, name):
+    # deterministic value in [0, 1[ for a document and a behaviour
+    digest = hashlib.blake2b(("%s:%d" % (name, number)).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'little') / 2**64
+
+class _RateLimiter(object):
+    """
+    Token bucket of the requests of a host
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def allow(self):
+        if self.rate <= 0:
+            return True
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+document_path = re.compile(r'^/(r/)?(pdf|pmc)/(PMC)?(\d+)\.(pdf|tar\.gz)$')
+
+def document_handler(profile, limiter):
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            match = document_path.match(urlsplit(self.path).path)
+            if match is None:
+                return self._respond(404, b"not found", "text/plain")
+            if not limiter.allow():
+                return self._respond(429, b"too many requests", "text/plain", { "Retry-After": "1" })
+            redirected, kind, number = match.group(1) is not None, match.group(2), int(match.group(4))
+            time.sleep(max(0.0, profile.latency * (1 + random.uniform(-profile.jitter, profile.jitter))))
+
+            if _draw(number, "error") < profile.error_rate:
+                return self._respond(404, b"not found", "text/plain")
+            if random.random() < profile.transient_rate:
+                return self._respond(503, b"unavailable", "text/plain")
+            if not redirected and _draw(number, "redirect") < profile.redirect_rate:
+                return self._respond(302, b"", "text/plain", { "Location": "/r" + self.path })
+            if kind == "pdf" and _draw(number, "html") < profile.html_rate:
+                return self._respond(200, b"<!DOCTYPE html><html><head><title>Landing page</title></head><body></body></html>", "text/html")
+            if kind == "pdf":
+                return self._respond(200, Generate.document(number, profile.mean_size), "application/pdf")
+            return self._respond(200, Generate.archive(number, profile.mean_size), "application/gzip")
+
+        def _respond(self, status, body, content_type, headers=None):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            if profile.bandwidth <= 0:
+                self.wfile.write(body)
+                return
+            # throttled response, by slices of 1/20 s
+            step = max(1, int(profile.bandwidth / 20))
+            for start in range(0, len(body), step):
+                self.wfile.write(body[start:start + step])
+                time.sleep(len(body[start:start + step]) / profile.bandwidth)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+def s3_handler(keep=False):
+    # key -> body (None if discarded), size
+    objects = {}
+    uploads = {}
+    lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def _key(self):
+            parts = urlsplit(self.path)
+            bucket, _, key = unquote(parts.path).lstrip('/').partition('/')
+            return bucket, key, parse_qs(parts.query, keep_blank_values=True)
+
+        def _body(self):
+            length = int(self.headers.get("Content-Length", 0))
+            body = self.rfile.read(length)
+            if "aws-chunked" in self.headers.get("Content-Encoding", ""):
+                body = _decode_aws_chunked(body)
+            return body
+
+        def do_PUT(self):
+            bucket, key, query = self._key()
+            body = self._body()
+            if not key:
+                return self._respond(200)
+            etag = '"%s"' % hashlib.md5(body).hexdigest()
+            if "uploadId" in query:
+                with lock:
+                    uploads[query["uploadId"][0]][int(query["partNumber"][0])] = body if keep else len(body)
+                return self._respond(200, headers={ "ETag": etag })
+            with lock:
+                objects[key] = (body if keep else None, len(body))
+            self._respond(200, headers={ "ETag": etag })
+
+        def do_POST(self):
+            bucket, key, query = self._key()
+            self._body()
+            if "uploads" in query:
+                upload_id = uuid.uuid4().hex
+                with lock:
+                    uploads[upload_id] = {}
+                return self._respond(200, ("<InitiateMultipartUploadResult><Bucket>%s</Bucket><Key>%s</Key><UploadId>%s</UploadId>"
+                    "</InitiateMultipartUploadResult>" % (bucket, key, upload_id)).encode())
+            if "uploadId" in query:
+                with lock:
+                    parts = uploads.pop(query["uploadId"][0])
+                    if keep:
+                        body = b"".join(parts[number] for number in sorted(parts))
+                        objects[key] = (body, len(body))
+                    else:
+                        objects[key] = (None, sum(parts.values()))
+                return self._respond(200, ("<CompleteMultipartUploadResult><Bucket>%s</Bucket><Key>%s</Key><ETag>\"%s\"</ETag>"
+                    "</CompleteMultipartUploadResult>" % (bucket, key, uuid.uuid4().hex)).encode())
+            self._respond(400)
+
+        def do_HEAD(self):
+            bucket, key, _ = self._key()
+            with lock:
+                stored = objects.get(key)
+            if stored is None:
+                return self._respond(404, head=True)
+            self._respond(200, headers={ "Content-Length": str(stored[1]) }, head=True)
+
+        def do_GET(self):
+            bucket, key, query = self._key()
+            if not key:
+                prefix = query.get("prefix", [""])[0]
+                with lock:
+                    keys = sorted(name for name in objects if name.startswith(prefix))
+                contents = "".join("<Contents><Key>%s</Key><Size>%d</Size></Contents>" % (name, objects[name][1]) for name in keys)
+                return self._respond(200, ("<ListBucketResult><Name>%s</Name><Prefix>%s</Prefix><IsTruncated>false</IsTruncated>%s"
+                    "</ListBucketResult>" % (bucket, prefix, contents)).encode())
+            with lock:
+                stored = objects.get(key)
+            if stored is None or stored[0] is None:
+                return self._respond(404, b"<Error><Code>NoSuchKey</Code></Error>")
+            body = stored[0]
+            range_match = re.match(r'bytes=(\d+)-(\d+)', self.headers.get("Range", ""))
+            if range_match:
+                body = body[int(range_match.group(1)):int(range_match.group(2)) + 1]
+                return self._respond(206, body)
+            self._respond(200, body)
+
+        def do_DELETE(self):
+            bucket, key, _ = self._key()
+            with lock:
+                objects.pop(key, None)
+            self._respond(204)
+
+        def _respond(self, status, body=b"", headers=None, head=False):
+            self.send_response(status)
+            headers = dict(headers or {})
+            headers.setdefault("Content-Length", str(len(body)))
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.end_headers()
+            if not head:
+                self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+def _decode_aws_chunked(body):
+    """
+    Payload of a body in the aws-chunked encoding used by the recent S3 clients for the checksums
+    """
+    data = []
+    position = 0
+    while True:
+        end = body.index(b"\r\n", position)
+        size = int(body[position:end].split(b";")[0], 16)
+        if size == 0:
+            return b"".join(data)
+        data.append(body[end + 2:end + 2 + size])
+        position = end + 2 + size + 2
+
+def start_servers(port, nb_hosts, profile, s3_port=None, s3_keep=False, ftp_port=None, ftp_directory=None):
+    """
+    Start the stand-in servers in daemon threads, return the server objects
+    """
+    servers = []
+    for host in range(nb_hosts):
+        # one request rate limit per host
+        server = ThreadingHTTPServer(("127.0.0.%d" % (host + 1), port), document_handler(profile, _RateLimiter(profile.host_rate)))
+        server.daemon_threads = True
+        servers.append(server)
+    if s3_port:
+        server = ThreadingHTTPServer(("127.0.0.1", s3_port), s3_handler(s3_keep))
+        server.daemon_threads = True
+        servers.append(server)
+    for server in servers:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    if ftp_port:
+        if ThreadedFTPServer is None:
+            raise ImportError("the FTP stand-in requires pyftpdlib, install it with: pip3 install pyftpdlib")
+        authorizer = DummyAuthorizer()
+        authorizer.add_anonymous(ftp_directory)
+        handler = type("Handler", (FTPHandler,), { "authorizer": authorizer })
+        server = ThreadedFTPServer(("127.0.0.1", ftp_port), handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+    return servers
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Local stand-ins of the document, S3 and FTP servers for benchmarking the harvester")
+    parser.add_argument("--port", type=int, default=8780, help="port of the document servers, default 8780")
+    parser.add_argument("--hosts", type=int, default=10, help="number of document hosts (127.0.0.1 to 127.0.0.N), default 10")
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds before each response, default 0.05")
+    parser.add_argument("--bandwidth", type=float, default=0, help="bytes per second of each response, default no limit")
+    parser.add_argument("--error-rate", type=float, default=0.05, help="proportion of dead links, default 0.05")
+    parser.add_argument("--transient-rate", type=float, default=0.02, help="proportion of random 503 errors, default 0.02")
+    parser.add_argument("--html-rate", type=float, default=0.02, help="proportion of HTML pages instead of the PDF, default 0.02")
+    parser.add_argument("--redirect-rate", type=float, default=0.1, help="proportion of redirected urls, default 0.1")
+    parser.add_argument("--host-rate", type=float, default=0, help="max requests per second per host, default no limit")
+    parser.add_argument("--mean-size", type=int, default=200 * 1024, help="mean size of the PDF in bytes, default 200KB")
+    parser.add_argument("--s3-port", type=int, default=None, help="port of the S3 stand-in, none by default")
+    parser.add_argument("--s3-keep", action="store_true", help="keep the uploaded objects in memory, for reading them back")
+    parser.add_argument("--ftp-port", type=int, default=None, help="port of the FTP stand-in, none by default")
+    parser.add_argument("--ftp-directory", default=None, help="directory served by the FTP stand-in (see Generate.py --archives)")
+    args = parser.parse_args()
+
+    profile = Profile(latency=args.latency, bandwidth=args.bandwidth, error_rate=args.error_rate, transient_rate=args.transient_rate,
+                      html_rate=args.html_rate, redirect_rate=args.redirect_rate, host_rate=args.host_rate, mean_size=args.mean_size)
+    start_servers(args.port, args.hosts, profile, args.s3_port, args.s3_keep, args.ftp_port, args.ftp_directory)
+    print("ready", flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        sys.exit(0)